@@ -0,0 +1,348 @@
+""" Bootra JSON API
+
+Version 1 of the JSON API for mobile clients and dashboards, registered on
+the app under /api/v1. Uses the same session login as the web pages.
+
+Every GET response carries an ETag of its body, so clients polling with
+If-None-Match get an empty 304 Not Modified when nothing has changed.
+
+SECTIONS:
+    - Config
+    - Current Routes
+    - History Routes
+    - Goal Routes
+    - Reading Routes
+    - Search Routes
+    - Other Functions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+from datetime import date
+from functools import wraps
+
+from flask import Blueprint, jsonify, request, session
+
+from helpers import *
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Fields of current and history rows returned by the API
+CURRENT_FIELDS = ["id", "title", "author", "isbn", "pages", "page", "progress",
+                  "start_date", "target_date"]
+HISTORY_FIELDS = ["id", "title", "author", "isbn", "pages", "start_date",
+                  "end_date", "days", "rate"]
+SEARCH_FIELDS = ["id", "title", "author", "isbn", "pages", "shelf",
+                 "start_date", "end_date"]
+GOAL_FIELDS = ["id", "kind", "description", "target", "progress", "percent",
+               "status", "period_start", "period_end"]
+STREAK_FIELDS = ["current", "best", "last_day"]
+
+
+def api_login_required(f):
+    """Decorate API routes to require login, 401 instead of redirecting"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None:
+            return error("Login required", 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@api.after_request
+def conditional(response):
+    """Adds an ETag to GET responses and answers If-None-Match with 304."""
+    if request.method == "GET" and response.status_code == 200:
+        response.add_etag()
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.make_conditional(request)
+    return response
+
+
+################################ CURRENT ROUTES ###############################
+
+@api.route("/current")
+@api_login_required
+def current():
+    """
+    Users current books, most recently started first.
+
+    GET:
+        Paged with the size and after args as on the homepage.
+        Returns {"books": [...], "after": next cursor or null}.
+    """
+    books, after = select_current_page(request.args.get("after"),
+                                       page_size(request.args.get("size")))
+    for book in books:
+        append_progress(book)
+    return {"books": [pick(book, CURRENT_FIELDS) for book in books],
+            "after": after}
+
+
+@api.route("/current/<int:book_id>")
+@api_login_required
+def current_book(book_id):
+    """
+    One current book with the dashboard projections from the /book page.
+
+    GET:
+        Returns {"book": {...}, "rates": {...}, "dates": {...}}.
+        404 if the book is not in the users current books.
+    """
+    book = select_from_current(book_id)
+    if book is None:
+        return error("Book not in current", 404)
+    return dashboard(book)
+
+
+@api.route("/current/<int:book_id>/page", methods=["PUT"])
+@api_login_required
+def current_page(book_id):
+    """
+    Updates users current page for a book, as the /update page does.
+
+    PUT:
+        Takes {"page": int} between 0 and the book's pages.
+        Returns the updated dashboard as GET /current/<book_id>.
+    """
+    book = select_from_current(book_id)
+    if book is None:
+        return error("Book not in current", 404)
+    if not book["pages"]:
+        return error("Book details are still being looked up", 409)
+
+    page = (request.get_json(silent=True) or {}).get("page")
+    if type(page) is not int or not 0 <= page <= book["pages"]:
+        return error(f"page must be an integer from 0 to {book['pages']}")
+
+    update_progress(book, page)
+    return dashboard(select_from_current(book_id))
+
+
+@api.route("/current/pages", methods=["PUT"])
+@api_login_required
+def current_pages():
+    """
+    Updates users current page for many books at once, e.g. a day's reading
+    synced from an e-reader. All the pages are saved or, if any is invalid,
+    none are.
+
+    PUT:
+        Takes {"pages": [{"book_id": int, "page": int}, ...]}, each book at
+        most once and at most MAX_PAGE_SIZE books.
+        Returns {"books": [...]} with the updated dashboard of each book as
+        GET /current/<book_id>, in the order given.
+    """
+    updates = (request.get_json(silent=True) or {}).get("pages")
+    if type(updates) is not list or not 1 <= len(updates) <= MAX_PAGE_SIZE:
+        return error(f"pages must be a list of 1 to {MAX_PAGE_SIZE} updates")
+
+    pages = {}
+    for update in updates:
+        if type(update) is not dict or type(update.get("book_id")) is not int \
+                or type(update.get("page")) is not int:
+            return error("Each update must have an integer book_id and page")
+        if update["book_id"] in pages:
+            return error(f"Book {update['book_id']} is updated twice")
+        pages[update["book_id"]] = update["page"]
+
+    try:
+        books = update_progress_many(pages)
+    except ValueError as e:
+        return error(str(e))
+
+    order = {book_id: n for n, book_id in enumerate(pages)}
+    books.sort(key=lambda book: order[book["id"]])
+    return {"books": dashboards(books)}
+
+
+@api.route("/current/<int:book_id>/target", methods=["PUT"])
+@api_login_required
+def current_target(book_id):
+    """
+    Sets or clears the target date for a book, as the /book page does.
+
+    PUT:
+        Takes {"target_date": "YYYY-MM-DD" after today, or null to clear}.
+        Returns the updated dashboard as GET /current/<book_id>.
+    """
+    book = select_from_current(book_id)
+    if book is None:
+        return error("Book not in current", 404)
+
+    target = (request.get_json(silent=True) or {}).get("target_date")
+    if target is not None:
+        try:
+            if date.fromisoformat(target) <= date.today():
+                return error("target_date must be after today")
+        except (TypeError, ValueError):
+            return error("target_date must be a YYYY-MM-DD date or null")
+
+    update_current(book_id, "target_date", target)
+    return dashboard(select_from_current(book_id))
+
+
+################################ HISTORY ROUTES ###############################
+
+@api.route("/history")
+@api_login_required
+def history():
+    """
+    Users finished books, most recently finished first, and lifetime stats.
+
+    GET:
+        Paged with the size and after args as on the history page.
+        Returns {"books": [...], "stats": {...}, "after": next cursor or null}.
+    """
+    books, stats, after = select_history_with_stats(
+        request.args.get("after"), page_size(request.args.get("size")))
+    return {"books": [pick(book, HISTORY_FIELDS) for book in books],
+            "stats": stats, "after": after}
+
+
+################################# GOAL ROUTES #################################
+
+@api.route("/goals")
+@api_login_required
+def goals():
+    """
+    Users reading goals and streak, as the /goals page shows them.
+
+    GET:
+        Returns {"goals": [...], "past": [...], "streak": {...}} with the
+        active goals, the most recently ended goals and the reading streak,
+        null if the user has never read.
+    """
+    goals = select_goals()
+    streak = goals["streak"]
+    return {"goals": [pick(goal, GOAL_FIELDS) for goal in goals["active"]],
+            "past": [pick(goal, GOAL_FIELDS) for goal in goals["past"]],
+            "streak": streak and pick(streak, STREAK_FIELDS)}
+
+
+@api.route("/goals/<kind>", methods=["PUT"])
+@api_login_required
+def goal(kind):
+    """
+    Sets users goal of a kind, books_year, pages_month or streak_days.
+
+    PUT:
+        Takes {"target": int}, replacing the target of the active goal of
+        the kind if there is one.
+        Returns the goals as GET /goals.
+    """
+    target = (request.get_json(silent=True) or {}).get("target")
+    try:
+        save_goal(kind, target)
+    except ValueError as e:
+        return error(str(e))
+    return goals()
+
+
+@api.route("/goals/<int:goal_id>", methods=["DELETE"])
+@api_login_required
+def remove_goal(goal_id):
+    """
+    Deletes one of users goals.
+
+    DELETE:
+        Returns the goals left as GET /goals.
+        404 if the user has no such goal.
+    """
+    if not delete_goal(goal_id):
+        return error("Goal not found", 404)
+    return goals()
+
+
+################################ READING ROUTES ###############################
+
+@api.route("/reading")
+@api_login_required
+def reading():
+    """
+    Users pages read per day, from the reading event log.
+
+    GET:
+        Reads the number of days up to today from the days arg, default 30,
+        and optionally a book_id arg to count one book.
+        Returns {"days": [{"day": "YYYY-MM-DD", "pages": int}, ...]}.
+    """
+    days = request.args.get("days", "30")
+    if not days.isdigit() or not 1 <= int(days) <= 366:
+        return error("days must be an integer from 1 to 366")
+    book_id = request.args.get("book_id", type=int)
+
+    return {"days": [{"day": day.isoformat(), "pages": pages}
+                     for day, pages in pages_per_day(int(days), book_id)]}
+
+
+################################ SEARCH ROUTES ################################
+
+@api.route("/search")
+@api_login_required
+def search():
+    """
+    Full text search of the users current and history books, as the /search
+    page does.
+
+    GET:
+        Reads the words to search for from the q arg and optionally the max
+        number of results from the limit arg.
+        Returns {"books": [...]} best matches first, each with a shelf of
+        'current' or 'history'.
+    """
+    limit = min(request.args.get("limit", SEARCH_LIMIT, type=int),
+                MAX_PAGE_SIZE)
+    books = search_books(request.args.get("q", ""), max(limit, 1))
+    return {"books": [pick(book, SEARCH_FIELDS) for book in books]}
+
+
+############################### OTHER FUNCTIONS ###############################
+
+def dashboard(book):
+    """
+    Builds the JSON body for a current book and its projections.
+
+    Args:
+        book (dict): current book data from select_from_current
+
+    Returns:
+        dict of book, rates and dates, dates as 'YYYY-MM-DD' strings
+    """
+    return dashboards([book])[0]
+
+
+def dashboards(books):
+    """
+    Builds the JSON bodies for many current books, with their projections
+    worked out together in one batch.
+
+    Args:
+        books (list of dicts): current book data from select_from_current
+
+    Returns:
+        list of dicts as from dashboard
+    """
+    projections = project_books(books,
+                                recent_rates=select_recent_rates(books))
+    bodies = []
+    for book, (rates, dates) in zip(books, projections):
+        append_progress(book)
+        bodies.append({"book": pick(book, CURRENT_FIELDS), "rates": rates,
+                       "dates": {key: value and value.isoformat()
+                                 for key, value in dates.items()}})
+    return bodies
+
+
+def error(message, status=400):
+    """Returns a JSON error response."""
+    return jsonify(error=message), status
+
+
+def pick(book, fields):
+    """Returns the given fields of a book dict, dates as 'YYYY-MM-DD'."""
+    return {field: book[field].isoformat()
+            if isinstance(book.get(field), date) else book.get(field)
+            for field in fields}
@@ -12,28 +12,93 @@ SECTIONS:
     - Config
     - Login Required Routes
     - Login, Register, Logout Routes
+    - Cover Routes
+    - CLI Commands
 """
 
 __author__ = "Jack Cahill"
 
 #################################### CONFIG ###################################
 
+import click
+import os
+
 from datetime import date
-from flask import Flask, flash, redirect, render_template, request, session, url_for
-from flask_session import Session
+from flask import Flask, Response, abort, flash, redirect, render_template, request, send_file, session, stream_with_context, url_for
 from functools import wraps
-from tempfile import mkdtemp
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from api import api
+from assets import Assets, build, compile_templates
+from auth import HashBusy, hash_password, needs_rehash, verify_password
+from covers import SIZES
+from dates import format_date
+from export import FORMATS, export
+from goals import KINDS, MAX_TARGET
 from helpers import *
+from instrument import Instrumentation
+from jobs import INTERVAL, work
+from migrations import explain, full_scans, migrate, pending_migrations, \
+    recording, schema_version
+from openlibrary import async_http, fetch_book_async, http
+from pagecache import STORES, MemoryStore, PageCache, SqliteStore
+from sessions import BACKENDS, SqliteSessionInterface, load_secret_key
+from worker import LookupWorker
 
 app = Flask(__name__)
 
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+# Templates are compiled once at startup and only reloaded when they change
+# in debug mode. CSS and JS are served as fingerprinted bundles, see assets.py
+app.config["TEMPLATES_AUTO_RELOAD"] = None
+app.jinja_env.filters["nice_date"] = format_date
+assets = Assets(app)
+compile_templates(app)
+
+# Sessions are kept in the database shared by all worker processes, or in
+# signed cookies with BOOTRA_SESSIONS=cookie, see sessions.py
+app.config["SESSION_BACKEND"] = os.environ.get("BOOTRA_SESSIONS", "sqlite")
+if app.config["SESSION_BACKEND"] not in BACKENDS:
+    raise ValueError(f"BOOTRA_SESSIONS must be one of {', '.join(BACKENDS)}")
+if app.config["SESSION_BACKEND"] == "sqlite":
+    app.session_interface = SqliteSessionInterface(db)
+else:
+    app.secret_key = load_secret_key()
+
+app.register_blueprint(api)
+
+# Per request timings of SQL statements, Open Library calls and templates,
+# served at /metrics and /debug/profiles. Off unless BOOTRA_INSTRUMENT is
+# set, as it adds work to every query. DEBUG_PANEL adds the timings to pages.
+# Both routes need BOOTRA_METRICS_TOKEN as a bearer token, or without one
+# are only served to requests from this machine. Behind a proxy on this
+# machine every request looks local, so tokenless requests carrying a
+# proxy's X-Forwarded-For, X-Real-IP or Forwarded header are refused
+app.config["INSTRUMENT"] = bool(os.environ.get("BOOTRA_INSTRUMENT"))
+app.config["DEBUG_PANEL"] = bool(os.environ.get("BOOTRA_DEBUG_PANEL"))
+if app.config["INSTRUMENT"]:
+    instrumentation = Instrumentation(
+        app, db, [http, async_http],
+        token=os.environ.get("BOOTRA_METRICS_TOKEN") or None,
+        book_cache=book_cache)
+
+# Rendered pages cached per user until their books change or the day does,
+# in each process or with BOOTRA_PAGE_CACHE=sqlite shared by every process,
+# see pagecache.py
+app.config["PAGE_CACHE"] = os.environ.get("BOOTRA_PAGE_CACHE", "memory")
+if app.config["PAGE_CACHE"] not in STORES:
+    raise ValueError(f"BOOTRA_PAGE_CACHE must be one of {', '.join(STORES)}")
+if app.config["PAGE_CACHE"] != "off":
+    page_store = MemoryStore() if app.config["PAGE_CACHE"] == "memory" \
+        else SqliteStore()
+    page_cache = PageCache(app, page_store, select_data_version)
+
+# New books added from /add are saved straight away as placeholders and
+# looked up in the background, set False to look them up in the request.
+# The worker thread starts with the first lookup. Each placeholder also gets
+# a lookup_book job, so 'flask jobs work' retries lookups that failed or were
+# cut short by a restart
+app.config["BACKGROUND_LOOKUPS"] = True
+lookup_worker = LookupWorker(fetch_book_async, fill_placeholder_book,
+                             retry_placeholder_book)
 
 
 def login_required(f):
@@ -57,17 +122,36 @@ def index():
     percentage progress bar.
 
     GET:
-        Selects users current books from database.
-        Reformats dates for nicer displaying.
+        Selects a page of users current books from database, page size and
+        position given by the size and after args.
         Calculates progress percentages for books for progress bars.
         Renders index.html template.
     """
-    books = select_from_current()
+    size = page_size(request.args.get("size"))
+    books, after = select_current_page(request.args.get("after"), size)
     for book in books:
-        reformat_date(book, "start_date")
         append_progress(book)
 
-    return render_template("index.html", books=books)
+    return render_template("index.html", books=books, after=after, size=size)
+
+
+@app.route("/current/page")
+@login_required
+def current_page():
+    """
+    Next page of the homepage table for infinite scrolling.
+
+    GET:
+        Selects the page of users current books after the after arg.
+        Returns JSON with the rendered table rows and the next cursor.
+    """
+    size = page_size(request.args.get("size"))
+    books, after = select_current_page(request.args.get("after"), size)
+    for book in books:
+        append_progress(book)
+
+    return {"html": render_template("current_rows.html", books=books),
+            "after": after}
 
 
 @app.route("/history", methods=["GET", "POST"])
@@ -85,9 +169,8 @@ def history():
         Redirects user back to homepage.
 
     GET:
-        Selects users book history from database.
-        Reformats dates for nicer displaying.
-        Calculates user lifetime stats.
+        Selects a page of users book history and lifetime stats in one query,
+        page size and position given by the size and after args.
         Renders history.html template.
     """
     if request.method == "POST":
@@ -95,24 +178,42 @@ def history():
         book_id = request.form.get("book_id")
         book = select_from_current(book_id)
 
+        if not book["pages"]:
+            flash("We are still looking up this book's details!")
+            return redirect(url_for("book", book_id=book_id))
+
         if book["start_date"] is None:
             flash("You haven't started this book yet!")
             return redirect(url_for("book", book_id=book_id))
 
         current_to_history(book)
-        flash(f"Congratulations! You have just completed {book["title"]}.")
+        flash(f"Congratulations! You have just completed {book['title']}.")
         return redirect("/")
 
     # GET method
     else:
-        books = select_from_history(order="end_date DESC")
-        for book in books:
-            reformat_date(book, "start_date")
-            reformat_date(book, "end_date")
+        size = page_size(request.args.get("size"))
+        books, stats, after = select_history_with_stats(
+            request.args.get("after"), size)
+        return render_template("history.html", books=books, stats=stats,
+                               after=after, size=size)
+
 
-        stats = {"books": user_books(), "pages": user_pages()}
-        stats["rate"] = user_rate(stats["pages"])
-        return render_template("history.html", books=books, stats=stats)
+@app.route("/history/page")
+@login_required
+def history_page():
+    """
+    Next page of the history table for infinite scrolling.
+
+    GET:
+        Selects the page of users book history after the after arg.
+        Returns JSON with the rendered table rows and the next cursor.
+    """
+    size = page_size(request.args.get("size"))
+    books, stats, after = select_history_with_stats(request.args.get("after"),
+                                                    size)
+    return {"html": render_template("history_rows.html", books=books),
+            "after": after}
 
 
 @app.route("/add", methods=["GET", "POST"])
@@ -124,8 +225,9 @@ def add():
     POST:
         Reached through /add page when form submitted.
         Checks inputs are valid.
-        Looks up book info and inserts new row into books table if it is a new
-        book.
+        If it is a new book, inserts a placeholder row into books table and
+        queues it to be looked up by the background worker, or looks up book
+        info first if BACKGROUND_LOOKUPS is off.
         Insert new row into current linking the current user and the book.
         Redirects user to homepage.
 
@@ -134,10 +236,10 @@ def add():
     """
     if request.method == "POST":
 
-        isbn = request.form.get("isbn")
+        isbn = to_isbn13(request.form.get("isbn"))
         target = request.form.get("target")
 
-        if not valid_isbn(isbn):
+        if isbn is None:
             flash("Please enter a valid ISBN!")
             return render_template("add.html")
 
@@ -147,7 +249,12 @@ def add():
             return render_template("add.html")
 
         in_books = select_from_books(isbn)
-        if not in_books:
+        if not in_books and app.config["BACKGROUND_LOOKUPS"]:
+            book_id = new_placeholder_book(isbn)
+            lookup_worker.submit(isbn)
+            flash("Book added! Its details will appear once we have looked "
+                  "them up.")
+        elif not in_books:
             book_info = lookup_book(isbn)
             if book_info:
                 new_book(book_info)
@@ -171,6 +278,72 @@ def add():
         return render_template("add.html", tomorrow=tomorrow)
 
 
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def bulk_import():
+    """
+    Page with form for adding many books at once, from pasted ISBNs or an
+    uploaded CSV export e.g. from Goodreads.
+
+    POST:
+        Reached through /import page when form submitted.
+        Extracts the ISBNs and adds them all to the user's current table.
+        Renders import.html template with a report of what was added.
+
+    GET:
+        Renders import.html template.
+    """
+    tomorrow = str(date.today() + timedelta(days=1))
+
+    if request.method == "POST":
+
+        text = request.form.get("isbns", "")
+        upload = request.files.get("file")
+        if upload:
+            text += "\n" + upload.read().decode("utf-8", errors="replace")
+
+        isbns = parse_isbns(text)
+        if not isbns:
+            flash("Please enter some ISBNs or choose a file!")
+            return render_template("import.html", tomorrow=tomorrow)
+
+        report = import_books(isbns, session["user_id"],
+                              request.form.get("target"))
+        flash(f"Added {len(report['added'])} of {len(isbns)} books.")
+        return render_template("import.html", tomorrow=tomorrow, report=report)
+
+    # GET method
+    else:
+        return render_template("import.html", tomorrow=tomorrow)
+
+
+@app.route("/export/<format>")
+@login_required
+def export_books(format):
+    """
+    Downloads the user's current and history shelves.
+
+    GET:
+        Streams the books in format, one of FORMATS, gzipped if the browser
+        accepts it.
+    """
+    if format not in FORMATS:
+        abort(404)
+
+    mimetype, extension = FORMATS[format]
+    compress = "gzip" in request.accept_encodings
+    name = "goodreads_library_export" if format == "goodreads" \
+        else "bootra_books"
+    response = Response(stream_with_context(
+        export(db, session["user_id"], format, compress)), mimetype=mimetype)
+    response.headers["Content-Disposition"] = \
+        f"attachment; filename={name}.{extension}"
+    response.vary.add("Accept-Encoding")
+    if compress:
+        response.content_encoding = "gzip"
+    return response
+
+
 @app.route("/book", methods=["GET", "POST"])
 @login_required
 def book():
@@ -209,45 +382,97 @@ def book():
     else:
         book_id = request.args.get("book_id")
         book = select_from_current(book_id)
+
+        # Placeholder book still waiting on its details
+        if not book["pages"]:
+            return render_template("pending.html", book=book,
+                                   status=select_pending_books(book_id))
+
         append_progress(book)
-        pages_left = book["pages"] - book["page"]
-        today = date.today()
-        tomorrow = today + timedelta(days=1)
-        dates = {}
-        rates = {}
-
-        if book["start_date"]:
-            # start_date stored as datetime for calculations
-            start_date = str_to_datetime(book["start_date"])
-            reformat_date(book, "start_date")
-            rates["current"] = calculate_rate(start_date, today, book["page"])
-            dates["current"] = calculate_date(pages_left, rates["current"])
-        else:
-            rates["current"] = dates["current"] = None
-
-        if book["target_date"]:
-            # target_date stored as datetime for calculations
-            target_date = str_to_datetime(book["target_date"])
-            reformat_date(book, "target_date")
-            # Reset target date to NULL if reached
-            if (target_date - today).days < 1:
-                update_current(book_id, "target_date", None)
-                rates["target"] = None
-                flash("Target date has been reset!")
-            else:
-                rates["target"] = calculate_rate(tomorrow, target_date, pages_left)
-        else:
-            rates["target"] = None
+        rates, dates = book_projections(book)
 
-        dates["15min"] = calculate_date(pages_left, 11)
-        dates["30min"] = calculate_date(pages_left, 22)
-        dates["1hour"] = calculate_date(pages_left, 44)
+        # Reached target dates are cleared by the daily goal rollover, until
+        # then they are shown as no target
+        if rates["target"] is None:
+            book["target_date"] = None
 
-        # Tomorrow is min date for target date, used in book.html
-        dates["tomorrow"] = str(tomorrow)
         return render_template("book.html", book=book, rates=rates, dates=dates)
 
 
+@app.route("/forecast")
+@login_required
+def forecast():
+    """
+    Whole shelf forecast of completion dates for all the users current books.
+
+    GET:
+        Reads extra reading speeds in pages per day from the rates arg,
+        e.g. /forecast?rates=15,60
+        Projects every current book at its current rate and each speed in
+        one batched call, plus the date the whole shelf would be finished.
+        Renders forecast.html template.
+    """
+    rates = {"15 mins": READING_RATES["15min"],
+             "30 mins": READING_RATES["30min"],
+             "1 hour": READING_RATES["1hour"]}
+    for rate in request.args.get("rates", "").split(","):
+        if rate.strip().isdigit() and int(rate) > 0:
+            rates[f"{int(rate)} pages"] = int(rate)
+
+    books = select_from_current()
+    projections = project_books(books, rates,
+                                recent_rates=select_recent_rates(books))
+    shelf = shelf_dates(books, rates)
+
+    for book, (book_rates, book_dates) in zip(books, projections):
+        book["rates"] = book_rates
+        book["dates"] = book_dates
+
+    return render_template("forecast.html", books=books, rates=rates,
+                           shelf=shelf)
+
+
+@app.route("/goals", methods=["GET", "POST"])
+@login_required
+def goals():
+    """
+    Users reading goals and streak.
+
+    POST:
+        Reached through /goals page when a goal is set.
+        Sets the goal of the kind chosen to the target entered, replacing
+        the target of the active goal of that kind.
+        Redirects back to /goals.
+
+    GET:
+        Renders goals.html template with the active goals, their progress,
+        the streak and recently ended goals.
+    """
+    if request.method == "POST":
+        try:
+            save_goal(request.form.get("kind"),
+                      int(request.form.get("target", "")))
+        except ValueError:
+            flash(f"Please enter a target from 1 to {MAX_TARGET}!")
+        return redirect(url_for("goals"))
+
+    return render_template("goals.html", goals=select_goals(), kinds=KINDS)
+
+
+@app.route("/goals/remove", methods=["POST"])
+@login_required
+def remove_goal():
+    """
+    Removes one of users goals.
+
+    POST:
+        Reached through /goals page when a goal's remove button is clicked.
+        Redirects back to /goals.
+    """
+    delete_goal(request.form.get("goal_id"))
+    return redirect(url_for("goals"))
+
+
 @app.route("/remove", methods=["POST"])
 def remove():
     """
@@ -264,6 +489,22 @@ def remove():
     return redirect("/")
 
 
+@app.route("/search")
+@login_required
+def search():
+    """
+    Searches the titles and authors of the users current and history books.
+
+    GET:
+        Reads the words to search for from the q arg, each matched as a
+        prefix.
+        Renders search.html template with the best matches first.
+    """
+    query = request.args.get("q", "")
+    books = search_books(query)
+    return render_template("search.html", books=books, query=query)
+
+
 @app.route("/update", methods=["POST"])
 def update():
     """
@@ -288,11 +529,15 @@ def update():
         flash("Please enter an integer for the page number!")
         return redirect(url_for("book", book_id=book_id))
 
-    start_date = select_from_current(book_id)["start_date"]
-    if start_date is None:
-        update_current(book_id, "start_date", str(date.today()))
+    book = select_from_current(book_id)
+    if not book["pages"]:
+        flash("We are still looking up this book's details!")
+        return redirect(url_for("book", book_id=book_id))
 
-    update_current(book_id, "page", page)
+    try:
+        update_progress(book, page)
+    except ValueError:
+        flash(f"Please enter a page number from 0 to {book['pages']}!")
     return redirect(url_for("book", book_id=book_id))
 
 
@@ -308,7 +553,9 @@ def login():
 
     POST:
         Reached through /login page when Log In button clicked.
-        Checks user exists and password is correct then remembers their id
+        Checks the username and IP address haven't run out of attempts.
+        Checks user exists and password is correct, upgrading the stored
+        hash if it was made with an old hash cost, then remembers their id
         before redirecting to the homepage logged in.
     """
     # Forget any user id
@@ -322,11 +569,29 @@ def login():
             flash("Please provide a username and password!")
             return render_template("login.html")
 
+        if not login_limiter.allow(f"user:{username.lower()}",
+                                   f"ip:{request.remote_addr}"):
+            flash("Too many log in attempts, please wait a minute!")
+            return render_template("login.html"), 429
+
         user = select_from_users(username)
-        if user is None or not check_password_hash(user["hash"], password):
+        try:
+            valid = user is not None and verify_password(user["hash"],
+                                                         password)
+        except HashBusy:
+            flash("We're busy right now, please try again shortly!")
+            return render_template("login.html"), 503
+        if not valid:
             flash("Invalid username and/or password!")
             return render_template("login.html")
 
+        # Upgraded at the next log in instead if the pool is busy
+        if needs_rehash(user["hash"]):
+            try:
+                update_user_hash(user["id"], hash_password(password))
+            except HashBusy:
+                pass
+
         session["user_id"] = user["id"]
         return redirect("/")
 
@@ -381,7 +646,11 @@ def register():
             flash("Passwords must match!")
             return render_template("register.html")
 
-        password_hash = generate_password_hash(password)
+        try:
+            password_hash = hash_password(password)
+        except HashBusy:
+            flash("We're busy right now, please try again shortly!")
+            return render_template("register.html"), 503
         new_user(username, password_hash)
         user = select_from_users(username)
         session["user_id"] = user["id"]
@@ -390,3 +659,388 @@ def register():
     # GET method
     else:
         return render_template("register.html")
+
+
+################################# COVER ROUTES ################################
+
+@app.route("/cover/<isbn>/<size>")
+@login_required
+def cover(isbn, size):
+    """
+    Cover of a book at one of the covers.SIZES. Covers not stored yet are
+    fetched from Open Library and resized by a fetch_cover job on the job
+    worker, never in the request.
+
+    GET:
+        Redirects to the image's permanent /covers/<digest> URL.
+        Redirects to the placeholder cover while the cover is being fetched
+        or if the book has no cover.
+        404 if the ISBN isn't of a book in the books table.
+    """
+    isbn = to_isbn13(isbn)
+    if size not in SIZES or isbn is None or not select_from_books(isbn):
+        abort(404)
+
+    found, digest = cover_store.lookup(isbn, size)
+    if not found:
+        schedule_cover(isbn, size)
+        response = redirect(url_for("static", filename="cover.svg"))
+        response.cache_control.no_cache = True
+        return response
+
+    # Short lived as the cover may be replaced when it is evicted, or found
+    # once the book has one
+    response = redirect(url_for("cover_file", digest=digest) if digest
+                        else url_for("static", filename="cover.svg"))
+    response.cache_control.max_age = 24 * 60 * 60
+    return response
+
+
+@app.route("/covers/<digest>")
+def cover_file(digest):
+    """
+    Stored cover image, named by the SHA-256 of its bytes so it never
+    changes. Served with a strong ETag and cached by browsers for a year
+    without revalidating. Supports Range requests.
+    """
+    image = cover_store.file(digest)
+    if image is None:
+        abort(404)
+    response = send_file(image["path"], mimetype=image["mimetype"],
+                         etag=digest, max_age=365 * 24 * 60 * 60,
+                         conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.template_global()
+def cover_url(isbn, size):
+    """
+    URL of a book's cover for templates, straight to the stored image if
+    it is already stored.
+    """
+    found, digest = cover_store.lookup(isbn, size)
+    if found and digest:
+        return url_for("cover_file", digest=digest)
+    return url_for("cover", isbn=isbn, size=size)
+
+
+################################# CLI COMMANDS ################################
+
+@app.cli.command("import-books")
+@click.argument("username")
+@click.argument("file", type=click.File())
+@click.option("--target", help="Target date YYYY-MM-DD for every book.")
+def import_books_command(username, file, target):
+    """
+    Adds the ISBNs in FILE to USERNAME's current books.
+    FILE can be a list of ISBNs or a CSV export e.g. from Goodreads.
+
+    Usage:
+        flask --app application import-books USERNAME FILE [--target DATE]
+    """
+    user = select_from_users(username)
+    if user is None:
+        raise click.ClickException(f"No user called {username}")
+
+    isbns = parse_isbns(file.read())
+    report = import_books(isbns, user["id"], target,
+                          lambda done, total: click.echo(
+                              f"Looked up {done}/{total}", err=True))
+
+    for key, values in report.items():
+        click.echo(f"{key}: {len(values)}")
+        for isbn in values if key != "added" else []:
+            click.echo(f"    {isbn}")
+
+
+@app.cli.command("export-books")
+@click.argument("username")
+@click.option("--format", type=click.Choice(list(FORMATS)), default="csv",
+              show_default=True)
+@click.option("--output", type=click.File("wb"), default="-",
+              help="File to write, default stdout. Gzipped if it ends .gz")
+def export_books_command(username, format, output):
+    """
+    Writes USERNAME's current and history books.
+
+    Usage:
+        flask --app application export-books USERNAME [--format FORMAT]
+                                                      [--output FILE]
+    """
+    user = select_from_users(username)
+    if user is None:
+        raise click.ClickException(f"No user called {username}")
+
+    for chunk in export(db, user["id"], format,
+                        output.name.endswith(".gz")):
+        output.write(chunk)
+
+
+@app.cli.group("assets")
+def assets_command():
+    """Build the static asset bundles."""
+
+
+@assets_command.command("build")
+def assets_build_command():
+    """Bundles, fingerprints and compresses the CSS and JS into static/dist."""
+    for name, file in build().items():
+        click.echo(f"{name} -> static/dist/{file}")
+
+
+@app.cli.group("db")
+def db_command():
+    """Manage the database schema."""
+
+
+@db_command.command("check")
+@click.option("--verbose", is_flag=True, help="Show every query plan.")
+def db_check_command(verbose):
+    """
+    Visits every page and API route as a new user with a few books, rolled
+    back at the end, and checks the query plan of each statement they run.
+    Exits with status 1 if any statement reads a whole table.
+    """
+    class Rollback(Exception):
+        pass
+
+    with recording(db) as statements:
+        try:
+            with db.transaction():
+                visit_every_route()
+                raise Rollback()
+        except Rollback:
+            pass
+
+    failed = 0
+    for sql, runs in statements.items():
+        if not sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE",
+                                                "DELETE", "WITH")):
+            continue
+        plan = explain(db, sql)
+        scans = full_scans(db, plan)
+        failed += bool(scans)
+        if scans or verbose:
+            result = f"FULL SCAN of {', '.join(scans)}" if scans else "OK"
+            click.echo(f"{result} ({runs} runs): {sql}")
+            for step in plan:
+                click.echo(f"    {step}")
+    click.echo(f"{failed} of {len(statements)} statements read a whole table.")
+    if failed:
+        raise SystemExit(1)
+
+
+@db_command.command("migrate")
+@click.option("--to", "target", type=int,
+              help="Version to stop at, the latest if not given.")
+def db_migrate_command(target):
+    """Creates or upgrades the schema, also done when the app starts."""
+    for version in migrate(db, target):
+        click.echo(f"Applied migration {version}.")
+    click.echo(f"Database is at version {schema_version(db)}.")
+
+
+@db_command.command("status")
+def db_status_command():
+    """Shows the schema version and any migrations not yet applied."""
+    click.echo(f"Database is at version {schema_version(db)}.")
+    for version, name in pending_migrations(db):
+        click.echo(f"Pending migration {version}: {name}")
+
+
+def visit_every_route():
+    """
+    Registers a user through the database, adds three books and visits every
+    page and API route the way a user would, for 'flask db check'.
+    """
+    client = app.test_client()
+    new_user("db-check", "")
+    with client.session_transaction() as user_session:
+        user_session["user_id"] = select_from_users("db-check")["id"]
+
+    book_ids = []
+    for isbn in ["9780306406157", "9780140449136", "9780262033848"]:
+        if not select_from_books(isbn):
+            new_book({"title": "Check", "author": "Check", "pages": 100,
+                      "isbn": isbn})
+        client.post("/add", data={"isbn": isbn, "target": "2100-01-01"})
+        book_ids.append(select_from_books(isbn)["id"])
+
+    first, second, third = book_ids
+    visits = [
+        ("get", "/", {}), ("get", "/current/page", {}),
+        ("post", "/goals", {"data": {"kind": "books_year", "target": 12}}),
+        ("post", "/goals", {"data": {"kind": "pages_month", "target": 500}}),
+        ("post", "/goals", {"data": {"kind": "streak_days", "target": 7}}),
+        ("post", "/update", {"data": {"book_id": first, "page": 10}}),
+        ("post", "/update", {"data": {"book_id": second, "page": 100}}),
+        ("get", "/book", {"query_string": {"book_id": first}}),
+        ("post", "/book", {"data": {"book_id": first,
+                                    "target": "2100-06-01"}}),
+        ("get", "/forecast", {}), ("get", "/search", {"query_string":
+                                                      {"q": "check"}}),
+        ("post", "/history", {"data": {"book_id": second}}),
+        ("get", "/history", {}), ("get", "/history/page", {}),
+        ("get", "/export/csv", {}),
+        ("post", "/remove", {"data": {"book_id": third}}),
+        ("get", "/api/v1/current", {}),
+        ("get", f"/api/v1/current/{first}", {}),
+        ("put", f"/api/v1/current/{first}/page", {"json": {"page": 20}}),
+        ("put", "/api/v1/current/pages",
+         {"json": {"pages": [{"book_id": first, "page": 30}]}}),
+        ("put", f"/api/v1/current/{first}/target",
+         {"json": {"target_date": "2100-07-01"}}),
+        ("get", "/api/v1/history", {}), ("get", "/api/v1/reading", {}),
+        ("get", "/goals", {}), ("get", "/api/v1/goals", {}),
+        ("put", "/api/v1/goals/books_year", {"json": {"target": 24}}),
+        ("get", "/api/v1/search", {"query_string": {"q": "check"}})
+    ]
+    for method, path, kwargs in visits:
+        response = getattr(client, method)(path, **kwargs)
+        response.get_data()
+        if response.status_code >= 400:
+            raise click.ClickException(f"{method.upper()} {path} returned "
+                                       f"{response.status_code}")
+
+
+@app.cli.group("events")
+def events_command():
+    """Maintain the reading_events log."""
+
+
+@events_command.command("compact")
+@click.option("--before", type=click.DateTime(["%Y-%m-%d"]),
+              help="Compact events before this date, default today.")
+def events_compact_command(before):
+    """
+    Rolls reading_events into daily totals in reading_days, run daily e.g.
+    from cron.
+    """
+    count = compact_reading_events(before and before.date())
+    click.echo(f"Compacted {count} reading events.")
+
+
+@app.cli.group("goals")
+def goals_command():
+    """Maintain reading goals and streaks."""
+
+
+@goals_command.command("rollover")
+def goals_rollover_command():
+    """
+    Ends the goals, streaks and target dates that have run out, now instead
+    of waiting for the worker's daily goal_rollover job.
+    """
+    counts = rollover_goals()
+    click.echo(f"Ended {counts['ended']} goals and started "
+               f"{counts['started']}, {counts['streaks_met']} streak goals "
+               f"met, {counts['streaks_broken']} streaks broken and "
+               f"{counts['targets']} target dates cleared.")
+
+
+@app.cli.group("jobs")
+def jobs_command():
+    """Run and inspect the background job queue."""
+
+
+@jobs_command.command("refresh")
+@click.option("--days", type=int, default=REFRESH_DAYS,
+              help="Refresh books not refreshed in this many days.")
+def jobs_refresh_command(days):
+    """Queues catalog refresh jobs for books now, without a worker."""
+    click.echo(f"Queued {schedule_book_refresh(days)} refresh jobs.")
+
+
+@jobs_command.command("retry")
+@click.argument("job_id", type=int)
+def jobs_retry_command(job_id):
+    """Queues dead lettered job JOB_ID to run again."""
+    if not jobs.retry(job_id):
+        raise click.ClickException(f"No dead lettered job {job_id}")
+    click.echo(f"Queued job {job_id}.")
+
+
+@jobs_command.command("status")
+def jobs_status_command():
+    """Shows the number of jobs of each kind and status, and dead letters."""
+    for row in jobs.counts():
+        click.echo(f"{row['kind']:<16}{row['status']:<10}{row['jobs']}")
+    for job in jobs.dead():
+        click.echo(f"dead {job['id']} {job['key']} after {job['attempts']} "
+                   f"attempts: {job['error']}")
+
+
+@jobs_command.command("work")
+@click.option("--once", is_flag=True, help="Stop when no jobs are due.")
+@click.option("--batch", type=int, default=BATCH_SIZE,
+              help="Jobs handled together, one Open Library request.")
+@click.option("--interval", type=float, default=INTERVAL,
+              help="Min seconds between batches, to rate limit the API.")
+def jobs_work_command(once, batch, interval):
+    """
+    Runs queued jobs, refreshing the catalog from Open Library every
+    REFRESH_DAYS, looking up placeholder books, fetching covers and rolling
+    goals over daily. Run as its own process alongside the web app.
+    """
+    work(jobs, {"refresh_book": refresh_books,
+                "lookup_book": lookup_placeholder_books,
+                "goal_rollover": rollover_goals,
+                "fetch_cover": fetch_covers},
+         [schedule_book_refresh, schedule_placeholder_lookups,
+          schedule_goal_rollover,
+          lambda: jobs.prune(JOB_RETENTION_DAYS * 24 * 60 * 60),
+          login_limiter.prune],
+         batch, interval, once)
+
+
+@app.cli.group("search")
+def search_command():
+    """Maintain the library_search full text index."""
+
+
+@search_command.command("rebuild")
+def search_rebuild_command():
+    """Recreates library_search from the current and history tables."""
+    rebuild_library_search()
+    click.echo("Rebuilt library_search.")
+
+
+@app.cli.group("sessions")
+def sessions_command():
+    """Maintain the sessions table."""
+
+
+@sessions_command.command("sweep")
+def sessions_sweep_command():
+    """Deletes expired sessions, also done hourly by the web app."""
+    if app.config["SESSION_BACKEND"] != "sqlite":
+        raise click.ClickException("Sessions are kept in cookies.")
+    click.echo(f"Deleted {app.session_interface.sweep()} expired sessions.")
+
+
+@app.cli.group("stats")
+def stats_command():
+    """Maintain the user_stats summary table."""
+
+
+@stats_command.command("rebuild")
+def stats_rebuild_command():
+    """Recomputes user_stats from the current and history tables."""
+    rebuild_user_stats()
+    click.echo("Rebuilt user_stats.")
+
+
+@stats_command.command("verify")
+def stats_verify_command():
+    """
+    Reports users whose user_stats have drifted from the current and history
+    tables, exiting with status 1 if there are any.
+    """
+    drift = verify_user_stats()
+    for row in drift:
+        click.echo(row)
+    click.echo(f"{len(drift)} users with drifted stats.")
+    if drift:
+        raise SystemExit(1)
@@ -0,0 +1,263 @@
+""" Static asset pipeline for Bootra
+
+Bundles the vendored Bootstrap (with Popper) and jQuery files in
+static/vendor with the app's own styles and scripts into one CSS and one JS
+file. Each bundle is minified and named by a hash of its contents, such as
+static/dist/app.3f9a0c1d2e4b.css. It is also compressed with gzip, and with
+brotli when the brotli package is installed, so nothing is compressed per
+request. static/dist/manifest.json maps bundle names to their files, and
+templates link them with asset_url.
+
+A bundle's name changes whenever its contents do, so /assets serves them to
+be cached by browsers for a year without revalidating. Old bundles are kept,
+as cached pages may still link them.
+
+Bundles are built by 'flask assets build', or when the app starts and finds
+them missing or older than their sources. In debug mode they are also
+rebuilt as soon as a source changes.
+
+Every template is also compiled when the app starts, so no request pays for
+compiling one.
+
+SECTIONS:
+    - Config
+    - Build
+    - Minify
+    - Serve
+    - Templates
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Bundle name to its sources in static, in order. Sources already minified
+# end in .min.css or .min.js
+BUNDLES = {
+    "app.css": ["vendor/bootstrap.min.css", "styles.css"],
+    "app.js": ["vendor/jquery.min.js", "vendor/bootstrap.bundle.min.js",
+               "scroll.js"]
+}
+
+# Hex digits of the content hash in bundle file names
+HASH_LENGTH = 12
+
+# Bundle file names, which are the only files /assets serves
+BUNDLE_FILE = re.compile(r"^[\w-]+\.[0-9a-f]{%d}\.(css|js)$" % HASH_LENGTH)
+
+# Content encoding to file extension of the precompressed copies, preferred
+# first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Seconds browsers cache bundles for
+MAX_AGE = 365 * 24 * 60 * 60
+
+# Comments and whitespace removed by the minifiers. /*! comments are kept,
+# they hold licenses
+CSS_COMMENT = re.compile(r"/\*(?!!).*?\*/", re.DOTALL)
+CSS_SPACE = re.compile(r"\s*([{}:;,>])\s*")
+SOURCE_MAP = re.compile(r"^\s*(//|/\*)# sourceMappingURL=.*$", re.MULTILINE)
+
+
+##################################### BUILD ###################################
+
+def build(static=STATIC):
+    """
+    Builds every bundle and its compressed copies into static/dist, skipping
+    files that already exist as their names are their contents, then writes
+    the manifest.
+
+    Args:
+        static (str): static directory
+
+    Returns:
+        dict of bundle name to file name in static/dist
+    """
+    dist = os.path.join(static, "dist")
+    os.makedirs(dist, exist_ok=True)
+
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        data = bundle(static, name, sources)
+        stem, extension = os.path.splitext(name)
+        digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        manifest[name] = f"{stem}.{digest}{extension}"
+
+        path = os.path.join(dist, manifest[name])
+        if not os.path.exists(path):
+            _write(path, data)
+            _write(path + ".gz", gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                _write(path + ".br", brotli.compress(data))
+
+    _write(os.path.join(dist, "manifest.json"),
+           json.dumps(manifest, indent=4).encode())
+    return manifest
+
+
+def bundle(static, name, sources):
+    """
+    Returns the contents of a bundle, its sources minified and joined.
+
+    Args:
+        static (str): static directory
+        name (str): bundle name, ending in .css or .js
+        sources (list of str): paths in static
+
+    Returns:
+        bytes
+    """
+    minify = minify_css if name.endswith(".css") else minify_js
+    parts = []
+    for source in sources:
+        with open(os.path.join(static, source), encoding="utf-8") as f:
+            text = SOURCE_MAP.sub("", f.read())
+        parts.append(text if ".min." in source else minify(text))
+    return "\n".join(part.strip() for part in parts).encode() + b"\n"
+
+
+def _write(path, data):
+    """Writes a file in one step, so other processes never see it partial."""
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+#################################### MINIFY ###################################
+
+def minify_css(text):
+    """Removes comments and unneeded whitespace from CSS."""
+    text = CSS_COMMENT.sub("", text)
+    text = CSS_SPACE.sub(r"\1", " ".join(text.split()))
+    return text.replace(";}", "}")
+
+
+def minify_js(text):
+    """
+    Removes whole line comments, indentation and blank lines from JavaScript.
+    Nothing within lines is touched, which keeps it safe without parsing.
+    """
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines
+                     if line and not line.startswith("//"))
+
+
+##################################### SERVE ###################################
+
+class Assets:
+    """
+    Serves the bundles at /assets and links them from templates.
+
+    Attributes:
+        manifest (dict): bundle name to file name in static/dist
+    """
+
+    def __init__(self, app, static=STATIC):
+        """
+        Loads the manifest, building the bundles first if they are missing
+        or out of date, and adds the /assets route and the asset_url
+        template global.
+
+        Args:
+            app (Flask)
+            static (str): static directory
+        """
+        self.app = app
+        self.static = static
+        self.dist = os.path.join(static, "dist")
+        self.manifest = self._load()
+
+        app.add_url_rule("/assets/<name>", "asset", self.serve)
+        app.add_template_global(self.url, "asset_url")
+
+    def url(self, name):
+        """
+        Returns the URL of a bundle for templates, rebuilding the bundles
+        first in debug mode if a source has changed.
+
+        Args:
+            name (str): one of BUNDLES
+
+        Returns:
+            str URL
+        """
+        if self.app.debug:
+            self.manifest = self._load()
+        return f"/assets/{self.manifest[name]}"
+
+    def serve(self, name):
+        """
+        GET /assets/<name>, a bundle, precompressed in the best encoding the
+        browser accepts. Cached for a year without revalidating.
+        """
+        path = safe_join(self.dist, name)
+        if not BUNDLE_FILE.match(name) or path is None \
+                or not os.path.exists(path):
+            abort(404)
+
+        encoding = None
+        for accepted, extension in ENCODINGS:
+            if accepted in request.accept_encodings \
+                    and os.path.exists(path + extension):
+                encoding = accepted
+                path += extension
+                break
+
+        response = send_file(path, mimetype=mimetypes.guess_type(name)[0],
+                             max_age=MAX_AGE, conditional=True)
+        if encoding is not None:
+            response.content_encoding = encoding
+        response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def _load(self):
+        """
+        Returns the manifest, building the bundles first if any source has
+        changed since it was written.
+        """
+        path = os.path.join(self.dist, "manifest.json")
+        changed = max(os.path.getmtime(os.path.join(self.static, source))
+                      for sources in BUNDLES.values() for source in sources)
+        if not os.path.exists(path) or os.path.getmtime(path) < changed:
+            return build(self.static)
+        with open(path) as f:
+            return json.load(f)
+
+
+################################### TEMPLATES #################################
+
+def compile_templates(app):
+    """
+    Compiles every template into the app's Jinja cache, so requests never
+    wait for one to compile.
+
+    Args:
+        app (Flask)
+
+    Returns:
+        int number of templates compiled
+    """
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
@@ -0,0 +1,248 @@
+""" Password hashing and login rate limiting for Bootra
+
+Password hashes are deliberately slow, so a burst of login attempts could
+keep every server worker busy hashing. Hashing here runs in a small pool of
+separate processes with a bounded number of hashes waiting, so page requests
+are never stuck behind it. Attempts beyond the bound are refused straight
+away with HashBusy instead of queueing.
+
+The hash method and cost are set by HASH_METHOD. Hashes made with an older
+method are upgraded the next time their user logs in.
+
+Login attempts are limited per username and per IP address by token
+buckets stored in the database, so every server process shares the limits.
+
+SECTIONS:
+    - Config
+    - Password Hashing
+    - Rate Limiter
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug hash method with its cost parameters, e.g. "scrypt:32768:8:1"
+# (N, r, p) or "pbkdf2:sha256:600000" (iterations)
+HASH_METHOD = os.environ.get("BOOTRA_HASH_METHOD", "scrypt:32768:8:1")
+
+# Start of hashes made with HASH_METHOD, which werkzeug writes with its
+# defaults filled in, e.g. "scrypt:32768:8:1" for "scrypt"
+HASH_PREFIX = generate_password_hash("", HASH_METHOD).split("$", 1)[0]
+
+# Processes hashing passwords, 0 hashes on the request's thread, and max
+# hashes waiting for a process before new ones are refused
+HASH_WORKERS = int(os.environ.get("BOOTRA_HASH_WORKERS", 2))
+HASH_QUEUE = 8
+
+# Seconds to wait for a hash before giving up
+HASH_TIMEOUT = 10
+
+# Login attempts allowed in a burst, and attempts regained per second, for
+# each username and each IP address
+USER_BURST = 5
+USER_RATE = 1 / 60
+IP_BURST = 20
+IP_RATE = 1 / 3
+
+
+class HashBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+############################### PASSWORD HASHING ##############################
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(HASH_WORKERS, 1) + HASH_QUEUE)
+
+
+def hash_password(password, method=HASH_METHOD):
+    """
+    Hashes a password for storing.
+
+    Args:
+        password (str)
+        method (str): werkzeug hash method and cost
+
+    Returns:
+        str hash
+
+    Raises:
+        HashBusy: too many hashes are waiting
+    """
+    return _run(generate_password_hash, password, method)
+
+
+def needs_rehash(password_hash):
+    """Returns whether a stored hash was made with another method or cost."""
+    return password_hash.split("$", 1)[0] != HASH_PREFIX
+
+
+def shutdown():
+    """Stops the hashing processes, if they were started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+def verify_password(password_hash, password):
+    """
+    Checks a password against a stored hash.
+
+    Args:
+        password_hash (str)
+        password (str)
+
+    Returns:
+        bool whether the password matches
+
+    Raises:
+        HashBusy: too many hashes are waiting
+    """
+    return _run(check_password_hash, password_hash, password)
+
+
+def _run(function, *args):
+    """
+    Runs a hash function in the pool, at most HASH_QUEUE waiting. A pool
+    broken by a dead process is dropped, so the next hash starts a new one.
+    """
+    if not _slots.acquire(blocking=False):
+        raise HashBusy()
+    try:
+        if not HASH_WORKERS:
+            return function(*args)
+        pool = _executor()
+        try:
+            return pool.submit(function, *args).result(HASH_TIMEOUT)
+        except BrokenProcessPool:
+            _discard(pool)
+            raise HashBusy()
+    except TimeoutError:
+        raise HashBusy()
+    finally:
+        _slots.release()
+
+
+def _discard(pool):
+    """Drops a broken pool, unless another thread has already replaced it."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _executor():
+    """
+    Returns the hashing process pool, started on first use. A pool is never
+    shared with a forked child, which starts its own.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Forking a process with running threads isn't safe
+            _pool = ProcessPoolExecutor(
+                HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_watch_parent, initargs=(os.getpid(),))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _watch_parent(pid):
+    """
+    Starts a thread in a hashing process that exits it if the server process
+    that started it is killed without shutting down the pool.
+    """
+    def watch():
+        while os.getppid() == pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+################################## RATE LIMITER ###############################
+
+class RateLimiter:
+    """
+    Token buckets stored in the rate_limits table.
+
+    Each key, such as a username or IP address, has a bucket holding up to
+    burst tokens which refills at rate tokens per second. An attempt takes
+    one token from each of its keys' buckets and is refused if any is empty.
+    """
+
+    def __init__(self, db, limits):
+        """
+        Args:
+            db: database with execute(sql, *args) and transaction() methods
+            limits (dict): key prefix to (burst, rate), keys are given as
+                prefix:name
+        """
+        self.db = db
+        self.limits = limits
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS rate_limits " \
+                        "(key TEXT PRIMARY KEY NOT NULL, " \
+                        "tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def allow(self, *keys):
+        """
+        Takes a token for an attempt from the bucket of every key, unless
+        one of them is empty.
+
+        Args:
+            *keys (str): prefix:name keys, the prefix one of limits
+
+        Returns:
+            bool whether the attempt is allowed
+        """
+        now = time.time()
+        with self.db.transaction():
+            buckets = {}
+            for key in keys:
+                burst, rate = self.limits[key.split(":", 1)[0]]
+                rows = self.db.execute("SELECT tokens, updated " \
+                                       "FROM rate_limits WHERE key = ?", key)
+                tokens = burst if not rows else \
+                    min(burst, rows[0]["tokens"]
+                        + (now - rows[0]["updated"]) * rate)
+                if tokens < 1:
+                    return False
+                buckets[key] = tokens
+
+            for key, tokens in buckets.items():
+                self.db.execute("INSERT OR REPLACE INTO rate_limits " \
+                                "(key, tokens, updated) VALUES (?, ?, ?)",
+                                key, tokens - 1, now)
+        return True
+
+    def prune(self):
+        """
+        Deletes buckets that have refilled, as they are the same as no bucket.
+
+        Returns:
+            int number of buckets deleted
+        """
+        now = time.time()
+        deleted = 0
+        for prefix, (burst, rate) in self.limits.items():
+            deleted += self.db.execute("DELETE FROM rate_limits " \
+                                       "WHERE key LIKE ? " \
+                                       "AND tokens + (? - updated) * ? >= ?",
+                                       f"{prefix}:%", now, rate, burst)
+        return deleted
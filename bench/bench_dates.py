@@ -0,0 +1,111 @@
+""" Benchmark of date handling when rendering history rows
+
+Renders history_rows.html for a user with 100k history rows two ways:
+    before - dates read as strings, reformatted one by one with the old
+             str_to_datetime and strftime round trip, then rendered
+    after  - dates read as datetime dates by the database layer and
+             formatted in the template by the cached nice_date filter
+
+Usage:
+    python bench/bench_dates.py [--rows 100000] [--repeat 3]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+from datetime import date
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# history_rows.html as it was before the nice_date filter
+OLD_ROWS = """{% for book in books %}
+    <tr>
+        <td class="left-align"><strong>{{ book["title"] }}</strong></td>
+        <td>{{ book["author"] }}</td>
+        <td>{{ book["start_date"] }}</td>
+        <td>{{ book["end_date"] }}</td>
+        <td>{{ book["days"] }}</td>
+        <td>{{ book["pages"] }}</td>
+        <td>{{ book["rate"]|round|int }}</td>
+    </tr>
+{% endfor %}
+"""
+
+QUERY = "SELECT * FROM books JOIN history ON id = book_id " \
+        "WHERE user_id = ? ORDER BY end_date DESC"
+
+
+def old_reformat_date(dictionary, key):
+    """reformat_date as it was before dates.py."""
+    if dictionary[key]:
+        list_date = dictionary[key].split("-")
+        dictionary[key] = date(int(list_date[0]), int(list_date[1]),
+                               int(list_date[2])).strftime("%a %e %b %Y")
+
+
+def timed(call, repeat):
+    """Returns the median seconds of repeat calls."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    scratch = os.path.join(tempfile.mkdtemp(), "bench.db")
+    shutil.copy(os.path.join(ROOT, "library.db"), scratch)
+    os.environ["BOOTRA_DATABASE"] = scratch
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT)
+
+    import helpers
+    from application import app
+    from bench_history import seed_books, seed_user
+    from database import dict_factory
+
+    seed_books(helpers.db, 1000)
+    user_id = seed_user(helpers.db, "dates", args.rows)
+
+    # Plain connection without the DATE converter, as the old layer read rows
+    plain = sqlite3.connect(scratch)
+    plain.row_factory = dict_factory
+
+    with app.app_context():
+        old_template = app.jinja_env.from_string(OLD_ROWS)
+        new_template = app.jinja_env.get_template("history_rows.html")
+
+        def before():
+            books = plain.execute(QUERY, (user_id,)).fetchall()
+            for book in books:
+                old_reformat_date(book, "start_date")
+                old_reformat_date(book, "end_date")
+            return old_template.render(books=books)
+
+        def after():
+            books = helpers.db.execute(QUERY, user_id)
+            return new_template.render(books=books)
+
+        assert before() == after()
+        print(f"{'path':>8}{'rows':>10}{'ms':>10}")
+        for name, call in [("before", before), ("after", after)]:
+            seconds = timed(call, args.repeat)
+            print(f"{name:>8}{args.rows:10}{seconds * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
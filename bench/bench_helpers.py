@@ -0,0 +1,135 @@
+""" Micro-benchmark of the helpers.py SQL helpers
+
+Times every SQL helper against the old cs50.SQL data access path and the
+sqlite3 Database path on a scratch copy of library.db seeded with one user,
+their current books and reading history.
+
+Needs the cs50 package for the old path. The helpers now group their
+statements with db.transaction(), which cs50.SQL doesn't have, so the old
+path gets a no-op one and each statement commits on its own as it did.
+
+Usage:
+    python bench/bench_helpers.py [--number 2000] [--history 200]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import contextlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def seed(db, current, history):
+    """
+    Adds a benchmark user with current and history books.
+
+    Args:
+        db (Database): scratch database
+        current (int): number of current rows
+        history (int): number of history rows
+
+    Returns:
+        dict with the user id, one of their current book ids and its isbn
+    """
+    user_id = db.execute("INSERT INTO users (username, hash) VALUES (?, ?)",
+                         "bench", "x")
+    random.seed(0)
+    today = date.today()
+    book_ids = []
+    with db.transaction():
+        for n in range(current + history):
+            book_ids.append(db.execute(
+                "INSERT INTO books (title, author, pages, isbn) " \
+                "VALUES (?, ?, ?, ?)",
+                f"Bench {n}", "Author", random.randint(100, 900),
+                f"B{n:012d}"))
+
+        for book_id in book_ids[:current]:
+            db.execute("INSERT INTO current " \
+                       "(user_id, book_id, start_date, page) " \
+                       "VALUES (?, ?, ?, ?)",
+                       user_id, book_id,
+                       today - timedelta(days=random.randint(1, 60)), 50)
+
+        for book_id in book_ids[current:]:
+            start = today - timedelta(days=random.randint(30, 3000))
+            days = random.randint(3, 30)
+            db.execute("INSERT INTO history " \
+                       "(user_id, book_id, start_date, end_date, days, rate) " \
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       user_id, book_id, start, start + timedelta(days=days),
+                       days, 20)
+
+    return {"user_id": user_id, "book_id": book_ids[0], "isbn": "B000000000000",
+            "spare": book_ids[-1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000,
+                        help="calls per helper per path")
+    parser.add_argument("--current", type=int, default=20)
+    parser.add_argument("--history", type=int, default=200)
+    args = parser.parse_args()
+
+    scratch = os.path.join(tempfile.mkdtemp(), "bench.db")
+    shutil.copy(os.path.join(ROOT, "library.db"), scratch)
+    os.environ["BOOTRA_DATABASE"] = scratch
+    sys.path.insert(0, ROOT)
+
+    from cs50 import SQL
+    import helpers
+    from application import app
+    from flask import session
+
+    new = helpers.db
+    class OldSQL(SQL):
+        """cs50.SQL with a transaction() that does nothing."""
+
+        @contextlib.contextmanager
+        def transaction(self):
+            yield
+
+    old = OldSQL(f"sqlite:///{scratch}")
+    ids = seed(new, args.current, args.history)
+
+    cases = [
+        ("select_from_books", lambda: helpers.select_from_books(ids["isbn"])),
+        ("select_from_current(book_id)",
+         lambda: helpers.select_from_current(ids["book_id"])),
+        ("select_from_current(isbn)",
+         lambda: helpers.select_from_current(isbn=ids["isbn"])),
+        ("select_from_current()", lambda: helpers.select_from_current()),
+        ("select_from_users", lambda: helpers.select_from_users("bench")),
+        ("update_current",
+         lambda: helpers.update_current(ids["book_id"], "page", 60)),
+        ("insert/delete_from_current",
+         lambda: (helpers.insert_into_current(ids["spare"]),
+                  helpers.delete_from_current(ids["spare"]))),
+    ]
+
+    print(f"{'helper':32}{'cs50 us':>12}{'sqlite3 us':>12}{'speedup':>10}")
+    with app.test_request_context():
+        session["user_id"] = ids["user_id"]
+        for name, call in cases:
+            times = []
+            for db in (old, new):
+                helpers.db = db
+                call()
+                best = min(timeit.repeat(call, number=args.number, repeat=3))
+                times.append(best / args.number * 1e6)
+            print(f"{name:32}{times[0]:12.1f}{times[1]:12.1f}"
+                  f"{times[0] / times[1]:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
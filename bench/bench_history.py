@@ -0,0 +1,152 @@
+""" Regression benchmark for the /history page queries
+
+Compares the old /history GET path (select_from_history, user_pages,
+user_books and user_rate, kept here as old_history) with
+select_history_with_stats for users with 10, 1k and 100k history rows,
+reporting queries per request and latency.
+
+Usage:
+    python bench/bench_history.py [--sizes 10 1000 100000] [--repeat 5]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def old_history(db, user_id):
+    """
+    The /history GET queries as they were before select_history_with_stats:
+    every history row, then the user's total pages, books and daily rate
+    each counted separately.
+    """
+    books = db.execute("SELECT * FROM books JOIN history ON id = book_id " \
+                       "WHERE user_id = ? ORDER BY end_date DESC", user_id)
+    pages = db.execute("SELECT COALESCE(SUM(pages), 0) AS pages " \
+                       "FROM books JOIN history ON id = book_id " \
+                       "WHERE user_id = ?", user_id)[0]["pages"]
+    pages += db.execute("SELECT COALESCE(SUM(page), 0) AS pages " \
+                        "FROM books JOIN current ON id = book_id " \
+                        "WHERE user_id = ?", user_id)[0]["pages"]
+    count = db.execute("SELECT COUNT(*) FROM history WHERE user_id = ?",
+                       user_id)[0]["COUNT(*)"]
+
+    first = db.execute("SELECT * FROM books JOIN history ON id = book_id " \
+                       "WHERE user_id = ? ORDER BY start_date ASC", user_id)
+    rate = 0
+    if first:
+        days = (date.today() - first[0]["start_date"]).days + 1
+        rate = round(pages / days)
+    return books, count, pages, rate
+
+
+def seed_user(db, name, history, current=10, books=1000):
+    """
+    Adds a user with the given number of history and current rows.
+
+    Args:
+        db (Database): scratch database
+        name (str): username
+        history (int): number of history rows
+        current (int): number of current rows
+        books (int): number of distinct books to spread the rows over
+
+    Returns:
+        int id of the new user
+    """
+    user_id = db.execute("INSERT INTO users (username, hash) VALUES (?, ?)",
+                         name, "x")
+    book_ids = [row["id"] for row in db.execute("SELECT id FROM books")]
+    random.seed(history)
+    today = date.today()
+    rows = []
+    for _ in range(history):
+        start = today - timedelta(days=random.randint(30, 10000))
+        days = random.randint(3, 30)
+        rows.append((user_id, random.choice(book_ids), start,
+                     start + timedelta(days=days), days, 20))
+
+    with db.transaction():
+        db.connection.executemany("INSERT INTO history " \
+                                  "(user_id, book_id, start_date, end_date, " \
+                                  "days, rate) VALUES (?, ?, ?, ?, ?, ?)",
+                                  rows)
+        db.connection.executemany("INSERT INTO current " \
+                                  "(user_id, book_id, start_date, page) " \
+                                  "VALUES (?, ?, ?, 10)",
+                                  [(user_id, book_id, today)
+                                   for book_id in book_ids[:current]])
+    return user_id
+
+
+def seed_books(db, books):
+    """Adds a catalog of books to pick history rows from."""
+    with db.transaction():
+        db.connection.executemany("INSERT INTO books " \
+                                  "(title, author, pages, isbn) " \
+                                  "VALUES (?, 'Author', ?, ?)",
+                                  [(f"Bench {n}", 100 + n % 800, f"H{n:012d}")
+                                   for n in range(books)])
+
+
+def measure(db, call, repeat):
+    """
+    Runs call repeat times.
+
+    Returns:
+        (queries per call, median seconds per call)
+    """
+    queries = []
+    db.connection.set_trace_callback(queries.append)
+    times = []
+    for _ in range(repeat):
+        queries.clear()
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    db.connection.set_trace_callback(None)
+    return len(queries), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    scratch = os.path.join(tempfile.mkdtemp(), "bench.db")
+    shutil.copy(os.path.join(ROOT, "library.db"), scratch)
+    os.environ["BOOTRA_DATABASE"] = scratch
+    sys.path.insert(0, ROOT)
+
+    import helpers
+    from application import app
+    from flask import session
+
+    seed_books(helpers.db, 1000)
+    print(f"{'history rows':>12}{'path':>10}{'queries':>9}{'ms':>10}")
+    for size in args.sizes:
+        with app.test_request_context():
+            session["user_id"] = seed_user(helpers.db, f"bench{size}", size)
+            helpers.rebuild_user_stats(session["user_id"])
+            for name, call in [("old", lambda: old_history(
+                                    helpers.db, session["user_id"])),
+                               ("new", helpers.select_history_with_stats)]:
+                queries, seconds = measure(helpers.db, call, args.repeat)
+                print(f"{size:12}{name:>10}{queries:9}{seconds * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+""" Benchmark of ISBN validation for imports
+
+Checks a made up import file of ISBNs, shaped like a Goodreads export or a
+pasted list: mostly ISBN-13s, some ISBN-10s, some hyphenated or labelled and
+a few typos. Times three ways of checking every line:
+    before - valid_isbn as it was, one digit at a time, ISBN-13s only
+    single - isbn.to_isbn13 on each line
+    bulk   - isbn.to_isbn13_many on the whole file
+
+Usage:
+    python bench/bench_isbn.py [--lines 1000000] [--repeat 3] [--seed 15]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def old_valid_isbn(isbn):
+    """valid_isbn as it was before isbn.py."""
+    try:
+        check_sum = 0
+        for i, digit in enumerate(isbn):
+            if i % 2 == 0:
+                check_sum += int(digit)
+            else:
+                check_sum += int(digit) * 3
+
+        if check_sum % 10 == 0 and len(isbn) == 13:
+            return True
+        else:
+            return False
+    except (TypeError, ValueError):
+        return False
+
+
+def make_lines(lines, rng):
+    """
+    Returns made up ISBNs as typed: 70% plain ISBN-13s, 15% ISBN-10s, 10%
+    hyphenated or labelled and 5% with a digit mistyped.
+    """
+    from isbn import to_isbn10
+
+    result = []
+    for _ in range(lines):
+        body = "978" + "".join(rng.choices("0123456789", k=9))
+        total = sum(int(digit) * (3 if i % 2 else 1)
+                    for i, digit in enumerate(body))
+        isbn = body + str(-total % 10)
+        kind = rng.random()
+        if kind < 0.70:
+            result.append(isbn)
+        elif kind < 0.85:
+            result.append(to_isbn10(isbn))
+        elif kind < 0.95:
+            result.append(rng.choice(["ISBN ", "ISBN-13: ", ""]) +
+                          f"{isbn[:3]}-{isbn[3]}-{isbn[4:7]}-{isbn[7:12]}-"
+                          f"{isbn[12]}")
+        else:
+            i = rng.randrange(13)
+            result.append(isbn[:i] + str((int(isbn[i]) + 1) % 10) +
+                          isbn[i + 1:])
+    return result
+
+
+def timed(call, repeat):
+    """Returns the median seconds of repeat calls."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=15)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from isbn import to_isbn13, to_isbn13_many
+
+    lines = make_lines(args.lines, random.Random(args.seed))
+    assert [to_isbn13(line) for line in lines] == to_isbn13_many(lines)
+
+    runs = [
+        ("before", lambda: [old_valid_isbn(line) for line in lines],
+         lambda result: sum(result)),
+        ("single", lambda: [to_isbn13(line) for line in lines],
+         lambda result: sum(isbn is not None for isbn in result)),
+        ("bulk", lambda: to_isbn13_many(lines),
+         lambda result: sum(isbn is not None for isbn in result))
+    ]
+    print(f"{'path':>8}{'lines':>10}{'valid':>10}{'ms':>10}{'lines/s':>12}")
+    for name, call, valid in runs:
+        seconds = timed(call, args.repeat)
+        print(f"{name:>8}{args.lines:10}{valid(call()):10}"
+              f"{seconds * 1000:10.1f}{args.lines / seconds:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+""" Load benchmark of the Bootra web routes
+
+Generates a synthetic database with bench/synthetic.py, or copies one given
+with --database, points the app at a local stub Open Library and drives
+GET /, GET /history, GET /book, POST /add, POST /update and POST /login
+with requests spread over the synthetic users.
+
+Two modes:
+    client: requests run one at a time through the Flask test client in
+        this process, queries per request are counted
+    server: the app is served by --workers forked processes, like a
+        preloaded gunicorn, and hit over HTTP by --concurrency clients each
+        logged in as a different user
+
+Prints JSON with the config and, for each mode and route, the number of
+requests and errors (status 400 or over), p50, p95 and p99 latency in ms,
+requests per second and queries per request (null in server mode), for
+tracking regressions between commits.
+
+Usage:
+    python bench/bench_routes.py [--mode client server] [--requests 100]
+                                 [--users 50] [--books 20000]
+                                 [--history 100] [--current 5]
+                                 [--workers 4] [--concurrency 8]
+                                 [--database DB] [--output FILE]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# /login last, as logging in replaces the session of the client sending it
+ROUTES = ["/", "/history", "/book", "/add", "/update", "/login"]
+
+
+def isbn13(n):
+    """Returns a valid ISBN-13 made from n, in the unassigned 979-0 range."""
+    digits = f"9790{n:08d}"
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str(-total % 10)
+
+
+def load_users(path):
+    """
+    Reads the synthetic users and their current books from the database.
+
+    Returns:
+        list of (user id, username, list of (book id, pages)) for users
+        with at least one current book
+    """
+    connection = sqlite3.connect(path)
+    books = {}
+    for user_id, book_id, pages in connection.execute(
+            "SELECT user_id, book_id, pages FROM current " \
+            "JOIN books ON books.id = book_id WHERE pages > 1"):
+        books.setdefault(user_id, []).append((book_id, pages))
+    users = [(user_id, username, books[user_id]) for user_id, username
+             in connection.execute("SELECT id, username FROM users " \
+                                   "WHERE username LIKE 'user%' ORDER BY id")
+             if user_id in books]
+    connection.close()
+    return users
+
+
+def make_request(route, user, isbns, rng):
+    """
+    Picks the method, path and form data of one request to a route.
+
+    Args:
+        route (str): one of ROUTES
+        user (tuple): (user id, username, current books)
+        isbns (iterator): unused ISBNs for /add
+        rng (random.Random)
+
+    Returns:
+        (method, path, form data or None)
+    """
+    book_id, pages = rng.choice(user[2])
+    if route == "/book":
+        return "GET", f"/book?book_id={book_id}", None
+    if route == "/add":
+        return "POST", "/add", {"isbn": next(isbns)}
+    if route == "/update":
+        return "POST", "/update", {"book_id": book_id,
+                                   "page": rng.randint(1, pages - 1)}
+    if route == "/login":
+        from synthetic import PASSWORD
+        return "POST", "/login", {"username": user[1], "password": PASSWORD}
+    return "GET", route, None
+
+
+def summarise(times, errors, elapsed, queries=None):
+    """
+    Summarises the requests to one route.
+
+    Args:
+        times (list of float): seconds taken by each request
+        errors (int): requests answered with status 400 or over
+        elapsed (float): wall clock seconds taken by all the requests
+        queries (list of int): SQL statements run by each request
+
+    Returns:
+        dict of requests, errors, p50_ms, p95_ms, p99_ms, rps and
+        queries_per_request
+    """
+    cuts = statistics.quantiles(times, n=100, method="inclusive")
+    return {"requests": len(times), "errors": errors,
+            "p50_ms": round(cuts[49] * 1000, 3),
+            "p95_ms": round(cuts[94] * 1000, 3),
+            "p99_ms": round(cuts[98] * 1000, 3),
+            "rps": round(len(times) / elapsed, 1),
+            "queries_per_request": round(statistics.mean(queries), 2)
+                                   if queries else None}
+
+
+################################## CLIENT MODE ################################
+
+def run_client(users, count, isbns, rng):
+    """
+    Times requests through the Flask test client, counting the queries each
+    request runs on this thread's connection.
+
+    Returns:
+        dict of route to summary
+    """
+    import helpers
+    from application import app
+
+    client = app.test_client()
+    statements = []
+    results = {}
+    for route in ROUTES:
+        times, queries, errors = [], [], 0
+        elapsed = 0.0
+        for _ in range(count):
+            user = rng.choice(users)
+            method, path, data = make_request(route, user, isbns, rng)
+            if route != "/login":
+                with client.session_transaction() as session:
+                    session["user_id"] = user[0]
+
+            helpers.db.connection.set_trace_callback(statements.append)
+            statements.clear()
+            begin = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            times.append(time.perf_counter() - begin)
+            helpers.db.connection.set_trace_callback(None)
+
+            elapsed += times[-1]
+            queries.append(len(statements))
+            errors += response.status_code >= 400
+        results[route] = summarise(times, errors, elapsed, queries)
+    return results
+
+
+################################## SERVER MODE ################################
+
+def serve_worker(listener):
+    """
+    Serves the app from a forked process on the shared listening socket.
+
+    Threads don't survive a fork, so the process gets its own lookup worker
+    and database connections.
+    """
+    import application
+    import auth
+    import helpers
+    from werkzeug.serving import make_server
+    from worker import LookupWorker
+
+    # Exit cleanly on terminate, shutting down the password hashing pool
+    def stop(*args):
+        auth.shutdown()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    # Keep the request log from drowning out the report
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    helpers.db._local = threading.local()
+    application.lookup_worker = LookupWorker(
+        application.fetch_book_async, helpers.fill_placeholder_book,
+        helpers.retry_placeholder_book)
+
+    port = listener.getsockname()[1]
+    server = make_server("127.0.0.1", port, application.app, threaded=True,
+                         fd=listener.fileno())
+    server.serve_forever()
+
+
+def run_server(users, count, isbns, rng, workers, concurrency):
+    """
+    Times requests over HTTP to the app served by forked worker processes.
+
+    Returns:
+        dict of route to summary
+    """
+    # Import the app before forking, so the workers start from it loaded
+    import application
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    url = f"http://127.0.0.1:{listener.getsockname()[1]}"
+
+    context = multiprocessing.get_context("fork")
+    # Not daemons, so they can start password hashing processes
+    processes = [context.Process(target=serve_worker, args=(listener,))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    # One logged in session per client thread, each a different user
+    from synthetic import PASSWORD
+    clients = []
+    for user in itertools.islice(itertools.cycle(users), concurrency):
+        client = requests.Session()
+        client.post(f"{url}/login", allow_redirects=False,
+                    data={"username": user[1], "password": PASSWORD})
+        clients.append((client, user))
+
+    def send(client, batch):
+        answers = []
+        for method, path, data in batch:
+            begin = time.perf_counter()
+            response = client.request(method, url + path, data=data,
+                                      allow_redirects=False)
+            answers.append((time.perf_counter() - begin,
+                            response.status_code))
+        return answers
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            for route in ROUTES:
+                # Each client sends its share of requests as its own user
+                batches = [[make_request(route, user, isbns, rng)
+                            for _ in range(n, count, concurrency)]
+                           for n, (_, user) in enumerate(clients)]
+                begin = time.perf_counter()
+                answers = list(itertools.chain.from_iterable(
+                    executor.map(send, [client for client, _ in clients],
+                                 batches)))
+                elapsed = time.perf_counter() - begin
+                results[route] = summarise(
+                    [seconds for seconds, _ in answers],
+                    sum(status >= 400 for _, status in answers), elapsed)
+    finally:
+        # Workers wait for their open keep-alive connections when stopping
+        for client, _ in clients:
+            client.close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+        listener.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", nargs="+", choices=["client", "server"],
+                        default=["client", "server"])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--history", type=float, default=100)
+    parser.add_argument("--current", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--database")
+    parser.add_argument("--output")
+    parser.add_argument("--seed", type=int, default=15)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT)
+    import stub_openlibrary
+    import synthetic
+
+    # Before anything imports openlibrary, which reads the URLs on import
+    scratch = os.path.join(tempfile.mkdtemp(), "bench.db")
+    stub = stub_openlibrary.serve(missing=0.1)
+    os.environ["OPENLIBRARY_URL"] = f"http://127.0.0.1:{stub.server_port}"
+    os.environ["OPENLIBRARY_COVERS_URL"] = os.environ["OPENLIBRARY_URL"]
+    os.environ["BOOTRA_COVERS"] = os.path.join(os.path.dirname(scratch),
+                                               "covers")
+
+    start = time.perf_counter()
+    if args.database:
+        shutil.copy(args.database, scratch)
+        os.environ["BOOTRA_DATABASE"] = scratch
+    else:
+        synthetic.generate(scratch, args.users, args.books, args.current,
+                           args.history, args.seed)
+    print(f"Prepared database in {time.perf_counter() - start:.1f}s",
+          file=sys.stderr)
+
+    # Time the log in itself, not the login rate limiter turning it away
+    import helpers
+    helpers.login_limiter.limits = {prefix: (1e9, 0)
+                                    for prefix in helpers.login_limiter.limits}
+
+    users = load_users(scratch)
+    rng = random.Random(args.seed)
+    isbns = (isbn13(n) for n in itertools.count())
+    report = {"config": {key: value for key, value in vars(args).items()
+                         if key != "output"},
+              "routes": {}}
+    for mode in args.mode:
+        print(f"Running {mode} mode", file=sys.stderr)
+        if mode == "client":
+            results = run_client(users, args.requests, isbns, rng)
+        else:
+            results = run_server(users, args.requests, isbns, rng,
+                                 args.workers, args.concurrency)
+        report["routes"][mode] = results
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+""" Benchmark of full text search over a large books catalog
+
+Fills a scratch database with a catalog of made up books, then times
+search_books for users with different numbers of current and history rows
+against a mix of queries: a common word, a rare word, a two letter prefix,
+an author surname and a two word query.
+
+Also times the same search against an FTS5 index of the whole books catalog
+joined to the users rows, to show why search_books uses the per user
+library_search index instead.
+
+Usage:
+    python bench/bench_search.py [--books 1000000] [--sizes 100 1000 10000]
+                                 [--repeat 20]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import itertools
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SYLLABLES = ["ka", "lo", "mi", "ren", "sha", "tor", "vel", "dun", "pe", "qui",
+             "bra", "stel", "on", "ar", "ith", "gal", "mor", "nes", "fi", "ux"]
+
+# search_books over a catalog wide index, for comparison
+CATALOG_INDEX = "CREATE VIRTUAL TABLE books_search USING fts5" \
+                "(title, author, content = 'books', content_rowid = 'id', " \
+                "prefix = '2 3', tokenize = 'unicode61 remove_diacritics 2')"
+CATALOG_SEARCH = "SELECT books.*, 'current' AS shelf, start_date, " \
+                 "NULL AS end_date, bm25(books_search, 10.0, 5.0) AS rank " \
+                 "FROM books_search JOIN current " \
+                 "ON current.book_id = books_search.rowid " \
+                 "JOIN books ON books.id = current.book_id " \
+                 "WHERE current.user_id = ? AND books_search MATCH ? " \
+                 "UNION ALL " \
+                 "SELECT books.*, 'history' AS shelf, start_date, end_date, " \
+                 "bm25(books_search, 10.0, 5.0) AS rank " \
+                 "FROM books_search JOIN history " \
+                 "ON history.book_id = books_search.rowid " \
+                 "JOIN books ON books.id = history.book_id " \
+                 "WHERE history.user_id = ? AND books_search MATCH ? " \
+                 "ORDER BY rank LIMIT 50"
+
+
+def make_words(count, rng):
+    """Returns count distinct made up words of 2 to 4 syllables."""
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def seed_catalog(db, books, rng):
+    """
+    Adds books with titles of 1 to 5 words drawn with a long tail, so some
+    words are in a large share of titles and most are rare.
+
+    Returns:
+        (list of title words most common first, list of author surnames)
+    """
+    words = make_words(20000, rng)
+    rng.shuffle(words)
+    weights = list(itertools.accumulate(1 / (rank + 1)
+                                        for rank in range(len(words))))
+    surnames = make_words(5000, rng)
+
+    chunk = 50000
+    for start in range(0, books, chunk):
+        rows = []
+        for n in range(start, min(start + chunk, books)):
+            title = " ".join(rng.choices(words, cum_weights=weights,
+                                           k=rng.randint(1, 5)))
+            author = f"{rng.choice(SYLLABLES).title()} " \
+                     f"{rng.choice(surnames).title()}"
+            rows.append((title.capitalize(), author, 100 + n % 800,
+                         f"S{n:012d}"))
+        with db.transaction():
+            db.connection.executemany("INSERT INTO books " \
+                                      "(title, author, pages, isbn) " \
+                                      "VALUES (?, ?, ?, ?)", rows)
+    return words, surnames
+
+
+def percentiles(times):
+    """Returns the p50 and p95 of a list of seconds, in ms."""
+    times = sorted(times)
+    return (statistics.median(times) * 1000,
+            times[int(len(times) * 0.95) - 1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=1000000)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    scratch = os.path.join(tempfile.mkdtemp(), "bench.db")
+    shutil.copy(os.path.join(ROOT, "library.db"), scratch)
+    os.environ["BOOTRA_DATABASE"] = scratch
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT)
+
+    import helpers
+    from application import app
+    from bench_history import seed_user
+    from flask import session
+
+    rng = random.Random(14)
+    start = time.perf_counter()
+    words, surnames = seed_catalog(helpers.db, args.books, rng)
+    print(f"Added {args.books} books in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    with helpers.db.transaction():
+        helpers.db.execute(CATALOG_INDEX)
+        helpers.db.execute("INSERT INTO books_search (books_search) " \
+                           "VALUES ('rebuild')")
+    print(f"Built catalog index in {time.perf_counter() - start:.1f}s")
+
+    queries = {"common": words[0], "rare": words[-1], "prefix": words[1][:2],
+               "author": surnames[7], "two words": f"{words[2]} {words[40]}"}
+
+    print(f"{'rows':>6}{'query':>11}{'index':>9}{'results':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}")
+    for size in args.sizes:
+        with app.test_request_context():
+            session["user_id"] = seed_user(helpers.db, f"search{size}", size,
+                                           current=size // 10)
+            for name, query in queries.items():
+                match = helpers.search_query(query)
+                paths = [("library",
+                          lambda: helpers.search_books(query)),
+                         ("catalog",
+                          lambda: helpers.db.execute(
+                              CATALOG_SEARCH, session["user_id"], match,
+                              session["user_id"], match))]
+                for path, call in paths:
+                    times = []
+                    for _ in range(args.repeat):
+                        begin = time.perf_counter()
+                        results = call()
+                        times.append(time.perf_counter() - begin)
+                    p50, p95 = percentiles(times)
+                    print(f"{size:6}{name:>11}{path:>9}{len(results):9}"
+                          f"{p50:9.2f}{p95:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
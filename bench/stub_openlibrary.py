@@ -0,0 +1,163 @@
+""" Stub Open Library server for Bootra
+
+Serves a fake /api/books endpoint so lookups can be exercised offline.
+Point the app at it with OPENLIBRARY_URL=http://127.0.0.1:<port>.
+
+Every ISBN gets a made up book, except a configurable fraction which are
+reported as not found. Multiple comma separated bibkeys are supported.
+Covers are served from /b/isbn/<isbn>-L.jpg as plain coloured PNGs, point
+the app at them with OPENLIBRARY_COVERS_URL set to the same address.
+GET /_stats returns the number of API requests served.
+
+Usage:
+    python bench/stub_openlibrary.py [--port 8001] [--delay 0.2]
+                                     [--missing 0.1]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import hashlib
+import json
+import struct
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def fake_book(isbn, missing):
+    """
+    Makes a deterministic Open Library record for an ISBN.
+
+    Args:
+        isbn (str)
+        missing (float): fraction of ISBNs reported as not found
+
+    Returns:
+        dict in the jscmd=data format, None if the ISBN is "not found"
+    """
+    digest = int(hashlib.sha1(isbn.encode()).hexdigest(), 16)
+    if (digest % 1000) / 1000 < missing:
+        return None
+    return {
+        "title": f"Book {isbn}",
+        "authors": [{"name": f"Author {digest % 997}"}],
+        "number_of_pages": 80 + digest % 700,
+        "subjects": [{"name": f"Subject {digest % 31}"}],
+        "publish_date": str(1950 + digest % 70)
+    }
+
+
+def fake_cover(isbn, width=400, height=600):
+    """
+    Makes a plain PNG cover in a colour picked from the ISBN.
+
+    Args:
+        isbn (str)
+        width, height (int): size in pixels
+
+    Returns:
+        bytes of the PNG file
+    """
+    colour = hashlib.sha1(isbn.encode()).digest()[:3]
+    rows = b"".join(b"\x00" + colour * width for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + \
+            struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + \
+        chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers /api/books, /b/isbn covers and /_stats requests."""
+
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+    missing = 0.0
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == "/_stats":
+            return self.send_json({"requests": Handler.requests})
+        if url.path.startswith("/b/isbn/"):
+            return self.send_cover(url.path[8:].split("-")[0])
+        if url.path != "/api/books":
+            return self.send_json({}, status=404)
+
+        with Handler.lock:
+            Handler.requests += 1
+        time.sleep(self.delay)
+
+        bibkeys = parse_qs(url.query).get("bibkeys", [""])[0]
+        body = {}
+        for key in filter(None, bibkeys.split(",")):
+            book = fake_book(key.split(":")[-1], self.missing)
+            if book:
+                body[key] = book
+        self.send_json(body)
+
+    def send_cover(self, isbn):
+        with Handler.lock:
+            Handler.requests += 1
+        if fake_book(isbn, self.missing) is None:
+            return self.send_json({}, status=404)
+
+        data = fake_cover(isbn)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=0, delay=0.0, missing=0.0):
+    """
+    Starts the stub server on a background thread.
+
+    Args:
+        port (int): 0 picks a free port
+        delay (float): seconds to sleep before answering each API request
+        missing (float): fraction of ISBNs reported as not found
+
+    Returns:
+        the running ThreadingHTTPServer, its url is
+        f"http://127.0.0.1:{server.server_port}"
+    """
+    Handler.delay = delay
+    Handler.missing = missing
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--missing", type=float, default=0.0)
+    args = parser.parse_args()
+
+    Handler.delay = args.delay
+    Handler.missing = args.missing
+    print(f"Stub Open Library on http://127.0.0.1:{args.port}")
+    ThreadingHTTPServer(("127.0.0.1", args.port), Handler).serve_forever()
@@ -0,0 +1,186 @@
+""" Synthetic database generator for Bootra benchmarks
+
+Builds a copy of library.db filled with made up users, books and reading
+history shaped like a real library: a long tail of book popularity, page
+counts and reading times around typical values, most users with a modest
+history and a few with a very long one.
+
+Every user is called user<n> with the password "password", so benchmarks
+can log in as any of them.
+
+Usage:
+    python bench/synthetic.py OUTPUT [--users 200] [--books 100000]
+                                     [--current 5] [--history 100]
+                                     [--seed 15]
+"""
+
+__author__ = "Jack Cahill"
+
+import argparse
+import itertools
+import math
+import os
+import random
+import shutil
+import sys
+import time
+
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PASSWORD = "password"
+
+# Book popularity falls off as 1 / rank ** POPULARITY
+POPULARITY = 0.8
+
+# Median and spread of page counts and of days taken to read a book
+PAGES = (300, 0.45)
+READING_DAYS = (14, 0.8)
+
+
+def lognormal(rng, median, sigma, low, high):
+    """Returns a log normally distributed int clipped to [low, high]."""
+    value = rng.lognormvariate(math.log(median), sigma)
+    return int(min(max(value, low), high))
+
+
+def seed_books(db, books, rng):
+    """
+    Adds books with made up titles, authors and page counts.
+
+    Returns:
+        list of the new book ids, most popular first
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from bench_search import make_words
+
+    words = make_words(5000, rng)
+    surnames = make_words(2000, rng)
+    first = db.execute("SELECT COALESCE(MAX(id), 0) AS id FROM books")[0]["id"]
+
+    rows = []
+    for n in range(books):
+        title = " ".join(rng.choices(words, k=rng.randint(1, 5)))
+        author = f"{rng.choice(surnames).title()} {rng.choice(words).title()}"
+        rows.append((title.capitalize(), author,
+                     lognormal(rng, *PAGES, 40, 1500), f"Y{n:012d}"))
+    with db.transaction():
+        db.connection.executemany("INSERT INTO books " \
+                                  "(title, author, pages, isbn) " \
+                                  "VALUES (?, ?, ?, ?)", rows)
+
+    book_ids = list(range(first + 1, first + books + 1))
+    rng.shuffle(book_ids)
+    return book_ids
+
+
+def seed_users(db, users, book_ids, current, history, rng):
+    """
+    Adds users with current and history rows.
+
+    Args:
+        db (Database)
+        users (int): number of users
+        book_ids (list of int): books to pick from, most popular first
+        current (float): mean current books per user
+        history (float): mean history rows per user, log normally spread
+        rng (random.Random)
+
+    Returns:
+        NONE
+    """
+    from werkzeug.security import generate_password_hash
+
+    # One hash for every user, hashing is deliberately slow
+    password_hash = generate_password_hash(PASSWORD)
+    weights = list(itertools.accumulate(1 / (rank + 1) ** POPULARITY
+                                        for rank in range(len(book_ids))))
+    pages = {row["id"]: row["pages"]
+             for row in db.execute("SELECT id, pages FROM books")}
+    today = date.today()
+
+    for n in range(users):
+        with db.transaction():
+            user_id = db.execute("INSERT INTO users (username, hash) " \
+                                 "VALUES (?, ?)", f"user{n}", password_hash)
+
+            history_rows = []
+            count = lognormal(rng, history * math.exp(-0.5), 1.0, 0, 100000)
+            for book_id in rng.choices(book_ids, cum_weights=weights,
+                                       k=count):
+                start = today - timedelta(days=rng.randint(30, 3650))
+                days = lognormal(rng, *READING_DAYS, 1, 365)
+                history_rows.append((user_id, book_id, start,
+                                     start + timedelta(days=days - 1), days,
+                                     pages[book_id] / days))
+            db.connection.executemany("INSERT INTO history " \
+                                      "(user_id, book_id, start_date, " \
+                                      "end_date, days, rate) " \
+                                      "VALUES (?, ?, ?, ?, ?, ?)",
+                                      history_rows)
+
+            current_rows = []
+            count = 1 + min(int(rng.expovariate(1 / current)), 50)
+            for book_id in set(rng.choices(book_ids, cum_weights=weights,
+                                           k=count)):
+                started = rng.random() < 0.8
+                start = today - timedelta(days=rng.randint(0, 60))
+                target = today + timedelta(days=rng.randint(1, 90))
+                current_rows.append((user_id, book_id,
+                                     start if started else None,
+                                     target if rng.random() < 0.4 else None,
+                                     rng.randint(1, pages[book_id] - 1)
+                                     if started else 0))
+            db.connection.executemany("INSERT INTO current " \
+                                      "(user_id, book_id, start_date, " \
+                                      "target_date, page) " \
+                                      "VALUES (?, ?, ?, ?, ?)", current_rows)
+
+
+def generate(path, users=200, books=100000, current=5, history=100, seed=15):
+    """
+    Creates a synthetic database at path from a copy of library.db.
+
+    Args:
+        path (str): database file to create, replaced if it exists
+        users, books (int): number of users and catalog books
+        current, history (float): mean current and history rows per user
+        seed (int): random seed, the same arguments give the same database
+
+    Returns:
+        NONE
+    """
+    shutil.copy(os.path.join(ROOT, "library.db"), path)
+    os.environ["BOOTRA_DATABASE"] = path
+    sys.path.insert(0, ROOT)
+
+    # helpers creates the tables and triggers the app needs on import
+    import helpers
+
+    rng = random.Random(seed)
+    book_ids = seed_books(helpers.db, books, rng)
+    seed_users(helpers.db, users, book_ids, current, history, rng)
+    helpers.rebuild_user_stats()
+    helpers.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("output")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--current", type=float, default=5)
+    parser.add_argument("--history", type=float, default=100)
+    parser.add_argument("--seed", type=int, default=15)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.output, args.users, args.books, args.current, args.history,
+             args.seed)
+    print(f"Generated {args.output} in {time.perf_counter() - start:.1f}s",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+""" Book lookup cache for Bootra
+
+Two tier cache in front of the Open Library API. Recent lookups are kept in an
+in-process LRU and every lookup is also written to the lookups table so that
+it survives restarts and is shared between worker processes.
+
+Both found and not found results are cached, with separate time to live, so a
+missing ISBN is only looked up once per negative_ttl however many users enter
+it. Concurrent lookups of the same ISBN share a single request.
+
+SECTIONS:
+    - Config
+    - Book Cache
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+import requests
+
+# Default time to live in seconds for found and not found lookups
+POSITIVE_TTL = 30 * 24 * 60 * 60
+NEGATIVE_TTL = 24 * 60 * 60
+
+
+################################## BOOK CACHE #################################
+
+class BookCache:
+    """
+    Caches the results of a lookup function keyed by ISBN.
+
+    Attributes:
+        stats (dict): hit, miss and latency counters, changed under the
+            lock so read them with snapshot
+            memory_hits, disk_hits, misses, errors - counts
+            coalesced - lookups that waited on another thread's fetch,
+                not counted as hits
+            fetch_seconds - total time spent in the lookup function
+    """
+
+    def __init__(self, db, fetch, capacity=1024, positive_ttl=POSITIVE_TTL,
+                 negative_ttl=NEGATIVE_TTL):
+        """
+        Args:
+            db: database with an execute(sql, *args) method for the disk tier
+            fetch (function): takes an ISBN and returns a dict or None
+            capacity (int): max number of ISBNs kept in memory
+            positive_ttl (int): seconds a found book is cached for
+            negative_ttl (int): seconds a not found book is cached for
+        """
+        self.db = db
+        self.fetch = fetch
+        self.capacity = capacity
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+
+        self.stats = dict.fromkeys(
+            ["memory_hits", "disk_hits", "misses", "errors", "coalesced"], 0)
+        self.stats["fetch_seconds"] = 0.0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS lookups " \
+                        "(isbn TEXT PRIMARY KEY NOT NULL, data TEXT, " \
+                        "expires REAL NOT NULL)")
+
+    def get(self, isbn):
+        """
+        Returns the cached lookup for an ISBN, calling fetch on a miss.
+
+        Args:
+            isbn (str)
+
+        Returns:
+            dict returned by fetch if book found
+            None if book not found or fetch failed
+        """
+        found, book = self._from_memory(isbn)
+        if found:
+            return book
+
+        # Only the first thread to miss an ISBN fetches it, the rest wait
+        with self._lock:
+            event = self._inflight.get(isbn)
+            leader = event is None
+            if leader:
+                event = self._inflight[isbn] = threading.Event()
+
+        if not leader:
+            self._count("coalesced")
+            event.wait()
+            return self._from_memory(isbn, count=False)[1]
+
+        try:
+            found, book = self._from_disk(isbn)
+            if not found:
+                book = self._fetch(isbn)
+            return book
+        finally:
+            with self._lock:
+                del self._inflight[isbn]
+            event.set()
+
+    def get_many(self, isbns, fetch_many, progress=None):
+        """
+        Returns the cached lookups for many ISBNs, fetching all the misses
+        with one call to fetch_many.
+
+        Args:
+            isbns (list of str)
+            fetch_many (function): takes a list of ISBNs and a progress
+                function and returns a dict of ISBN to dict or None, leaving
+                out ISBNs it failed to fetch
+            progress (function): passed on to fetch_many
+
+        Returns:
+            dict mapping each ISBN to its book dict or None
+        """
+        books = {}
+        missing = []
+        for isbn in isbns:
+            found, books[isbn] = self._from_memory(isbn)
+            if not found:
+                missing.append(isbn)
+
+        if missing:
+            placeholders = ", ".join("?" * len(missing))
+            rows = self.db.execute("SELECT isbn, data, expires FROM lookups " \
+                                   f"WHERE isbn IN ({placeholders}) " \
+                                   "AND expires > ?", *missing, time.time())
+            self._count("disk_hits", len(rows))
+            for row in rows:
+                book = json.loads(row["data"]) if row["data"] else None
+                books[row["isbn"]] = book
+                self._remember(row["isbn"], book, row["expires"])
+            found = {row["isbn"] for row in rows}
+            missing = [isbn for isbn in missing if isbn not in found]
+
+        if missing:
+            self._count("misses", len(missing))
+            start = time.perf_counter()
+            fetched = fetch_many(missing, progress)
+            self._count("fetch_seconds", time.perf_counter() - start)
+            self._count("errors", len(missing) - len(fetched))
+            for isbn, book in fetched.items():
+                books[isbn] = book
+                self._store(isbn, book)
+
+        return books
+
+    def invalidate(self, isbn):
+        """
+        Removes an ISBN from both tiers so the next get fetches it again.
+
+        Args:
+            isbn (str)
+
+        Returns:
+            NONE
+        """
+        with self._lock:
+            self._memory.pop(isbn, None)
+        self.db.execute("DELETE FROM lookups WHERE isbn = ?", isbn)
+
+    def snapshot(self):
+        """Returns a copy of stats taken under the lock."""
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, name, amount=1):
+        """Adds to one of the stats under the lock."""
+        with self._lock:
+            self.stats[name] += amount
+
+    def _fetch(self, isbn):
+        """Calls fetch and stores the result in both tiers."""
+        self._count("misses")
+        start = time.perf_counter()
+        try:
+            book = self.fetch(isbn)
+        except requests.RequestException:
+            # Not cached so that the next request tries again
+            self._count("errors")
+            return None
+        finally:
+            self._count("fetch_seconds", time.perf_counter() - start)
+
+        self._store(isbn, book)
+        return book
+
+    def _from_disk(self, isbn):
+        """Returns (found, book) from the lookups table."""
+        rows = self.db.execute("SELECT data, expires FROM lookups " \
+                               "WHERE isbn = ? AND expires > ?",
+                               isbn, time.time())
+        if not rows:
+            return False, None
+
+        self._count("disk_hits")
+        book = json.loads(rows[0]["data"]) if rows[0]["data"] else None
+        self._remember(isbn, book, rows[0]["expires"])
+        return True, book
+
+    def _from_memory(self, isbn, count=True):
+        """
+        Returns (found, book) from the LRU, dropping expired entries. Counts
+        a memory hit unless count is False.
+        """
+        with self._lock:
+            entry = self._memory.get(isbn)
+            if entry is None:
+                return False, None
+            if entry[1] <= time.time():
+                del self._memory[isbn]
+                return False, None
+            self._memory.move_to_end(isbn)
+            if count:
+                self.stats["memory_hits"] += 1
+        return True, entry[0]
+
+    def _store(self, isbn, book):
+        """Adds a fetched lookup to both tiers."""
+        ttl = self.positive_ttl if book else self.negative_ttl
+        expires = time.time() + ttl
+        self._remember(isbn, book, expires)
+        self.db.execute("INSERT OR REPLACE INTO lookups " \
+                        "(isbn, data, expires) VALUES (?, ?, ?)",
+                        isbn, json.dumps(book) if book else None, expires)
+
+    def _remember(self, isbn, book, expires):
+        """Adds an entry to the LRU, evicting the least recently used."""
+        with self._lock:
+            self._memory[isbn] = (book, expires)
+            self._memory.move_to_end(isbn)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
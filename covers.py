@@ -0,0 +1,266 @@
+""" Cover image store for Bootra
+
+Keeps a local copy of each book's Open Library cover so pages don't hot link
+covers.openlibrary.org on every view. The original is fetched once per ISBN
+and the thumbnail sizes used by the templates are generated from it.
+
+Images are stored content addressed, named by the SHA-256 of their bytes,
+so each file never changes and can be served with a strong ETag and cached
+by browsers forever. The covers table maps an ISBN and size to a file and
+the cover_files table tracks file sizes and last access, so the store is
+kept under max_bytes by deleting the least recently used files.
+
+Covers are fetched and resized by fetch_cover jobs on the job worker, never
+in a request. Resizing needs Pillow. Without it every size is served as the
+original, and a fetched file that isn't an image can't be caught.
+
+SECTIONS:
+    - Config
+    - Cover Store
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import hashlib
+import io
+import os
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+COVER_DIR = os.environ.get("BOOTRA_COVERS", "covers")
+
+# Max total bytes of stored images before least recently used are evicted
+MAX_BYTES = 256 * 1024 * 1024
+
+# Thumbnail widths in pixels, twice the width shown for high DPI screens
+SIZES = {"S": 80, "M": 180, "L": 460}
+ORIGINAL = "original"
+
+# Seconds a missing cover is remembered, and between last access updates
+NEGATIVE_TTL = 24 * 60 * 60
+TOUCH_EVERY = 60 * 60
+
+JPEG_QUALITY = 85
+
+
+################################## COVER STORE ################################
+
+class CoverStore:
+    """
+    Content addressed store of cover images on disk.
+
+    Attributes:
+        root (str): directory the images are stored in
+        max_bytes (int): max total size of stored images
+    """
+
+    def __init__(self, db, fetch, root=COVER_DIR, max_bytes=MAX_BYTES):
+        """
+        Args:
+            db: database with execute(sql, *args) and transaction() methods
+            fetch (function): takes an ISBN and returns (bytes, mimetype) of
+                the original cover or None, raising RequestException on
+                network errors
+            root (str): directory the images are stored in
+            max_bytes (int): max total size of stored images
+        """
+        self.db = db
+        self.fetch = fetch
+        self.root = root
+        self.max_bytes = max_bytes
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS cover_files " \
+                        "(digest TEXT PRIMARY KEY NOT NULL, " \
+                        "mimetype TEXT NOT NULL, bytes INTEGER NOT NULL, " \
+                        "accessed REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cover_files_accessed " \
+                        "ON cover_files (accessed)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS covers " \
+                        "(isbn TEXT NOT NULL, size TEXT NOT NULL, " \
+                        "digest TEXT, checked REAL NOT NULL, " \
+                        "PRIMARY KEY(isbn, size))")
+
+    def file(self, digest):
+        """
+        Finds a stored image by digest, marking it as recently used.
+
+        Args:
+            digest (str)
+
+        Returns:
+            dict of digest, mimetype, bytes and path of the image
+            None if it is not stored
+        """
+        rows = self.db.execute("SELECT * FROM cover_files WHERE digest = ?",
+                               digest)
+        if not rows or not os.path.exists(self.path(digest)):
+            return None
+
+        image = rows[0]
+        now = time.time()
+        if now - image["accessed"] > TOUCH_EVERY:
+            self.db.execute("UPDATE cover_files SET accessed = ? " \
+                            "WHERE digest = ?", now, digest)
+        image["path"] = self.path(digest)
+        return image
+
+    def get(self, isbn, size):
+        """
+        Returns the digest of a book's cover at a size, fetching the original
+        and generating the size if they are not stored yet.
+
+        Args:
+            isbn (str)
+            size (str): one of SIZES
+
+        Returns:
+            str digest of the image
+            None if the book has no cover, or its cover isn't an image
+
+        Raises:
+            requests.RequestException if Open Library could not be reached,
+            nothing is recorded so it is fetched again next time
+        """
+        found, digest = self.lookup(isbn, size)
+        if found:
+            return digest
+
+        found, original = self.lookup(isbn, ORIGINAL)
+        if not found:
+            cover = self.fetch(isbn)
+            original = cover and self.put(*cover)
+            self._map(isbn, ORIGINAL, original)
+        if original is None:
+            self._map(isbn, size, None)
+            return None
+
+        digest = self._resize(original, SIZES[size])
+        self._map(isbn, size, digest)
+        return digest
+
+    def lookup(self, isbn, size):
+        """
+        Looks up the stored cover of a book at a size without fetching.
+
+        Args:
+            isbn (str)
+            size (str): one of SIZES or ORIGINAL
+
+        Returns:
+            (bool, str) whether the answer is known and the digest of the
+            image, None if the book has no cover
+        """
+        rows = self.db.execute("SELECT covers.digest, checked, bytes " \
+                               "FROM covers LEFT JOIN cover_files " \
+                               "ON covers.digest = cover_files.digest " \
+                               "WHERE isbn = ? AND size = ?", isbn, size)
+        if not rows:
+            return False, None
+
+        row = rows[0]
+        if row["digest"] is None:
+            return time.time() - row["checked"] < NEGATIVE_TTL, None
+        # File evicted since it was mapped
+        if row["bytes"] is None:
+            return False, None
+        return True, row["digest"]
+
+    def path(self, digest):
+        """Returns the file path of an image, fanned out by digest prefix."""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data, mimetype):
+        """
+        Stores an image under the digest of its bytes, evicting least
+        recently used images if the store is over max_bytes.
+
+        Args:
+            data (bytes)
+            mimetype (str)
+
+        Returns:
+            str digest of the image
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            partial = f"{path}.{os.getpid()}.tmp"
+            with open(partial, "wb") as f:
+                f.write(data)
+            os.replace(partial, path)
+
+        self.db.execute("INSERT OR REPLACE INTO cover_files " \
+                        "(digest, mimetype, bytes, accessed) " \
+                        "VALUES (?, ?, ?, ?)",
+                        digest, mimetype, len(data), time.time())
+        self.evict()
+        return digest
+
+    def evict(self):
+        """
+        Deletes least recently used images until the store is within
+        max_bytes.
+
+        Returns:
+            int number of images deleted
+        """
+        total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) AS total " \
+                                "FROM cover_files")[0]["total"]
+        if total <= self.max_bytes:
+            return 0
+
+        deleted = 0
+        for image in self.db.execute("SELECT digest, bytes FROM cover_files " \
+                                     "ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM cover_files WHERE digest = ?",
+                            image["digest"])
+            try:
+                os.remove(self.path(image["digest"]))
+            except FileNotFoundError:
+                pass
+            total -= image["bytes"]
+            deleted += 1
+        return deleted
+
+    def _map(self, isbn, size, digest):
+        """Records the image of a book's cover at a size, None if none."""
+        self.db.execute("INSERT OR REPLACE INTO covers " \
+                        "(isbn, size, digest, checked) VALUES (?, ?, ?, ?)",
+                        isbn, size, digest, time.time())
+
+    def _resize(self, digest, width):
+        """
+        Stores a copy of an image scaled down to width as a JPEG.
+
+        Returns:
+            str digest of the copy
+            digest unchanged if Pillow is not installed or the image is
+            already narrower
+            None if the file can't be read as an image
+        """
+        image = self.file(digest)
+        if Image is None or image is None:
+            return digest
+
+        try:
+            with Image.open(image["path"]) as original:
+                if original.width <= width:
+                    return digest
+                height = round(original.height * width / original.width)
+                thumbnail = original.convert("RGB").resize((width, height),
+                                                           Image.LANCZOS)
+        except (OSError, Image.DecompressionBombError):
+            # UnidentifiedImageError is an OSError
+            return None
+        data = io.BytesIO()
+        thumbnail.save(data, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        return self.put(data.getvalue(), "image/jpeg")
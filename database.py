@@ -0,0 +1,205 @@
+""" Data access layer for Bootra
+
+Thin wrapper around sqlite3 with the same execute(sql, *args) interface as
+cs50.SQL, without parsing every statement through sqlparse and SQLAlchemy.
+
+Each thread gets its own connection, opened on first use and kept for the
+life of the thread, so multi-threaded WSGI servers never share a connection.
+Connections run in WAL mode so readers don't block the writer, and sqlite3
+keeps a cache of prepared statements per connection. Columns declared as DATE
+are returned as datetime dates.
+
+SECTIONS:
+    - Config
+    - Database
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import date
+
+from dates import parse_date
+
+DATABASE = os.environ.get("BOOTRA_DATABASE", "library.db")
+
+# Prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+# Rows fetched at a time by iterate
+ITERATE_SIZE = 500
+
+# Store dates as 'YYYY-MM-DD' strings like cs50.SQL did, and read columns
+# declared as DATE back as datetime dates
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter("date", parse_date)
+
+
+################################### DATABASE ##################################
+
+def dict_factory(cursor, row):
+    """Row factory returning rows as dicts of column name to value."""
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+class Database:
+    """
+    Per-thread sqlite3 connections to one database file.
+
+    Attributes:
+        path (str): database file
+        observers (list of functions): called with (sql, seconds, rows) after
+            each statement run by execute, rows being the number of rows
+            returned or changed
+    """
+
+    def __init__(self, path=DATABASE):
+        """
+        Args:
+            path (str): database file
+        """
+        self.path = path
+        self.observers = []
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """The calling thread's connection, opened on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self.connect()
+            self._local.depth = 0
+        return connection
+
+    def connect(self):
+        """
+        Opens a new connection in autocommit mode, transactions are started
+        explicitly with transaction().
+
+        Returns:
+            sqlite3.Connection
+        """
+        connection = sqlite3.connect(self.path, isolation_level=None,
+                                     cached_statements=CACHED_STATEMENTS,
+                                     check_same_thread=False,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        connection.row_factory = dict_factory
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    def execute(self, sql, *args):
+        """
+        Executes one SQL statement with ? placeholders.
+
+        Args:
+            sql (str)
+            *args: values for the placeholders
+
+        Returns:
+            list of row dicts for statements returning rows
+            int id of the new row for INSERT
+            int number of rows changed for UPDATE and DELETE
+            None otherwise
+        """
+        start = time.perf_counter()
+        cursor = self.connection.execute(sql, args)
+        if cursor.description is not None:
+            result = cursor.fetchall()
+        else:
+            command = sql.lstrip()[:7].upper()
+            if command.startswith(("INSERT", "REPLACE")):
+                result = cursor.lastrowid
+            elif command.startswith(("UPDATE", "DELETE")):
+                result = cursor.rowcount
+            else:
+                result = None
+
+        if self.observers:
+            seconds = time.perf_counter() - start
+            rows = len(result) if cursor.description is not None \
+                else max(cursor.rowcount, 0)
+            for observer in self.observers:
+                observer(sql, seconds, rows)
+        return result
+
+    def iterate(self, sql, *args, size=ITERATE_SIZE):
+        """
+        Runs a query and yields its rows a batch at a time instead of fetching
+        them all, so memory use doesn't grow with the number of rows.
+        Observers are called once the rows run out.
+
+        Args:
+            sql (str)
+            *args: values for the placeholders
+            size (int): rows fetched at a time
+
+        Yields:
+            row dicts
+        """
+        start = time.perf_counter()
+        cursor = self.connection.execute(sql, args)
+        seconds = time.perf_counter() - start
+        rows = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = cursor.fetchmany(size)
+                seconds += time.perf_counter() - start
+                if not batch:
+                    break
+                rows += len(batch)
+                yield from batch
+        finally:
+            cursor.close()
+        for observer in self.observers:
+            observer(sql, seconds, rows)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements in the with block in one transaction, committed
+        at the end of the block or rolled back if it raises.
+        Nested blocks join the outermost transaction.
+
+        Usage:
+            with db.transaction():
+                db.execute(...)
+                db.execute(...)
+        """
+        connection = self.connection
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """Closes the calling thread's connection if it has one."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
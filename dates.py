@@ -0,0 +1,64 @@
+""" Date utilities for Bootra
+
+Dates are stored in the database as 'YYYY-MM-DD' strings. They are parsed into
+datetime dates once, as rows are read (see database.py), and only formatted
+for display in the templates with the nice_date filter.
+
+A history page repeats the same few hundred dates many times, so parsing and
+formatting are memoised in bounded caches.
+
+SECTIONS:
+    - Config
+    - Date Functions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+from datetime import date
+from functools import lru_cache
+
+# Format used to display dates e.g. Sat 15 Aug 2020
+DISPLAY_FORMAT = "%a %e %b %Y"
+
+# Max number of distinct dates kept in each cache
+CACHE_SIZE = 4096
+
+
+################################ DATE FUNCTIONS ###############################
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_date(value):
+    """
+    Formats a date for display, registered as the nice_date template filter.
+
+    Args:
+        value (datetime date or 'YYYY-MM-DD' str): may be None
+
+    Returns:
+        str in nice format e.g. Sat 15 Aug 2020
+        empty str if value is None
+    """
+    if not value:
+        return ""
+    return parse_date(value).strftime(DISPLAY_FORMAT)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_date(value):
+    """
+    Converts a stored date into datetime date format.
+
+    Args:
+        value (str or bytes): of form 'YYYY-MM-DD', datetime dates are
+            returned unchanged
+
+    Returns:
+        same date in datetime date form
+    """
+    if isinstance(value, date):
+        return value
+    if isinstance(value, bytes):
+        value = value.decode()
+    return date.fromisoformat(value)
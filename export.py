@@ -0,0 +1,169 @@
+""" Reading history export for Bootra
+
+Streams a user's current and history shelves as CSV, JSON Lines or a
+Goodreads compatible CSV that Goodreads (and Bootra's own import) can read.
+
+Rows are read from the database a batch at a time and written out as they
+come, optionally gzipped on the fly, so memory use stays the same however
+long the history is. Each shelf is read by its own query in the order of
+its (user_id, start_date) index, so nothing is sorted before the first row.
+
+SECTIONS:
+    - Config
+    - Rows
+    - Formats
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import csv
+import io
+import json
+import zlib
+
+from datetime import date
+
+from isbn import to_isbn10
+
+# Rows written per chunk of output
+CHUNK_ROWS = 200
+
+COLUMNS = ["shelf", "title", "author", "isbn", "pages", "page", "start_date",
+           "target_date", "end_date", "days", "rate"]
+
+# Columns of a Goodreads library export, the ones Goodreads imports
+GOODREADS_COLUMNS = ["Title", "Author", "ISBN", "ISBN13", "My Rating",
+                     "Number of Pages", "Date Read", "Date Added",
+                     "Bookshelves", "Exclusive Shelf"]
+GOODREADS_SHELVES = {"current": "currently-reading", "history": "read"}
+
+# Format name to (mimetype, file extension)
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "goodreads": ("text/csv", "csv")
+}
+
+# Rows of each shelf in export order, using the current_user_start and
+# history_user_start indexes
+EXPORT_SQL = {
+    "current": "SELECT 'current' AS shelf, title, author, isbn, pages, " \
+               "page, start_date, target_date, NULL AS end_date, " \
+               "NULL AS days, NULL AS rate " \
+               "FROM current JOIN books ON books.id = book_id " \
+               "WHERE user_id = ? ORDER BY start_date",
+    "history": "SELECT 'history' AS shelf, title, author, isbn, pages, " \
+               "pages AS page, start_date, NULL AS target_date, end_date, " \
+               "days, rate " \
+               "FROM history JOIN books ON books.id = book_id " \
+               "WHERE user_id = ? ORDER BY start_date"
+}
+
+
+###################################### ROWS ###################################
+
+def export_rows(db, user_id):
+    """
+    Yields every book on a user's current and history shelves, current
+    first, each shelf oldest first.
+
+    Args:
+        db (Database)
+        user_id (int)
+
+    Yields:
+        dicts with the keys in COLUMNS
+    """
+    for sql in EXPORT_SQL.values():
+        yield from db.iterate(sql, user_id)
+
+
+def export(db, user_id, format, compress=False):
+    """
+    Streams a user's export in a format.
+
+    Args:
+        db (Database)
+        user_id (int)
+        format (str): one of FORMATS
+        compress (bool): gzip the output
+
+    Returns:
+        generator of bytes chunks of the file
+    """
+    chunks = WRITERS[format](export_rows(db, user_id))
+    encoded = (chunk.encode() for chunk in chunks)
+    return gzip_chunks(encoded) if compress else encoded
+
+
+def gzip_chunks(chunks):
+    """Gzips a stream of bytes chunks as they come."""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+#################################### FORMATS ##################################
+
+def csv_chunks(rows):
+    """Yields rows as CSV with a header of COLUMNS."""
+    yield from _csv(COLUMNS, ([row[column] for column in COLUMNS]
+                              for row in rows))
+
+
+def goodreads_chunks(rows):
+    """
+    Yields rows in the CSV format of a Goodreads library export, with ISBNs
+    wrapped as ="..." like Goodreads does so spreadsheets keep their digits.
+    Books are stored by ISBN-13, their ISBN-10 is worked out from it.
+    """
+    def goodreads(row):
+        isbn13 = row["isbn"] if row["isbn"] and len(row["isbn"]) == 13 else ""
+        isbn10 = to_isbn10(isbn13) or ""
+        shelf = GOODREADS_SHELVES[row["shelf"]]
+        return [row["title"], row["author"], f'="{isbn10}"', f'="{isbn13}"',
+                0, row["pages"], _slashed(row["end_date"]),
+                _slashed(row["start_date"]), shelf, shelf]
+
+    yield from _csv(GOODREADS_COLUMNS, (goodreads(row) for row in rows))
+
+
+def jsonl_chunks(rows):
+    """Yields rows as JSON Lines, one object per book."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, default=date.isoformat) + "\n")
+        if len(lines) == CHUNK_ROWS:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def _csv(header, rows):
+    """Yields a header and rows as CSV, CHUNK_ROWS rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for n, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if n % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _slashed(day):
+    """Formats a date as YYYY/MM/DD like Goodreads, None as empty."""
+    return day.strftime("%Y/%m/%d") if day else ""
+
+
+WRITERS = {"csv": csv_chunks, "jsonl": jsonl_chunks,
+           "goodreads": goodreads_chunks}
@@ -0,0 +1,271 @@
+""" Reading goals for Bootra
+
+Goals a user can set, at most one active goal of each kind:
+
+    books_year: books finished in a calendar year
+    pages_month: pages read in a calendar month
+    streak_days: days in a row with some reading
+
+Progress is kept up to date as the user reads. record_reading and
+record_finished add each page update and finished book to the user's active
+goals in the transaction that saves it, so showing goals never recounts
+them. Progress is only counted from the reading log and history in full when
+a goal starts, as it may start part way through its period.
+
+Every user's current reading streak is kept in reading_streaks the same
+way, extended by the first reading of each day.
+
+Nothing changes when goals are viewed. Once a day rollover, run by the
+goal_rollover job, works through every user in batch:
+
+    - goals whose period has ended are marked met or missed, and the same
+      target is set for the period that has started
+    - streak goals that have been reached are marked met
+    - streaks with no reading yesterday or today are broken
+    - target dates of current books that have been reached are cleared
+
+SECTIONS:
+    - Config
+    - Goals
+    - Progress
+    - Rollover
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import json
+
+from datetime import date, timedelta
+
+# Goal kind to its description
+KINDS = {
+    "books_year": "books this year",
+    "pages_month": "pages this month",
+    "streak_days": "days reading in a row"
+}
+
+# Largest target allowed for any goal
+MAX_TARGET = 100000
+
+# Progress of each goal counted in full from history, reading_days and
+# reading_events, for goals just started. Takes the day before today, as
+# streaks last read before then are broken
+PROGRESS_SQL = "CASE kind " \
+               "WHEN 'books_year' THEN (SELECT COUNT(*) FROM history " \
+               "WHERE history.user_id = goals.user_id " \
+               "AND end_date BETWEEN period_start AND period_end) " \
+               "WHEN 'pages_month' THEN (SELECT COALESCE(SUM(pages), 0) " \
+               "FROM (SELECT pages FROM reading_days " \
+               "WHERE reading_days.user_id = goals.user_id " \
+               "AND day BETWEEN period_start AND period_end " \
+               "UNION ALL SELECT pages_read FROM reading_events " \
+               "WHERE reading_events.user_id = goals.user_id " \
+               "AND day BETWEEN period_start AND period_end)) " \
+               "ELSE COALESCE((SELECT current FROM reading_streaks " \
+               "WHERE reading_streaks.user_id = goals.user_id " \
+               "AND last_day >= ?), 0) END"
+
+# Streak length after reading on a day, from the streak before it. Takes the
+# day and the day before
+STREAK_SQL = "CASE WHEN last_day >= ? THEN current " \
+             "WHEN last_day = ? THEN current + 1 ELSE 1 END"
+
+
+##################################### GOALS ###################################
+
+def period(kind, day):
+    """
+    Returns the first and last day of the period of a goal containing a day,
+    a calendar year or month. Streak goals have no end.
+
+    Args:
+        kind (str): one of KINDS
+        day (datetime date)
+
+    Returns:
+        tuple of datetime dates, the last None for streak goals
+    """
+    if kind == "books_year":
+        return date(day.year, 1, 1), date(day.year, 12, 31)
+    if kind == "pages_month":
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return start, end
+    return day, None
+
+
+def set_goal(db, user_id, kind, target, today=None):
+    """
+    Sets a user's goal of a kind for the current period, changing the target
+    of their active goal of that kind if they have one.
+
+    Args:
+        db (Database)
+        user_id (int)
+        kind (str): one of KINDS
+        target (int): from 1 to MAX_TARGET
+
+    Returns:
+        int id of the goal
+
+    Raises:
+        ValueError if kind or target isn't valid
+    """
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    if type(target) is not int or not 1 <= target <= MAX_TARGET:
+        raise ValueError(f"target must be from 1 to {MAX_TARGET}")
+
+    today = today or date.today()
+    with db.transaction():
+        active = db.execute("SELECT id FROM goals WHERE user_id = ? " \
+                            "AND kind = ? AND status = 'active'",
+                            user_id, kind)
+        if active:
+            db.execute("UPDATE goals SET target = ? WHERE id = ?",
+                       target, active[0]["id"])
+            return active[0]["id"]
+
+        start, end = period(kind, today)
+        goal_id = db.execute("INSERT INTO goals " \
+                             "(user_id, kind, target, period_start, " \
+                             "period_end) VALUES (?, ?, ?, ?, ?)",
+                             user_id, kind, target, start, end)
+        recount(db, today, "id = ?", goal_id)
+        return goal_id
+
+
+#################################### PROGRESS #################################
+
+def record_finished(db, user_id, day):
+    """
+    Counts a book finished on a day towards the user's books goal. Call in
+    the transaction that moves it to history.
+    """
+    db.execute("UPDATE goals SET progress = progress + 1 " \
+               "WHERE user_id = ? AND kind = 'books_year' " \
+               "AND status = 'active' " \
+               "AND ? BETWEEN period_start AND period_end", user_id, day)
+
+
+def record_reading(db, user_id, day, pages):
+    """
+    Counts pages read on a day towards the user's pages goal, and extends
+    their streak if they read any. Call in the transaction that logs the
+    pages in reading_events.
+
+    Args:
+        db (Database)
+        user_id (int)
+        day (datetime date)
+        pages (int): pages read, negative when a page number was corrected
+
+    Returns:
+        NONE
+    """
+    db.execute("UPDATE goals SET progress = progress + ? " \
+               "WHERE user_id = ? AND kind = 'pages_month' " \
+               "AND status = 'active' " \
+               "AND ? BETWEEN period_start AND period_end",
+               pages, user_id, day)
+    if pages <= 0:
+        return
+
+    yesterday = day - timedelta(days=1)
+    db.execute("INSERT INTO reading_streaks " \
+               "(user_id, current, best, last_day) VALUES (?, 1, 1, ?) " \
+               f"ON CONFLICT(user_id) DO UPDATE SET current = {STREAK_SQL}, " \
+               f"best = MAX(best, {STREAK_SQL}), " \
+               "last_day = MAX(last_day, excluded.last_day)",
+               user_id, day, day, yesterday, day, yesterday)
+    db.execute("UPDATE goals SET progress = (SELECT current " \
+               "FROM reading_streaks WHERE user_id = goals.user_id) " \
+               "WHERE user_id = ? AND kind = 'streak_days' " \
+               "AND status = 'active'", user_id)
+
+
+def recount(db, today, where, *args):
+    """
+    Counts the progress of goals in full, see PROGRESS_SQL.
+
+    Args:
+        db (Database)
+        today (datetime date)
+        where (str): SQL condition picking the goals
+        *args: values for the placeholders in where
+
+    Returns:
+        int number of goals counted
+    """
+    return db.execute(f"UPDATE goals SET progress = {PROGRESS_SQL} " \
+                      f"WHERE {where}", today - timedelta(days=1), *args)
+
+
+#################################### ROLLOVER #################################
+
+def rollover(db, today=None):
+    """
+    Ends the goals, streaks and target dates that have run out by today, for
+    every user at once. Safe to run more than once a day, each step only
+    picks up what hasn't been rolled over yet.
+
+    Args:
+        db (Database)
+        today (datetime date)
+
+    Returns:
+        dict of numbers of goals ended, goals started, streak goals met,
+        streaks broken and target dates cleared
+    """
+    today = today or date.today()
+    yesterday = today - timedelta(days=1)
+    counts = {}
+    with db.transaction():
+        # Later goals replace those that have ended with the same target
+        first = db.execute("SELECT COALESCE(MAX(id), 0) AS id FROM goals")
+        for kind in ["books_year", "pages_month"]:
+            start, end = period(kind, today)
+            db.execute("INSERT INTO goals " \
+                       "(user_id, kind, target, period_start, period_end) " \
+                       "SELECT user_id, kind, target, ?, ? FROM goals " \
+                       "WHERE status = 'active' AND period_end < ? " \
+                       "AND kind = ?", start, end, today, kind)
+        counts["started"] = recount(db, today, "id > ?", first[0]["id"])
+        counts["ended"] = db.execute("UPDATE goals SET status = CASE " \
+                                     "WHEN progress >= target THEN 'met' " \
+                                     "ELSE 'missed' END " \
+                                     "WHERE status = 'active' " \
+                                     "AND period_end < ?", today)
+
+        counts["streaks_met"] = db.execute("UPDATE goals " \
+                                           "SET status = 'met', " \
+                                           "period_end = (SELECT last_day " \
+                                           "FROM reading_streaks " \
+                                           "WHERE user_id = goals.user_id) " \
+                                           "WHERE status = 'active' " \
+                                           "AND kind = 'streak_days' " \
+                                           "AND progress >= target")
+        counts["streaks_broken"] = db.execute("UPDATE reading_streaks " \
+                                              "SET current = 0 " \
+                                              "WHERE current > 0 " \
+                                              "AND last_day < ?", yesterday)
+        db.execute("UPDATE goals SET progress = 0 WHERE status = 'active' " \
+                   "AND kind = 'streak_days' AND progress > 0 " \
+                   "AND user_id IN (SELECT user_id FROM reading_streaks " \
+                   "WHERE current = 0)")
+
+        counts["targets"] = db.execute("UPDATE current " \
+                                       "SET target_date = NULL " \
+                                       "WHERE target_date <= ?", today)
+
+        db.execute("INSERT OR REPLACE INTO goal_rollovers (day, counts) " \
+                   "VALUES (?, ?)", today, json.dumps(counts))
+    return counts
+
+
+def rolled_over(db, today=None):
+    """Returns whether rollover has run for today."""
+    return bool(db.execute("SELECT day FROM goal_rollovers WHERE day = ?",
+                           today or date.today()))
@@ -12,17 +12,101 @@ __author__ = "Jack Cahill"
 
 #################################### CONFIG ###################################
 
-import requests
+import csv
+import json
+import re
+import time
 
-from cs50 import SQL
 from datetime import date, timedelta
 from flask import session
+from requests import RequestException
 
-db = SQL("sqlite:///library.db")
+from auth import IP_BURST, IP_RATE, USER_BURST, USER_RATE, RateLimiter
+from cache import BookCache
+from covers import CoverStore
+from database import Database
+from dates import parse_date
+from goals import KINDS, record_finished, record_reading, rolled_over, \
+    rollover, set_goal
+from isbn import to_isbn13, to_isbn13_many
+from jobs import JobQueue
+from migrations import LIBRARY_SEARCH_SQL, USER_STATS_SQL, migrate
+from openlibrary import BATCH_SIZE, fetch_book, fetch_books, fetch_cover, \
+    fetch_details
+from projections import READING_RATES, project_books, shelf_dates
+
+db = Database()
+
+# Creates or upgrades the schema, see migrations.py
+migrate(db)
+
+# Columns of current that update_current is allowed to change
+CURRENT_COLUMNS = {"page", "start_date", "target_date"}
+
+# Default and max number of books shown per page of current and history
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Days of reading used for the recent reading rate
+ROLLING_DAYS = 14
+
+# Failed lookups of a placeholder book before it is shown as failed. It is
+# still looked up again every jobs.SCHEDULE_EVERY, see
+# schedule_placeholder_lookups
+LOOKUP_ATTEMPTS = 5
+
+# Seconds before the lookup_book job queued for a new placeholder runs,
+# leaving the web app's lookup worker time to fill it in first
+LOOKUP_JOB_DELAY = 60
+
+# Default number of results returned by search_books
+SEARCH_LIMIT = 50
+
+# Days between catalog refreshes of each book, and days done jobs are kept
+REFRESH_DAYS = 30
+JOB_RETENTION_DAYS = 7
+
+# Open Library lookups cached in memory and in the lookups table
+book_cache = BookCache(db, fetch_book)
+
+# Background jobs run by 'flask jobs work'
+jobs = JobQueue(db)
+
+# Local copies of Open Library covers, served by the /covers routes
+cover_store = CoverStore(db, fetch_cover)
+
+# Login attempts allowed per username and per IP address
+login_limiter = RateLimiter(db, {"user": (USER_BURST, USER_RATE),
+                                 "ip": (IP_BURST, IP_RATE)})
 
 
 ######################### SQL HELPER FUNCTIONS #########################
 
+def bump_data_version(user_id=None, book_id=None):
+    """
+    Bumps the data version of a user, or of every user with a book in their
+    current or history, so their cached pages are rendered again. Called in
+    the transaction of every helper that changes what a user's pages show.
+
+    Args:
+        user_id (int): user whose data changed
+        book_id (int): book whose details changed, instead of user_id
+
+    Returns:
+        NONE
+    """
+    if book_id is None:
+        db.execute("INSERT INTO user_versions (user_id, version) " \
+                   "VALUES (?, 1) ON CONFLICT(user_id) " \
+                   "DO UPDATE SET version = version + 1", user_id)
+    else:
+        db.execute("INSERT INTO user_versions (user_id, version) " \
+                   "SELECT user_id, 1 FROM current WHERE book_id = ? " \
+                   "UNION SELECT user_id, 1 FROM history WHERE book_id = ? " \
+                   "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+                   book_id, book_id)
+
+
 def delete_from_current(book_id):
     """
     Deletes book from users current table.
@@ -33,13 +117,61 @@ def delete_from_current(book_id):
     Returns:
         NONE
     """
-    db.execute("DELETE FROM current WHERE book_id = ? AND user_id = ?",
-               book_id, session["user_id"])
+    with db.transaction():
+        db.execute("UPDATE user_stats SET current_pages = current_pages - " \
+                   "(SELECT COALESCE(SUM(page), 0) FROM current " \
+                   "WHERE book_id = ? AND user_id = ?) WHERE user_id = ?",
+                   book_id, session["user_id"], session["user_id"])
+        db.execute("DELETE FROM current WHERE book_id = ? AND user_id = ?",
+                   book_id, session["user_id"])
+        bump_data_version(session["user_id"])
+
+
+def delete_goal(goal_id):
+    """
+    Deletes one of users goals.
+
+    Args:
+        goal_id (int)
+
+    Returns:
+        bool whether the goal was found and deleted
+    """
+    with db.transaction():
+        deleted = db.execute("DELETE FROM goals WHERE id = ? AND user_id = ?",
+                             goal_id, session["user_id"])
+        bump_data_version(session["user_id"])
+    return bool(deleted)
+
+
+def compact_reading_events(before=None):
+    """
+    Rolls reading_events up into daily totals in reading_days and deletes
+    the rolled up events.
+
+    Args:
+        before (datetime date): events before this day are compacted,
+            defaults to today so todays events stay in the log
+
+    Returns:
+        int number of events compacted
+    """
+    before = before or date.today()
+    with db.transaction():
+        db.execute("INSERT INTO reading_days (user_id, book_id, day, pages) " \
+                   "SELECT user_id, book_id, day, SUM(pages_read) " \
+                   "FROM reading_events WHERE day < ? " \
+                   "GROUP BY user_id, book_id, day " \
+                   "ON CONFLICT(user_id, book_id, day) " \
+                   "DO UPDATE SET pages = pages + excluded.pages",
+                   before)
+        return db.execute("DELETE FROM reading_events WHERE day < ?", before)
 
 
 def current_to_history(book):
     """
-    Removes book from users current and inserts into users history.
+    Removes book from users current and inserts into users history, counting
+    it towards users books goal.
 
     Args:
         book (dict): contains data for book to be moved
@@ -47,16 +179,142 @@ def current_to_history(book):
     Returns:
         NONE
     """
-    start_date = str_to_datetime(book["start_date"])
+    start_date = parse_date(book["start_date"])
     end_date = date.today()
     days = (end_date - start_date).days + 1
     rate = book["pages"] / days
 
-    db.execute("INSERT INTO history " \
-               "(user_id, book_id, start_date, end_date, days, rate) " \
-               "VALUES (?, ?, ?, ?, ?, ?)",
-               session["user_id"], book["id"], start_date, end_date, days, rate)
-    delete_from_current(book["id"])
+    with db.transaction():
+        db.execute("INSERT INTO history " \
+                   "(user_id, book_id, start_date, end_date, days, rate) " \
+                   "VALUES (?, ?, ?, ?, ?, ?)",
+                   session["user_id"], book["id"], start_date, end_date, days,
+                   rate)
+        db.execute("UPDATE user_stats SET books = books + 1, " \
+                   "history_pages = history_pages + ?, " \
+                   "earliest_start = MIN(COALESCE(earliest_start, ?), ?) " \
+                   "WHERE user_id = ?",
+                   book["pages"], start_date, start_date, session["user_id"])
+        record_finished(db, session["user_id"], end_date)
+        delete_from_current(book["id"])
+
+
+def fetch_covers(payloads):
+    """
+    Fetches and resizes book covers into the cover store. Handler for
+    fetch_cover jobs.
+
+    Args:
+        payloads (list of dicts): isbn and size of each cover
+
+    Returns:
+        NONE
+
+    Raises:
+        requests.RequestException if Open Library could not be reached, so
+        the jobs are retried
+    """
+    for payload in payloads:
+        cover_store.get(payload["isbn"], payload["size"])
+
+
+def fill_placeholder_book(isbn, book):
+    """
+    Fills in a placeholder book with its looked up details. Called by the
+    background lookup worker, so doesn't use the session.
+
+    Args:
+        isbn (str)
+        book (dict): title, author and pages from Open Library, None if it
+            has no usable data for the ISBN
+
+    Returns:
+        NONE
+    """
+    with db.transaction():
+        pending = db.execute("SELECT book_id FROM pending_books " \
+                             "WHERE isbn = ? AND status != 'not_found'", isbn)
+        if not pending:
+            return
+
+        book_id = pending[0]["book_id"]
+        if book is None or not book["pages"]:
+            db.execute("UPDATE pending_books SET status = 'not_found' " \
+                       "WHERE book_id = ?", book_id)
+        else:
+            db.execute("UPDATE books SET title = ?, author = ?, pages = ? " \
+                       "WHERE id = ?",
+                       book["title"], book["author"], book["pages"], book_id)
+            db.execute("DELETE FROM pending_books WHERE book_id = ?", book_id)
+        bump_data_version(book_id=book_id)
+
+
+def import_books(isbns, user_id, target_date=None, progress=None):
+    """
+    Adds many books to a user's current table at once.
+    Known books are found with a single query, unknown books are looked up
+    together using lookup_books and everything is inserted in one
+    transaction.
+
+    Args:
+        isbns (list of str): ISBN-10s or ISBN-13s in any format to add,
+            invalid ones are skipped
+        user_id (int): user whose current table the books are added to
+        target_date (str): inserted for every book if specified
+        progress (function): called with (done, total) while looking up
+
+    Returns:
+        dict of lists of ISBNs with keys
+            added - ISBN-13s inserted into current
+            present - ISBN-13s already in current
+            invalid - ISBNs as given that aren't valid
+            not_found - ISBN-13s that could not be looked up
+    """
+    report = {"added": [], "present": [], "invalid": [], "not_found": []}
+    isbns = list(dict.fromkeys(isbns))
+    canonical = to_isbn13_many(isbns)
+    report["invalid"] = [isbn for isbn, isbn13 in zip(isbns, canonical)
+                         if isbn13 is None]
+    wanted = list(dict.fromkeys(isbn for isbn in canonical if isbn))
+
+    if not wanted:
+        return report
+
+    placeholders = ", ".join("?" * len(wanted))
+    rows = db.execute("SELECT isbn FROM books JOIN current ON id = book_id " \
+                      f"WHERE user_id = ? AND isbn IN ({placeholders})",
+                      user_id, *wanted)
+    report["present"] = [row["isbn"] for row in rows]
+    wanted = [isbn for isbn in wanted if isbn not in report["present"]]
+
+    book_ids = select_many_from_books(wanted)
+    unknown = [isbn for isbn in wanted if isbn not in book_ids]
+    looked_up = lookup_books(unknown, progress) if unknown else {}
+
+    with db.transaction():
+        for isbn in unknown:
+            if looked_up.get(isbn):
+                book = looked_up[isbn]
+                db.execute("INSERT OR IGNORE INTO books " \
+                           "(title, author, pages, isbn) VALUES (?, ?, ?, ?)",
+                           book["title"], book["author"], book["pages"], isbn)
+            else:
+                report["not_found"].append(isbn)
+
+        if unknown:
+            book_ids.update(select_many_from_books(unknown))
+
+        for isbn in wanted:
+            if isbn in book_ids:
+                db.execute("INSERT INTO current " \
+                           "(user_id, book_id, target_date) VALUES (?, ?, ?)",
+                           user_id, book_ids[isbn], target_date or None)
+                report["added"].append(isbn)
+
+        if report["added"]:
+            bump_data_version(user_id)
+
+    return report
 
 
 def insert_into_current(book_id, target_date=None):
@@ -70,12 +328,48 @@ def insert_into_current(book_id, target_date=None):
     Returns:
         NONE
     """
-    if target_date:
-        db.execute("INSERT INTO current (user_id, book_id, target_date) " \
-                   "VALUES (?, ?, ?)", session["user_id"], book_id, target_date)
-    else:
-        db.execute("INSERT INTO current (user_id, book_id) VALUES (?, ?)",
-                   session["user_id"], book_id)
+    with db.transaction():
+        if target_date:
+            db.execute("INSERT INTO current (user_id, book_id, target_date) " \
+                       "VALUES (?, ?, ?)",
+                       session["user_id"], book_id, target_date)
+        else:
+            db.execute("INSERT INTO current (user_id, book_id) VALUES (?, ?)",
+                       session["user_id"], book_id)
+        bump_data_version(session["user_id"])
+
+
+def lookup_placeholder_books(payloads):
+    """
+    Looks up placeholder books on Open Library and fills them in, skipping
+    any the lookup worker has filled in already. Handler for lookup_book
+    jobs.
+
+    Args:
+        payloads (list of dicts): isbn of each placeholder book
+
+    Returns:
+        NONE
+
+    Raises:
+        requests.RequestException if any lookup failed with a network
+        error, so the jobs are retried
+    """
+    isbns = [payload["isbn"] for payload in payloads]
+    rows = db.execute("SELECT isbn FROM pending_books WHERE isbn IN " \
+                      f"({', '.join('?' * len(isbns))}) " \
+                      "AND status != 'not_found'", *isbns)
+    isbns = [row["isbn"] for row in rows]
+    books = fetch_books(isbns) if isbns else {}
+
+    failed = [isbn for isbn in isbns if isbn not in books]
+    for isbn in isbns:
+        if isbn in books:
+            fill_placeholder_book(isbn, books[isbn])
+        else:
+            retry_placeholder_book(isbn)
+    if failed:
+        raise RequestException(f"Lookup of {len(failed)} books failed")
 
 
 def new_book(book):
@@ -93,6 +387,29 @@ def new_book(book):
                book["title"], book["author"], book["pages"], book["isbn"])
 
 
+def new_placeholder_book(isbn):
+    """
+    Inserts a placeholder row into books for a book whose details are still
+    to be looked up, titled by its ISBN with no author and 0 pages. Queues a
+    lookup_book job for it in the same transaction, so the lookup happens
+    even if the web app's lookup worker never gets to it.
+
+    Args:
+        isbn (str)
+
+    Returns:
+        int id of the new book
+    """
+    with db.transaction():
+        book_id = db.execute("INSERT INTO books (title, author, pages, isbn) " \
+                             "VALUES (?, '', 0, ?)", isbn, isbn)
+        db.execute("INSERT INTO pending_books (book_id, isbn) VALUES (?, ?)",
+                   book_id, isbn)
+        jobs.enqueue("lookup_book", {"isbn": isbn},
+                     key=f"lookup_book:{isbn}", delay=LOOKUP_JOB_DELAY)
+    return book_id
+
+
 def new_user(username, password_hash):
     """
     Inserts new row into users table.
@@ -104,8 +421,354 @@ def new_user(username, password_hash):
     Returns:
         NONE
     """
-    db.execute("INSERT INTO users (username, hash) VALUES (?, ?)",
-               username, password_hash)
+    with db.transaction():
+        user_id = db.execute("INSERT INTO users (username, hash) VALUES (?, ?)",
+                             username, password_hash)
+        db.execute("INSERT INTO user_stats (user_id) VALUES (?)", user_id)
+
+
+def pages_per_day(days=30, book_id=None):
+    """
+    Selects users pages read on each of the last days, from the daily
+    totals in reading_days and the events not yet compacted.
+
+    Args:
+        days (int): number of days up to and including today
+        book_id (int): only count this book, every book if not specified
+
+    Returns:
+        List of (datetime date, int pages) oldest first, one per day
+    """
+    first = date.today() - timedelta(days=days - 1)
+    book_filter = "AND book_id = ?" if book_id else ""
+    args = [book_id] if book_id else []
+
+    rows = db.execute("SELECT day, SUM(pages) AS pages FROM (" \
+                      "SELECT day, pages FROM reading_days " \
+                      f"WHERE user_id = ? AND day >= ? {book_filter} " \
+                      "UNION ALL SELECT day, pages_read FROM reading_events " \
+                      f"WHERE user_id = ? AND day >= ? {book_filter}) " \
+                      "GROUP BY day",
+                      session["user_id"], first, *args,
+                      session["user_id"], first, *args)
+
+    # GROUP BY on the subquery loses the DATE type
+    pages = {parse_date(row["day"]): row["pages"] for row in rows}
+    return [(first + timedelta(days=n), pages.get(first + timedelta(days=n), 0))
+            for n in range(days)]
+
+
+def rebuild_library_search():
+    """
+    Recreates every row of the library_search index from the current and
+    history tables, e.g. after a VACUUM has renumbered their rowids.
+
+    Returns:
+        NONE
+    """
+    with db.transaction():
+        db.execute("DELETE FROM library_search")
+        db.execute(f"INSERT INTO library_search {LIBRARY_SEARCH_SQL}")
+
+
+def rebuild_user_stats(user_id=None):
+    """
+    Recomputes rows in user_stats from the current and history tables.
+
+    Args:
+        user_id (int): user to rebuild, every user if not specified
+
+    Returns:
+        NONE
+    """
+    with db.transaction():
+        if user_id:
+            db.execute("INSERT OR REPLACE INTO user_stats " \
+                       f"{USER_STATS_SQL} WHERE users.id = ?", user_id)
+            # Through users, so a user_id with no users row changes nothing
+            db.execute("INSERT INTO user_versions (user_id, version) " \
+                       "SELECT id, 1 FROM users WHERE id = ? " \
+                       "ON CONFLICT(user_id) " \
+                       "DO UPDATE SET version = version + 1", user_id)
+        else:
+            db.execute("DELETE FROM user_stats")
+            db.execute(f"INSERT INTO user_stats {USER_STATS_SQL}")
+            db.execute("INSERT INTO user_versions (user_id, version) " \
+                       "SELECT id, 1 FROM users WHERE true " \
+                       "ON CONFLICT(user_id) " \
+                       "DO UPDATE SET version = version + 1")
+
+
+def refresh_books(payloads):
+    """
+    Refreshes books from Open Library, saving their subjects and publish
+    date and correcting their page count along with the history rates and
+    user_stats that depend on it. Handler for refresh_book jobs.
+
+    Args:
+        payloads (list of dicts): book_id of each book to refresh
+
+    Returns:
+        NONE
+
+    Raises:
+        requests.RequestException if Open Library could not be reached, so
+        the jobs are retried
+    """
+    book_ids = [payload["book_id"] for payload in payloads]
+    for i in range(0, len(book_ids), BATCH_SIZE):
+        batch = book_ids[i:i + BATCH_SIZE]
+        books = db.execute("SELECT id, isbn, pages FROM books WHERE id IN " \
+                           f"({', '.join('?' * len(batch))})", *batch)
+        details = fetch_details([book["isbn"] for book in books])
+
+        for book in books:
+            found = details.get(book["isbn"])
+            with db.transaction():
+                db.execute("INSERT OR REPLACE INTO book_details " \
+                           "(book_id, found, subjects, publish_date, " \
+                           "refreshed) VALUES (?, ?, ?, ?, ?)",
+                           book["id"], found is not None,
+                           found and json.dumps(found["subjects"]),
+                           found and found["publish_date"], time.time())
+                if found and found["pages"] not in (None, book["pages"]):
+                    update_book_pages(book, found["pages"])
+
+
+def retry_placeholder_book(isbn):
+    """
+    Counts a failed lookup of a placeholder book, marking it failed after
+    LOOKUP_ATTEMPTS. Called by the background lookup worker and the
+    lookup_book jobs, which retry it.
+
+    Args:
+        isbn (str)
+
+    Returns:
+        NONE
+    """
+    with db.transaction():
+        changed = db.execute("UPDATE pending_books " \
+                             "SET attempts = attempts + 1, " \
+                             "status = CASE WHEN attempts + 1 >= ? " \
+                             "THEN 'failed' ELSE status END " \
+                             "WHERE isbn = ? AND status = 'pending'",
+                             LOOKUP_ATTEMPTS, isbn)
+        pending = db.execute("SELECT book_id, status FROM pending_books " \
+                             "WHERE isbn = ?", isbn)
+        if changed and pending[0]["status"] == "failed":
+            bump_data_version(book_id=pending[0]["book_id"])
+
+
+def rollover_goals(payloads=()):
+    """
+    Rolls every user's goals, streaks and target dates over to today, see
+    goals.rollover. Handler for goal_rollover jobs.
+
+    Args:
+        payloads (list of dicts): day each job was queued for, unused as
+            rollover always catches up to today
+
+    Returns:
+        dict of numbers of goals ended, goals started, streak goals met,
+        streaks broken and target dates cleared
+    """
+    today = date.today()
+    with db.transaction():
+        db.execute("INSERT INTO user_versions (user_id, version) " \
+                   "SELECT user_id, 1 FROM goals WHERE status = 'active' " \
+                   "UNION SELECT user_id, 1 FROM reading_streaks " \
+                   "WHERE current > 0 AND last_day < ? " \
+                   "UNION SELECT user_id, 1 FROM current " \
+                   "WHERE target_date <= ? " \
+                   "ON CONFLICT(user_id) DO UPDATE SET version = version + 1",
+                   today - timedelta(days=1), today)
+        return rollover(db, today)
+
+
+def save_goal(kind, target):
+    """
+    Sets users goal of a kind, see goals.set_goal.
+
+    Args:
+        kind (str): one of goals.KINDS
+        target (int)
+
+    Returns:
+        int id of the goal
+
+    Raises:
+        ValueError if kind or target isn't valid
+    """
+    with db.transaction():
+        goal_id = set_goal(db, session["user_id"], kind, target)
+        bump_data_version(session["user_id"])
+    return goal_id
+
+
+def schedule_book_refresh(days=REFRESH_DAYS):
+    """
+    Queues a refresh_book job for every book not refreshed in the last days,
+    skipping placeholder books. Job keys stop a book being queued twice.
+
+    Args:
+        days (int)
+
+    Returns:
+        int number of jobs queued
+    """
+    books = db.execute("SELECT id FROM books " \
+                       "LEFT JOIN book_details ON id = book_id " \
+                       "WHERE (refreshed IS NULL OR refreshed < ?) " \
+                       "AND id NOT IN (SELECT book_id FROM pending_books)",
+                       time.time() - days * 24 * 60 * 60)
+    with db.transaction():
+        return sum(jobs.enqueue("refresh_book", {"book_id": book["id"]},
+                                key=f"refresh_book:{book['id']}")
+                   for book in books)
+
+
+def schedule_cover(isbn, size):
+    """
+    Queues a fetch_cover job for a book's cover at a size. The job key stops
+    a cover being queued twice.
+
+    Args:
+        isbn (str)
+        size (str): one of covers.SIZES
+
+    Returns:
+        bool whether a job was queued
+    """
+    return jobs.enqueue("fetch_cover", {"isbn": isbn, "size": size},
+                        key=f"fetch_cover:{isbn}:{size}")
+
+
+def schedule_goal_rollover():
+    """
+    Queues a goal_rollover job unless rollover has already run today. The
+    job key stops it being queued twice.
+
+    Returns:
+        bool whether a job was queued
+    """
+    today = date.today()
+    if rolled_over(db, today):
+        return False
+    return jobs.enqueue("goal_rollover", {"day": today.isoformat()},
+                        key=f"goal_rollover:{today}")
+
+
+def schedule_placeholder_lookups():
+    """
+    Queues a lookup_book job for every placeholder book still pending or
+    failed, including those whose last job was dead lettered. Job keys stop
+    a book being queued twice.
+
+    Returns:
+        int number of jobs queued
+    """
+    with db.transaction():
+        return sum(jobs.enqueue("lookup_book", {"isbn": isbn},
+                                key=f"lookup_book:{isbn}")
+                   for isbn in select_pending_books())
+
+
+def search_books(query, limit=SEARCH_LIMIT):
+    """
+    Full text search of the titles and authors of users current and history
+    books, every word matched as a prefix, best matches first by BM25 with
+    title matches weighted above author matches.
+
+    Args:
+        query (str): words as typed by the user
+        limit (int): max number of books to return
+
+    Returns:
+        List of book data dicts (empty list if none match) with
+            shelf - 'current' or 'history'
+            start_date, end_date - None if not set
+            rank - BM25 score, lower is better
+    """
+    match = search_query(query)
+    if not match:
+        return []
+
+    return db.execute("WITH matches AS (SELECT rowid, " \
+                      "bm25(library_search, 0.0, 10.0, 5.0) AS rank " \
+                      "FROM library_search WHERE library_search MATCH ? " \
+                      "ORDER BY rank LIMIT ?) " \
+                      "SELECT books.*, 'current' AS shelf, start_date, " \
+                      "NULL AS end_date, rank FROM matches " \
+                      "JOIN current ON current.rowid = matches.rowid / 2 " \
+                      "JOIN books ON books.id = book_id " \
+                      "WHERE matches.rowid % 2 = 0 UNION ALL " \
+                      "SELECT books.*, 'history' AS shelf, start_date, " \
+                      "end_date, rank FROM matches " \
+                      "JOIN history ON history.rowid = matches.rowid / 2 " \
+                      "JOIN books ON books.id = book_id " \
+                      "WHERE matches.rowid % 2 = 1 ORDER BY rank",
+                      f"owner : u{session['user_id']} AND " \
+                      f"{{title author}} : ({match})", limit)
+
+
+def select_recent_rates(books, days=ROLLING_DAYS):
+    """
+    Calculates users daily page rate over the last days for each book, from
+    reading_days and reading_events in one query.
+
+    Args:
+        books (list of dicts): current book data
+        days (int): size of the window, shortened to the days since the book
+            was started
+
+    Returns:
+        dict of book id to float pages per day
+            books without any logged reading, e.g. started before the
+            event log, are left out
+    """
+    if not books:
+        return {}
+
+    today = date.today()
+    first = today - timedelta(days=days - 1)
+    placeholders = ", ".join("?" * len(books))
+    ids = [book["id"] for book in books]
+
+    rows = db.execute("SELECT book_id, " \
+                      "SUM(CASE WHEN day >= ? THEN pages ELSE 0 END) " \
+                      "AS pages FROM (" \
+                      "SELECT book_id, day, pages FROM reading_days " \
+                      f"WHERE user_id = ? AND book_id IN ({placeholders}) " \
+                      "UNION ALL SELECT book_id, day, pages_read " \
+                      "FROM reading_events " \
+                      f"WHERE user_id = ? AND book_id IN ({placeholders})) " \
+                      "GROUP BY book_id",
+                      first, session["user_id"], *ids, session["user_id"], *ids)
+
+    start_dates = {book["id"]: book["start_date"] for book in books}
+    rates = {}
+    for row in rows:
+        start = start_dates[row["book_id"]] or today
+        window = min(days, (today - start).days + 1)
+        rates[row["book_id"]] = row["pages"] / max(window, 1)
+    return rates
+
+
+def select_data_version(user_id):
+    """
+    Returns a user's data version, bumped by bump_data_version whenever
+    their current or history changes.
+
+    Args:
+        user_id (int)
+
+    Returns:
+        int version, 0 if never bumped
+    """
+    row = db.execute("SELECT version FROM user_versions WHERE user_id = ?",
+                     user_id)
+    return row[0]["version"] if row else 0
 
 
 def select_from_books(isbn):
@@ -113,7 +776,7 @@ def select_from_books(isbn):
     Selects and returns data on a book with specific ISBN.
 
     Args:
-        isbn (str): uniquely identifies book
+        isbn (str): ISBN-13, as from to_isbn13, uniquely identifies book
 
     Returns:
         dict of book data if book in books table
@@ -156,112 +819,372 @@ def select_from_current(book_id=None, isbn=None):
                           session["user_id"])
 
 
-def select_from_history(order):
+def select_from_users(username):
+    """
+    Returns data on a user corresponding to input username.
+
+    Args:
+        username (str): unqiquely identifies user
+
+    Return:
+        dict of user data if user exists
+        None if user doesn't exist
+    """
+    user = db.execute("SELECT * FROM users WHERE username = ?", username)
+    return user[0] if user else None
+
+
+def select_goals(past=12):
+    """
+    Selects users goals and reading streak.
+
+    Args:
+        past (int): max number of ended goals returned
+
+    Returns:
+        Dict with keys
+            active - list of goal dicts, in the order of goals.KINDS
+            past - list of ended goal dicts, most recent first
+            streak - dict of current and best streak and last_day, None if
+                users never read
     """
-    Selects and returns data of books in users history table.
+    goals = db.execute("SELECT * FROM goals WHERE user_id = ? " \
+                       "AND status = 'active'", session["user_id"])
+    goals.sort(key=lambda goal: list(KINDS).index(goal["kind"]))
+    ended = db.execute("SELECT * FROM goals WHERE user_id = ? " \
+                       "AND status IN ('met', 'missed') " \
+                       "ORDER BY period_end DESC, id DESC LIMIT ?",
+                       session["user_id"], past)
+    streak = db.execute("SELECT current, best, last_day " \
+                        "FROM reading_streaks WHERE user_id = ?",
+                        session["user_id"])
+    for goal in goals + ended:
+        append_goal_progress(goal)
+
+    # A streak without reading yesterday is over, though only broken in the
+    # table by the next rollover
+    streak = streak[0] if streak else None
+    if streak and streak["last_day"] < date.today() - timedelta(days=1):
+        streak["current"] = 0
+    return {"active": goals, "past": ended,
+            "streak": streak}
+
+
+def select_current_page(after=None, size=PAGE_SIZE):
+    """
+    Selects one page of users books in current table using a keyset cursor.
 
     Args:
-        order (str): SQL command specifiying order e.g. 'end_date DESC'
+        after (str): cursor returned with the previous page, first page if
+            not specified
+        size (int): max number of books on the page
+
+    Returns:
+        List of book data dicts (empty list if no books found)
+            Books ordered by most to least recently started, not started
+            books last
+        str cursor for the next page, None if this is the last page
+    """
+    sql = "SELECT *, current.rowid AS position FROM books JOIN current " \
+          "ON id = book_id WHERE user_id = ?"
+    args = [session["user_id"]]
+
+    start_date, position = parse_cursor(after)
+    if position and start_date:
+        sql += " AND (start_date < ? OR (start_date = ? AND " \
+               "current.rowid < ?) OR start_date IS NULL)"
+        args += [start_date, start_date, position]
+    elif position:
+        sql += " AND start_date IS NULL AND current.rowid < ?"
+        args.append(position)
+
+    books = db.execute(f"{sql} ORDER BY start_date DESC, current.rowid DESC " \
+                       "LIMIT ?", *args, size + 1)
+    if len(books) > size:
+        return books[:size], make_cursor(books[size - 1], "start_date")
+    return books, None
+
+
+def select_history_with_stats(after=None, size=PAGE_SIZE):
+    """
+    Selects one page of users book history and their lifetime stats in one
+    query, paging with a keyset cursor.
+    Stats come from the user_stats summary table so cost the same however
+    many books the user has read.
+
+    Args:
+        after (str): cursor returned with the previous page, first page if
+            not specified
+        size (int): max number of books on the page
 
     Returns:
         List of book data dicts (empty list if no books found)
             Books ordered by most to least recently finished
+        Dict of lifetime stats
+            books - total books read
+            pages - total pages read, including pages of current books
+            rate - average daily pages since starting first book
+        str cursor for the next page, None if this is the last page
     """
-    return db.execute("SELECT * FROM books JOIN history ON id = book_id " \
-                      f"WHERE user_id = ? ORDER BY {order}", session["user_id"])
+    sql = "SELECT *, history.rowid AS position FROM books JOIN history " \
+          "ON id = book_id WHERE user_id = ?"
+    args = [session["user_id"]]
+
+    end_date, position = parse_cursor(after)
+    if position:
+        sql += " AND (end_date, history.rowid) < (?, ?)"
+        args += [end_date, position]
+
+    sql = f"WITH finished AS ({sql} " \
+          "ORDER BY end_date DESC, history.rowid DESC LIMIT ?) " \
+          "SELECT finished.*, user_stats.books AS total_books, " \
+          "user_stats.history_pages + user_stats.current_pages " \
+          "AS total_pages, user_stats.earliest_start " \
+          "FROM user_stats LEFT JOIN finished " \
+          "WHERE user_stats.user_id = ? " \
+          "ORDER BY finished.end_date DESC, finished.position DESC"
+    args += [size + 1, session["user_id"]]
+
+    rows = db.execute(sql, *args)
+    if not rows:
+        # No user_stats row, e.g. user added outside of new_user
+        rebuild_user_stats(session["user_id"])
+        rows = db.execute(sql, *args)
+
+    if not rows:
+        # Still none when the session's user has no users row, e.g. deleted
+        # while logged in or a cookie session outliving the database
+        return [], {"books": 0, "pages": 0, "rate": 0}, None
+
+    # Stats from user_stats are repeated on every row, with a single row of
+    # NULL book data when the user has no history
+    stats = {"books": rows[0]["total_books"], "pages": rows[0]["total_pages"]}
+    if rows[0]["earliest_start"]:
+        earliest_start = parse_date(rows[0]["earliest_start"])
+        stats["rate"] = round(calculate_rate(earliest_start, date.today(),
+                                             stats["pages"]))
+    else:
+        stats["rate"] = 0
 
+    books = [row for row in rows if row["id"] is not None]
+    if len(books) > size:
+        return books[:size], stats, make_cursor(books[size - 1], "end_date")
+    return books, stats, None
 
-def select_from_users(username):
+
+def select_many_from_books(isbns):
     """
-    Returns data on a user corresponding to input username.
+    Selects the ids of books with any of the given ISBNs in one query.
 
     Args:
-        username (str): unqiquely identifies user
+        isbns (list of str)
 
-    Return:
-        dict of user data if user exists
-        None if user doesn't exist
+    Returns:
+        dict mapping ISBN to book id for the books in the books table
     """
-    user = db.execute("SELECT * FROM users WHERE username = ?", username)
-    return user[0] if user else None
+    if not isbns:
+        return {}
 
+    placeholders = ", ".join("?" * len(isbns))
+    rows = db.execute("SELECT id, isbn FROM books " \
+                      f"WHERE isbn IN ({placeholders})", *isbns)
+    return {row["isbn"]: row["id"] for row in rows}
 
-def update_current(book_id, column, value):
+
+def select_pending_books(book_id=None):
     """
-    Update value corresponding to specific column and row in current table.
+    Selects placeholder books still waiting on a lookup.
 
     Args:
-        book_id (int): uniquely identifies with user_id row to be updated
-        column (str): column name in table of value to be updated
-        value (str or int): the new value
+        book_id (int): for the status of one book
 
     Returns:
-        NONE
+        str status of the book if book_id specified, None if it is not a
+            placeholder
+        List of ISBNs of books pending or failed otherwise, to look up again
+            by schedule_placeholder_lookups
     """
-    db.execute("UPDATE current SET ? = ? WHERE book_id = ? AND user_id = ?",
-               column, value, book_id, session["user_id"])
+    if book_id:
+        book = db.execute("SELECT status FROM pending_books WHERE book_id = ?",
+                          book_id)
+        return book[0]["status"] if book else None
+    return [book["isbn"] for book in db.execute(
+        "SELECT isbn FROM pending_books WHERE status != 'not_found'")]
 
 
-def user_books():
+def update_book_pages(book, pages):
     """
-    Calculates users total books read.
+    Corrects the page count of a book for every user, recalculating the
+    history rates and user_stats that depend on it and capping current pages
+    at the new count.
 
     Args:
-        NONE
+        book (dict): id and isbn of the book
+        pages (int): new page count
 
     Returns:
-        int of users total book count
+        NONE
     """
-    return db.execute("SELECT COUNT(*) FROM history WHERE user_id = ?",
-                      session["user_id"])[0]["COUNT(*)"]
+    with db.transaction():
+        db.execute("UPDATE books SET pages = ? WHERE id = ?", pages, book["id"])
+        db.execute("UPDATE history SET rate = ? * 1.0 / days " \
+                   "WHERE book_id = ?", pages, book["id"])
+        db.execute("UPDATE current SET page = ? WHERE book_id = ? " \
+                   "AND page > ?", pages, book["id"], pages)
+        users = db.execute("SELECT user_id FROM history WHERE book_id = ? " \
+                           "UNION SELECT user_id FROM current " \
+                           "WHERE book_id = ?", book["id"], book["id"])
+        for user in users:
+            rebuild_user_stats(user["user_id"])
+    book_cache.invalidate(book["isbn"])
 
 
-def user_pages():
+def update_current(book_id, column, value):
     """
-    Calculates users total pages read.
+    Update value corresponding to specific column and row in current table.
 
     Args:
-        NONE
+        book_id (int): uniquely identifies with user_id row to be updated
+        column (str): column name in table of value to be updated, one of
+            CURRENT_COLUMNS
+        value (str or int): the new value
 
     Returns:
-        int of users total page count
+        NONE
+
+    Raises:
+        ValueError if column is not in CURRENT_COLUMNS
     """
-    history_pages = db.execute("SELECT SUM(pages) FROM books JOIN history " \
-                               "ON id = book_id WHERE user_id = ?",
-                               session["user_id"])[0]["SUM(pages)"]
-    if history_pages is None:
-        history_pages = 0
+    if column not in CURRENT_COLUMNS:
+        raise ValueError(f"Can't update column {column!r} of current")
+
+    with db.transaction():
+        if column == "page":
+            db.execute("UPDATE user_stats " \
+                       "SET current_pages = current_pages + " \
+                       "(SELECT COALESCE(SUM(? - page), 0) FROM current " \
+                       "WHERE book_id = ? AND user_id = ?) WHERE user_id = ?",
+                       value, book_id, session["user_id"], session["user_id"])
+        db.execute(f"UPDATE current SET {column} = ? " \
+                   "WHERE book_id = ? AND user_id = ?",
+                   value, book_id, session["user_id"])
+        bump_data_version(session["user_id"])
+
+
+def update_progress(book, page):
+    """
+    Updates users current page for a book, setting the start date to today
+    if it is the first update, and logs the update in reading_events.
+
+    Args:
+        book (dict): current book data, from select_from_current
+        page (int): the new page number
 
-    current_pages = db.execute("SELECT SUM(page) FROM books JOIN current " \
-                               "ON id = book_id WHERE user_id = ?",
-                               session["user_id"])[0]["SUM(page)"]
-    if current_pages is None:
-        current_pages = 0
+    Returns:
+        NONE
 
-    return current_pages + history_pages
+    Raises:
+        ValueError if the page is out of range, see update_progress_many
+    """
+    update_progress_many({book["id"]: page})
 
 
-def user_rate(pages):
+def update_progress_many(pages):
     """
-    Calculates users average daily pages since starting their first book.
+    Updates users current page for many books in one transaction, as
+    update_progress does for one. Every book is checked before any changes,
+    then all of them are changed by one statement per table: the pages and
+    any missing start dates in current, the events in reading_events and the
+    page total in user_stats. The pages read count towards users goals.
 
     Args:
-        pages (int): users total page count
+        pages (dict): book id to new page number, from 0 to the book's pages
 
     Returns:
-        int of users daily page rate rounded to nearest int
-    """
-    books = select_from_history("start_date ASC")
-    if len(books) == 0:
-        return 0
+        list of dicts of the updated books, as from select_from_current
 
-    # Books ordered by start date so first is earliest
-    earliest_start = str_to_datetime(books[0]["start_date"])
+    Raises:
+        ValueError if a book isn't in users current, is still being looked
+            up or the page is out of range, and nothing is changed
+    """
+    user_id = session["user_id"]
+    today = date.today()
+    ids = list(pages)
+    placeholders = ", ".join("?" * len(ids))
+    values = ", ".join(["(?, ?)"] * len(ids))
+    updates = [value for item in pages.items() for value in item]
+
+    with db.transaction():
+        books = {book["id"]: book for book in
+                 db.execute("SELECT * FROM books JOIN current " \
+                            "ON id = book_id WHERE user_id = ? " \
+                            f"AND id IN ({placeholders})", user_id, *ids)}
+        for book_id, page in pages.items():
+            if book_id not in books:
+                raise ValueError(f"Book {book_id} is not in current")
+            if not books[book_id]["pages"]:
+                raise ValueError(f"Book {book_id} is still being looked up")
+            if not 0 <= page <= books[book_id]["pages"]:
+                raise ValueError(f"Page of book {book_id} must be from 0 to "
+                                 f"{books[book_id]['pages']}")
+
+        now = time.time()
+        db.execute("INSERT INTO reading_events " \
+                   "(user_id, book_id, day, page, pages_read, created) " \
+                   f"VALUES {', '.join(['(?, ?, ?, ?, ?, ?)'] * len(ids))}",
+                   *[value for book_id, page in pages.items()
+                     for value in (user_id, book_id, today, page,
+                                   page - books[book_id]["page"], now)])
+        read = sum(page - books[book_id]["page"]
+                   for book_id, page in pages.items())
+        db.execute("UPDATE user_stats " \
+                   "SET current_pages = current_pages + ? WHERE user_id = ?",
+                   read, user_id)
+        record_reading(db, user_id, today, read)
+        db.execute("UPDATE current SET page = updates.column2, " \
+                   "start_date = COALESCE(start_date, ?) " \
+                   f"FROM (VALUES {values}) AS updates " \
+                   "WHERE user_id = ? AND book_id = updates.column1",
+                   today, *updates, user_id)
+        bump_data_version(user_id)
+
+        return db.execute("SELECT * FROM books JOIN current " \
+                          "ON id = book_id WHERE user_id = ? " \
+                          f"AND id IN ({placeholders})", user_id, *ids)
+
+
+def update_user_hash(user_id, password_hash):
+    """Replaces a user's password hash, e.g. after raising the hash cost."""
+    db.execute("UPDATE users SET hash = ? WHERE id = ?", password_hash,
+               user_id)
+
+
+def verify_user_stats():
+    """
+    Compares user_stats with stats recomputed from the current and history
+    tables.
 
-    # +1 to count current day as whole day
-    days = (date.today() - earliest_start).days + 1
+    Args:
+        NONE
 
-    return round(pages / days)
+    Returns:
+        List of dicts for users whose stats have drifted, each with user_id
+        and the stored and expected values of every column that differs
+    """
+    stored = {row["user_id"]: row
+              for row in db.execute("SELECT * FROM user_stats")}
+    drift = []
+    for expected in db.execute(USER_STATS_SQL):
+        # MIN() loses the DATE column type so comes back as a string
+        if expected["earliest_start"]:
+            expected["earliest_start"] = parse_date(expected["earliest_start"])
+        row = stored.get(expected["user_id"], {})
+        columns = {column: {"stored": row.get(column), "expected": value}
+                   for column, value in expected.items()
+                   if column != "user_id" and row.get(column) != value}
+        if columns:
+            drift.append({"user_id": expected["user_id"], **columns})
+    return drift
 
 
 ######################## OTHER HELPER FUNCTIONS ########################
@@ -282,24 +1205,44 @@ def append_progress(book):
         book["progress"] = None
 
 
-def calculate_date(pages, rate):
+def append_goal_progress(goal):
     """
-    Calculates date to read a number of pages at a given rate starting tomorrow.
+    Adds the description of a goal and its progress as a percentage of its
+    target, at most 100.
 
     Args:
-        pages (int): pages left read
-        rate (float): pages read per day rate
+        goal (dict): goal data from the goals table
 
     Returns:
-        date string in nice format e.g. Sat 15 Aug 2020
+        NONE
     """
-    days = (pages / rate)
-    if days.is_integer():
-        days = int(days)
-    else:
-        days = int(days) + 1
-    end_date = date.today() + timedelta(days=days)
-    return end_date.strftime("%a %e %b %Y")
+    goal["description"] = KINDS[goal["kind"]]
+    goal["percent"] = min(100, max(0, round(goal["progress"] /
+                                            goal["target"] * 100)))
+
+
+def book_projections(book):
+    """
+    Calculates the daily page rates and completion dates shown on the book
+    dashboard, see projections.project_books.
+
+    Args:
+        book (dict): current book data, with datetime dates
+
+    Returns:
+        Dict of rates
+            current - pages per day over the last ROLLING_DAYS, or since
+                starting if no reading was logged, None if not started
+            target - pages per day needed from tomorrow to finish on the
+                target date, None if no target or target reached
+        Dict of datetime dates
+            current - completion date at the current rate, None if not
+                started or no pages read yet
+            15min, 30min, 1hour - completion dates at READING_RATES
+            tomorrow - earliest allowed target date
+    """
+    return project_books([book],
+                         recent_rates=select_recent_rates([book]))[0]
 
 
 def calculate_rate(start_date, end_date, pages):
@@ -322,6 +1265,7 @@ def lookup_book(isbn):
     """
     Looks up data on book identified by ISBN using Open Library API.
     https://openlibrary.org/dev/docs/api/books
+    Results, including books not found, are cached by book_cache.
 
     Args:
         isbn (str)
@@ -330,79 +1274,115 @@ def lookup_book(isbn):
         dict containing title, author and number of pages for the book
         None if an error is encountered
     """
-    try:
-        response = requests.get("https://openlibrary.org/api/books?" \
-                                f"bibkeys=ISBN:{isbn}&format=json&jscmd=data")
-        response.raise_for_status()
-    except requests.RequestException:
-        return None
+    return book_cache.get(isbn)
 
-    try:
-        data = response.json()[f"ISBN:{isbn}"]
-        return {
-            "title": data["title"],
-            "author": data["authors"][0]["name"],
-            "pages": data["number_of_pages"],
-            "isbn": isbn
-        }
-    except (KeyError, TypeError, ValueError):
-        return None
 
+def lookup_books(isbns, progress=None):
+    """
+    Looks up data on many books using the Open Library API, sending the ISBNs
+    not already in book_cache in concurrent multi bibkey requests.
 
-def reformat_date(dictionary, key):
+    Args:
+        isbns (list of str)
+        progress (function): called with (done, total) after each request
+
+    Returns:
+        dict mapping each ISBN to a dict of title, author, number of pages
+        and isbn, or to None if the book could not be found
     """
-    Reformats date into a nicer format. e.g. Sat 15 Aug 2020
+    return book_cache.get_many(isbns, fetch_books, progress)
+
+
+def make_cursor(book, key):
+    """
+    Makes a keyset cursor pointing just after a book in a paged list.
 
     Args:
-        dictionary (dict): contains date to be reformated
-        key (str): key name of date to reformat
+        book (dict): last book on the page, with a position key
+        key (str): key name of the date the list is ordered by
 
     Returns:
-        NONE
+        str cursor e.g. '2020-08-15.12'
     """
-    if dictionary[key]:
-        # Needs to be datetime type to use .strftime
-        dictionary[key] = str_to_datetime(dictionary[key])
-        dictionary[key] = dictionary[key].strftime("%a %e %b %Y")
+    return f"{book[key] or ''}.{book['position']}"
 
 
-def str_to_datetime(str_date):
+def page_size(size):
     """
-    Converts string date into datetime date format.
+    Reads a requested page size, keeping it between 1 and MAX_PAGE_SIZE.
 
     Args:
-        str_date (str): of form 'YYYY-MM-DD'
+        size (str): from the request args, may be None
 
     Returns:
-        same date in datetime date form
+        int page size, PAGE_SIZE if size is missing or not an integer
     """
-    list_date = str_date.split("-")
-    return date(int(list_date[0]), int(list_date[1]), int(list_date[2]))
+    try:
+        return min(max(int(size), 1), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
 
 
-def valid_isbn(isbn):
+def parse_cursor(cursor):
     """
-    Performs checksum on input ISBN-13 number.
+    Splits a keyset cursor made by make_cursor.
 
     Args:
-        isbn (str)
+        cursor (str): may be None
 
     Returns:
-        True if input a valid ISBN-13
-        False if input not a valid ISBN-13
+        (date str or None, int position)
+        (None, None) if cursor is missing or invalid
     """
     try:
-        # Calculate check_sum (x_0 + 3x_1 + x_2 + 3x_3 + ...)
-        check_sum = 0
-        for i, digit in enumerate(isbn):
-            if i % 2 == 0:
-                check_sum += int(digit)
-            else:
-                check_sum += int(digit) * 3
+        date_part, position = cursor.rsplit(".", 1)
+        return date_part or None, int(position)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def parse_isbns(text):
+    """
+    Extracts ISBNs from pasted text or an uploaded CSV export.
+    Goodreads style exports are read from their ISBN13 column, or their ISBN
+    column for rows without an ISBN-13, any other text is split on
+    whitespace and commas. ISBNs are returned as found, see to_isbn13.
+
+    Args:
+        text (str)
+
+    Returns:
+        list of ISBN strings in the order found
+    """
+    lines = text.strip().splitlines()
+    header = next(csv.reader(lines[:1]), [])
+    columns = [name for name in ["ISBN13", "ISBN"] if name in header]
+
+    # Goodreads wraps ISBNs as ="9780141036144"
+    def unwrap(value):
+        return (value or "").strip('="\' ')
+
+    if columns:
+        values = [next((unwrap(row[column]) for column in columns
+                        if unwrap(row[column])), "")
+                  for row in csv.DictReader(lines)]
+    else:
+        values = [unwrap(value) for value in re.split(r"[\s,;]+", text)]
+    return [isbn for isbn in values if isbn]
+
+
+def search_query(query):
+    """
+    Turns text typed into a search box into an FTS5 query matching every
+    word as a prefix, e.g. 'harry pot' becomes '"harry"* "pot"*'.
+    Quoting each word stops FTS5 syntax in the text being interpreted.
+
+    Args:
+        query (str): may be None
+
+    Returns:
+        str FTS5 query, empty if there are no words to search for
+    """
+    words = re.findall(r"\w+", query or "")
+    return " ".join(f'"{word}"*' for word in words)
 
-        if check_sum % 10 == 0 and len(isbn) == 13:
-            return True
-        else:
-            return False
-    except (TypeError, ValueError):
-        return False
@@ -0,0 +1,437 @@
+""" Request instrumentation for Bootra
+
+Opt-in timings of where each request spends its time: every SQL statement
+run through Database.execute (with its normalised text and row count), every
+HTTP call made through a requests session, such as Open Library lookups, and
+every template render.
+
+The totals are kept in memory and served in the Prometheus text format at
+/metrics. Each response gets a Server-Timing header, and with DEBUG_PANEL on
+HTML pages get a panel listing the request's statements, calls and
+templates. A sample of requests is run under cProfile and the profiles of
+the slowest are kept for /debug/profiles.
+
+Metrics and profiles are per process, so with several server workers each
+one reports only the requests it served. Instrumentation adds a little work
+to every statement, so it is off unless the app turns it on.
+
+/metrics and /debug/profiles are only served to requests bearing the
+configured token, or when there is none to requests from this machine
+that did not come through a proxy.
+Profiles record request paths without their query strings, which can hold
+other users' search terms.
+
+SECTIONS:
+    - Config
+    - Metrics
+    - Instrumentation
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import cProfile
+import heapq
+import hmac
+import io
+import itertools
+import pstats
+import random
+import re
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+from flask import (Response, abort, before_render_template, current_app, g,
+                   has_request_context, request, template_rendered)
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Fraction of requests run under cProfile, and number of the slowest
+# profiles kept
+PROFILE_SAMPLE = 0.1
+PROFILE_SLOWEST = 10
+
+# Functions listed per profile
+PROFILE_LINES = 40
+
+# Addresses allowed to read /metrics and /debug/profiles without a token
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+# Headers a proxy adds, marking a local request as one relayed from elsewhere
+PROXY_HEADERS = ("Forwarded", "X-Forwarded-For", "X-Real-IP")
+
+# Metric name to (type, help), in the order they are served
+METRICS = {
+    "bootra_request_seconds": ("histogram", "Request latency by endpoint."),
+    "bootra_request_queries": ("counter",
+                               "SQL statements run by requests by endpoint."),
+    "bootra_sql_seconds": ("summary", "SQL statement time by statement."),
+    "bootra_sql_rows": ("counter",
+                        "Rows returned or changed by statement."),
+    "bootra_http_seconds": ("summary",
+                            "Outgoing HTTP call time to response headers by "
+                            "host and status."),
+    "bootra_template_seconds": ("summary",
+                                "Template render time by template."),
+    "bootra_page_cache_requests": ("counter",
+                                   "Page cache hits, misses and skips by "
+                                   "endpoint."),
+    "bootra_book_cache_lookups": ("counter",
+                                  "Open Library lookups by book cache "
+                                  "result."),
+    "bootra_book_cache_fetch_seconds": ("counter",
+                                        "Time spent fetching book cache "
+                                        "misses.")
+}
+
+# Book cache stats served as bootra_book_cache_lookups results
+BOOK_CACHE_RESULTS = ("memory_hits", "disk_hits", "misses", "errors",
+                      "coalesced")
+
+# Literals and IN lists folded together when normalising statements
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(sql):
+    """
+    Returns a statement with its literals replaced by ? and IN lists of
+    placeholders folded to (...), so statements differing only in values
+    are counted together.
+    """
+    sql = LITERALS.sub("?", SPACES.sub(" ", sql.strip()))
+    return IN_LIST.sub("(...)", sql)
+
+
+##################################### METRICS #################################
+
+class Metrics:
+    """
+    Thread safe in memory metrics, rendered in the Prometheus text format.
+
+    Each series is a metric name and a tuple of (label, value) pairs, with a
+    count and sum and, for histograms, counts per bucket.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        Args:
+            buckets (tuple of float): upper bounds of histogram buckets
+        """
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        """
+        Records one observation of a value, or adds it to a counter.
+
+        Args:
+            name (str): one of METRICS
+            labels (dict): label name to value
+            value (float)
+
+        Returns:
+            NONE
+        """
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                buckets = [0] * len(self.buckets) \
+                    if METRICS[name][0] == "histogram" else None
+                series = self._series[key] = [0, 0.0, buckets]
+            series[0] += 1
+            series[1] += value
+            if series[2] is not None:
+                for n, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        series[2][n] += 1
+
+    def set(self, name, labels, total):
+        """
+        Sets a counter to a total kept elsewhere, such as the book cache's.
+
+        Args:
+            name (str): one of METRICS, a counter
+            labels (dict): label name to value
+            total (float)
+
+        Returns:
+            NONE
+        """
+        with self._lock:
+            self._series[(name, tuple(labels.items()))] = [1, total, None]
+
+    def render(self):
+        """Returns all series in the Prometheus text exposition format."""
+        with self._lock:
+            series = {key: (count, total, buckets and list(buckets))
+                      for key, (count, total, buckets) in self._series.items()}
+
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                count, total, buckets = series[key]
+                labels = key[1]
+                if kind == "counter":
+                    lines.append(f"{name}_total{format_labels(labels)} "
+                                 f"{total:g}")
+                    continue
+                if kind == "histogram":
+                    for bound, hits in zip(self.buckets, buckets):
+                        lines.append(f"{name}_bucket"
+                                     f"{format_labels(labels, le=bound)} "
+                                     f"{hits}")
+                    lines.append(f"{name}_bucket"
+                                 f"{format_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels, **extra):
+    """Returns labels as {name="value",...}, escaped for Prometheus."""
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+               .replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value
+                          in zip(pairs, escaped)) + "}"
+
+
+################################ INSTRUMENTATION ##############################
+
+class Instrumentation:
+    """
+    Hooks timing into a Flask app, its database and requests sessions.
+
+    Attributes:
+        metrics (Metrics): totals since the app started
+        profiles (list): (seconds, n, method, path, report) of the slowest
+            profiled requests, a min heap on seconds
+        token (str): bearer token for /metrics and /debug/profiles, None
+            to serve them to unproxied LOCAL_ADDRESSES only
+        book_cache (BookCache): cache whose stats are served in /metrics
+    """
+
+    def __init__(self, app, db, sessions=(), profile_sample=PROFILE_SAMPLE,
+                 profile_slowest=PROFILE_SLOWEST, token=None,
+                 book_cache=None):
+        """
+        Adds the hooks and the /metrics and /debug/profiles routes.
+
+        Args:
+            app (Flask): DEBUG_PANEL in its config turns the HTML panel on,
+                defaults to app.debug
+            db (Database)
+            sessions (list of requests.Session): sessions to time calls of
+            profile_sample (float): fraction of requests run under cProfile
+            profile_slowest (int): number of the slowest profiles kept
+            token (str): see class attributes
+            book_cache (BookCache): see class attributes
+        """
+        self.metrics = Metrics()
+        self.profiles = []
+        self.token = token
+        self.book_cache = book_cache
+        self.profile_sample = profile_sample
+        self.profile_slowest = profile_slowest
+        self._count = itertools.count()
+        self._lock = threading.Lock()
+
+        app.config.setdefault("DEBUG_PANEL", app.debug)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.rendered, app)
+        app.add_url_rule("/metrics", "metrics", self.serve_metrics)
+        app.add_url_rule("/debug/profiles", "profiles", self.serve_profiles)
+        self.panel = app.jinja_env.get_template("debug_panel.html")
+
+        db.observers.append(self.query)
+        for session in sessions:
+            session.hooks["response"].append(self.response)
+
+    def after_request(self, response):
+        """Records the request's timings and adds them to the response."""
+        trace = g.pop("trace", None)
+        if trace is None:
+            return response
+        seconds = time.perf_counter() - trace["start"]
+        if trace["profile"] is not None:
+            trace["profile"].disable()
+            self.keep_profile(trace["profile"], seconds)
+
+        endpoint = request.endpoint or "unmatched"
+        self.metrics.observe("bootra_request_seconds", {"endpoint": endpoint},
+                             seconds)
+        self.metrics.observe("bootra_request_queries", {"endpoint": endpoint},
+                             len(trace["queries"]))
+        page_cache = g.pop("page_cache", None)
+        if page_cache is not None:
+            self.metrics.observe("bootra_page_cache_requests",
+                                 {"endpoint": endpoint, "result": page_cache},
+                                 1)
+
+        totals = {part: sum(item["seconds"] for item in trace[part])
+                  for part in ("queries", "calls", "templates")}
+        response.headers["Server-Timing"] = ", ".join(
+            [f"sql;dur={totals['queries'] * 1000:.2f};"
+             f"desc=\"{len(trace['queries'])} queries\"",
+             f"http;dur={totals['calls'] * 1000:.2f}",
+             f"tpl;dur={totals['templates'] * 1000:.2f}",
+             f"total;dur={seconds * 1000:.2f}"]
+            + ([f"cache;desc=\"{page_cache}\""] if page_cache else []))
+
+        if current_app.config["DEBUG_PANEL"] \
+                and response.mimetype == "text/html" \
+                and not response.direct_passthrough:
+            self.add_panel(response, trace, totals, seconds)
+        return response
+
+    def add_panel(self, response, trace, totals, seconds):
+        """Adds the debug panel before the end of an HTML page's body."""
+        statements = {}
+        for query in trace["queries"]:
+            statement = statements.setdefault(
+                query["sql"], {"sql": query["sql"], "count": 0, "rows": 0,
+                               "seconds": 0.0})
+            statement["count"] += 1
+            statement["rows"] += query["rows"]
+            statement["seconds"] += query["seconds"]
+        panel = self.panel.render(
+            seconds=seconds, totals=totals, calls=trace["calls"],
+            templates=trace["templates"],
+            statements=sorted(statements.values(),
+                              key=lambda statement: -statement["seconds"]),
+            other=seconds - sum(totals.values()))
+
+        page = response.get_data(as_text=True)
+        end = page.rfind("</body>")
+        if end == -1:
+            end = len(page)
+        response.set_data(page[:end] + panel + page[end:])
+
+    def before_render(self, app, template, context):
+        """Notes when a template starts rendering."""
+        if "trace" in g:
+            g.trace["rendering"].append(time.perf_counter())
+
+    def before_request(self):
+        """Starts the request's trace, under cProfile for a sample."""
+        profile = None
+        if random.random() < self.profile_sample:
+            profile = cProfile.Profile()
+        g.trace = {"start": time.perf_counter(), "queries": [], "calls": [],
+                   "templates": [], "rendering": [], "profile": profile}
+        if profile is not None:
+            profile.enable()
+
+    def keep_profile(self, profile, seconds):
+        """Keeps a request's profile if it is among the slowest."""
+        with self._lock:
+            if len(self.profiles) >= self.profile_slowest \
+                    and seconds <= self.profiles[0][0]:
+                return
+
+        report = io.StringIO()
+        pstats.Stats(profile, stream=report).sort_stats("cumulative") \
+            .print_stats(PROFILE_LINES)
+        entry = (seconds, next(self._count), request.method, request.path,
+                 report.getvalue())
+        with self._lock:
+            if len(self.profiles) < self.profile_slowest:
+                heapq.heappush(self.profiles, entry)
+            elif seconds > self.profiles[0][0]:
+                heapq.heapreplace(self.profiles, entry)
+
+    def query(self, sql, seconds, rows):
+        """Database observer, records one statement."""
+        sql = normalize_sql(sql)
+        self.metrics.observe("bootra_sql_seconds", {"statement": sql}, seconds)
+        self.metrics.observe("bootra_sql_rows", {"statement": sql}, rows)
+        if has_request_context() and "trace" in g:
+            g.trace["queries"].append({"sql": sql, "seconds": seconds,
+                                       "rows": rows})
+
+    def rendered(self, app, template, context):
+        """Records a template render."""
+        if "trace" not in g or not g.trace["rendering"]:
+            return
+        seconds = time.perf_counter() - g.trace["rendering"].pop()
+        name = template.name or "string"
+        self.metrics.observe("bootra_template_seconds", {"template": name},
+                             seconds)
+        g.trace["templates"].append({"name": name, "seconds": seconds})
+
+    def response(self, response, *args, **kwargs):
+        """requests response hook, records one HTTP call."""
+        seconds = response.elapsed.total_seconds()
+        url = urlsplit(response.url)
+        self.metrics.observe("bootra_http_seconds",
+                             {"host": url.netloc,
+                              "status": response.status_code}, seconds)
+        if has_request_context() and "trace" in g:
+            g.trace["calls"].append({"method": response.request.method,
+                                     "url": f"{url.netloc}{url.path}",
+                                     "status": response.status_code,
+                                     "seconds": seconds})
+
+    def teardown_request(self, error=None):
+        """Stops profiling requests that raised before after_request."""
+        trace = g.pop("trace", None)
+        if trace is not None and trace["profile"] is not None:
+            trace["profile"].disable()
+
+    def authorize(self):
+        """
+        Aborts with 404 unless the request bears the token, or when there is
+        no token comes from LOCAL_ADDRESSES without any PROXY_HEADERS.
+        """
+        if self.token is None:
+            allowed = (request.remote_addr in LOCAL_ADDRESSES and
+                       not any(name in request.headers
+                               for name in PROXY_HEADERS))
+        else:
+            header = request.headers.get("Authorization", "")
+            allowed = hmac.compare_digest(header.encode(),
+                                          f"Bearer {self.token}".encode())
+        if not allowed:
+            abort(404)
+
+    def serve_metrics(self):
+        """GET /metrics, the metrics in the Prometheus text format."""
+        self.authorize()
+        if self.book_cache is not None:
+            stats = self.book_cache.snapshot()
+            for result in BOOK_CACHE_RESULTS:
+                self.metrics.set("bootra_book_cache_lookups",
+                                 {"result": result}, stats[result])
+            self.metrics.set("bootra_book_cache_fetch_seconds", {},
+                             stats["fetch_seconds"])
+        return Response(self.metrics.render(),
+                        mimetype="text/plain; version=0.0.4")
+
+    def serve_profiles(self):
+        """GET /debug/profiles, the slowest profiled requests, slowest first."""
+        self.authorize()
+        with self._lock:
+            profiles = sorted(self.profiles, reverse=True)
+        text = "\n".join(f"{'=' * 79}\n{method} {path} "
+                         f"{seconds * 1000:.1f} ms\n{report}"
+                         for seconds, _, method, path, report in profiles)
+        return Response(text or "No requests profiled yet.\n",
+                        mimetype="text/plain")
@@ -0,0 +1,224 @@
+""" ISBN handling for Bootra
+
+Reads ISBNs however they are typed or exported: ISBN-10 or ISBN-13, with or
+without hyphens, spaces or an "ISBN" label, and with a lower case x as the
+ISBN-10 check digit. Every valid ISBN is keyed by its ISBN-13, so the same
+edition entered either way is one row in books.
+
+to_isbn13_many checks a whole import file at once, with each group of ISBNs
+of one length turned into a NumPy array of digits and checked in a few
+array operations rather than digit by digit.
+
+SECTIONS:
+    - Config
+    - ISBN Functions
+    - Bulk Functions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import re
+
+import numpy as np
+
+# Characters dropped from ISBNs: whitespace and the hyphens, dashes and dots
+# used to separate their parts
+SEPARATORS = re.compile(r"[\s\-.\u2010-\u2014]")
+
+# "ISBN", "ISBN:", "ISBN-10:" or "ISBN-13:" labels in front of ISBNs
+LABEL = re.compile(r"^ISBN(-?1[03])?:?")
+
+# ISBN-13s are EAN-13s in these prefixes. Only 978 has ISBN-10 equivalents
+PREFIXES = ("978", "979")
+
+WEIGHTS_10 = np.arange(10, 0, -1)
+WEIGHTS_13 = np.array([1, 3] * 6 + [1])
+
+# Sum of the weighted 978 prefix, to convert ISBN-10s without it
+PREFIX_SUM = 9 * 1 + 7 * 3 + 8 * 1
+
+
+################################# ISBN FUNCTIONS ##############################
+
+def clean_isbn(text):
+    """
+    Strips the separators and any label from an ISBN and upper cases its X.
+    Doesn't check it is valid.
+
+    Args:
+        text (str): may be None
+
+    Returns:
+        str e.g. "030640615X" from "ISBN 0-306-40615-x"
+    """
+    if not isinstance(text, str):
+        return ""
+    if text.isdigit():
+        return text
+    isbn = text.strip().upper()
+    if isbn.startswith("ISBN"):
+        isbn = LABEL.sub("", isbn)
+    # Plain hyphens and spaces are by far the most common, and quicker to
+    # replace than to match
+    isbn = isbn.replace("-", "").replace(" ", "")
+    return isbn if isbn.isalnum() else SEPARATORS.sub("", isbn)
+
+
+def to_isbn10(text):
+    """
+    Converts an ISBN to its ISBN-10.
+
+    Args:
+        text (str): ISBN-10 or ISBN-13 in any format
+
+    Returns:
+        str ISBN-10
+        None if not a valid ISBN or a 979 ISBN-13, which have no ISBN-10
+    """
+    isbn = to_isbn13(text)
+    if isbn is None or not isbn.startswith("978"):
+        return None
+    body = isbn[3:12]
+    check = -sum(int(digit) * weight
+                 for digit, weight in zip(body, range(10, 1, -1))) % 11
+    return body + ("X" if check == 10 else str(check))
+
+
+def to_isbn13(text):
+    """
+    Converts an ISBN to its ISBN-13, the key books are stored by.
+
+    Args:
+        text (str): ISBN-10 or ISBN-13 in any format, may be None
+
+    Returns:
+        str ISBN-13 of 13 digits
+        None if not a valid ISBN
+    """
+    isbn = clean_isbn(text)
+    if not isbn.isascii():
+        return None
+    if len(isbn) == 13 and isbn.isdigit() and isbn[:3] in PREFIXES:
+        odd, even = map(int, isbn[::2]), map(int, isbn[1::2])
+        if (sum(odd) + 3 * sum(even)) % 10 == 0:
+            return isbn
+    elif len(isbn) == 10 and isbn[:9].isdigit() \
+            and (isbn[9].isdigit() or isbn[9] == "X"):
+        digits = [int(digit) for digit in isbn[:9]]
+        digits.append(10 if isbn[9] == "X" else int(isbn[9]))
+        if sum(digit * weight for digit, weight
+               in zip(digits, range(10, 0, -1))) % 11 == 0:
+            body = "978" + isbn[:9]
+            return body + str(_check_digit_13(digits[:9]))
+    return None
+
+
+def valid_isbn(text):
+    """
+    Checks an ISBN-10 or ISBN-13 in any format against its check digit.
+
+    Args:
+        text (str): may be None
+
+    Returns:
+        True if a valid ISBN
+        False if not
+    """
+    return to_isbn13(text) is not None
+
+
+def _check_digit_13(digits):
+    """Returns the ISBN-13 check digit of the 978 prefix and 9 digits."""
+    total = PREFIX_SUM + sum(digit * (1 if i % 2 else 3)
+                             for i, digit in enumerate(digits))
+    return -total % 10
+
+
+################################# BULK FUNCTIONS ##############################
+
+def to_isbn13_many(texts):
+    """
+    Converts many ISBNs to their ISBN-13s at once, as to_isbn13.
+
+    Args:
+        texts (list of str): ISBN-10s and ISBN-13s in any format
+
+    Returns:
+        list with the ISBN-13 of each, or None where not a valid ISBN
+    """
+    cleaned = [clean_isbn(text) for text in texts]
+    result = [None] * len(cleaned)
+
+    rows = [i for i, isbn in enumerate(cleaned) if len(isbn) == 13]
+    if rows:
+        valid = _valid_13(_digits([cleaned[i] for i in rows], 13))
+        for i, ok in zip(rows, valid.tolist()):
+            if ok:
+                result[i] = cleaned[i]
+
+    rows = [i for i, isbn in enumerate(cleaned) if len(isbn) == 10]
+    if rows:
+        isbns = _convert_10(_digits([cleaned[i] for i in rows], 10))
+        for i, isbn in zip(rows, isbns):
+            result[i] = isbn
+    return result
+
+
+def valid_isbns(texts):
+    """
+    Checks many ISBNs at once, as valid_isbn.
+
+    Args:
+        texts (list of str): ISBN-10s and ISBN-13s in any format
+
+    Returns:
+        bool array, True where a valid ISBN
+    """
+    return np.array([isbn is not None for isbn in to_isbn13_many(texts)],
+                    dtype=bool)
+
+
+def _convert_10(digits):
+    """
+    Returns the ISBN-13 of each row of ISBN-10 digits, None where invalid.
+    An X check digit is 10, any other character is out of range.
+    """
+    digits[:, 9] = np.where(digits[:, 9] == ord("X") - ord("0"), 10,
+                            digits[:, 9])
+    valid = (digits[:, :9] <= 9).all(axis=1) & (digits[:, 9] <= 10) \
+        & ((digits @ WEIGHTS_10) % 11 == 0)
+
+    isbns = np.empty((len(digits), 13), dtype=np.uint8)
+    isbns[:, :3] = [9, 7, 8]
+    isbns[:, 3:12] = digits[:, :9]
+    isbns[:, 12] = -(PREFIX_SUM + digits[:, :9] @ WEIGHTS_13[3:12]) % 10
+    return _strings(isbns, valid)
+
+
+def _valid_13(digits):
+    """Returns a bool array, True where a row of ISBN-13 digits is valid."""
+    prefix = digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2]
+    return (digits <= 9).all(axis=1) \
+        & np.isin(prefix, [int(prefix) for prefix in PREFIXES]) \
+        & ((digits @ WEIGHTS_13) % 10 == 0)
+
+
+def _digits(isbns, length):
+    """
+    Returns ISBNs of one length as an array with a row of digits each.
+    Characters other than digits come out above 9.
+    """
+    data = "".join(isbns).encode("ascii", "replace")
+    codes = np.frombuffer(data, dtype=np.uint8).reshape(-1, length)
+    return codes.astype(np.int64) - ord("0") & 0xFF
+
+
+def _strings(digits, valid):
+    """Returns rows of digits as strings, None where not valid."""
+    length = digits.shape[1]
+    digits = np.where(valid[:, None], digits, 0).astype(np.uint8)
+    text = (digits + ord("0")).tobytes().decode("ascii")
+    return [text[i * length:(i + 1) * length] if ok else None
+            for i, ok in enumerate(valid.tolist())]
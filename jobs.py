@@ -0,0 +1,248 @@
+""" Durable job queue for Bootra
+
+SQLite backed queue for work that runs outside of requests, such as catalog
+refreshes. Jobs are rows in the jobs table, so they survive restarts and
+can be queued by the web app and run by a separate worker process started
+with 'flask jobs work'.
+
+A job claimed by a worker is leased for a while and becomes claimable again
+if the worker dies before finishing it. Failed jobs are retried with
+backoff and moved to the dead letter status after max_attempts. A job key
+can be given to make queueing idempotent, a key is only queued once until
+its job has finished.
+
+SECTIONS:
+    - Config
+    - Job Queue
+    - Worker
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import json
+import logging
+import time
+
+# Attempts before a job is dead lettered, and retry delays in seconds of
+# RETRY_BASE * 2 ** (attempts - 1) up to RETRY_CAP
+MAX_ATTEMPTS = 5
+RETRY_BASE = 60
+RETRY_CAP = 6 * 60 * 60
+
+# Seconds a claimed job is leased to its worker
+LEASE = 5 * 60
+
+# Worker defaults: jobs claimed per batch, min seconds between batches,
+# seconds to wait when idle and seconds between scheduled runs
+BATCH = 50
+INTERVAL = 1.0
+POLL = 5.0
+SCHEDULE_EVERY = 60 * 60
+
+log = logging.getLogger(__name__)
+
+
+################################### JOB QUEUE #################################
+
+class JobQueue:
+    """
+    Queue of jobs stored in the jobs table.
+
+    A job has a kind naming its handler, a JSON payload and one of the
+    statuses queued, running, done or dead. run_at is when a queued job is
+    due and when a running job's lease runs out.
+    """
+
+    def __init__(self, db, max_attempts=MAX_ATTEMPTS):
+        """
+        Args:
+            db: database with execute(sql, *args) and transaction() methods
+            max_attempts (int): attempts before a job is dead lettered
+        """
+        self.db = db
+        self.max_attempts = max_attempts
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs " \
+                        "(id INTEGER PRIMARY KEY NOT NULL, " \
+                        "kind TEXT NOT NULL, key TEXT, " \
+                        "payload TEXT NOT NULL, " \
+                        "status TEXT NOT NULL DEFAULT 'queued', " \
+                        "attempts INTEGER NOT NULL DEFAULT 0, " \
+                        "run_at REAL NOT NULL, error TEXT, " \
+                        "created REAL NOT NULL, updated REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_kind_status_run " \
+                        "ON jobs (kind, status, run_at)")
+        # A key can only be queued again once its last job has finished
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_key " \
+                        "ON jobs (key) WHERE status IN ('queued', 'running')")
+
+    def claim(self, kind, limit=1, lease=LEASE):
+        """
+        Claims jobs of a kind that are due to run, oldest first, including
+        running jobs whose lease has run out.
+
+        Args:
+            kind (str)
+            limit (int): max number of jobs to claim
+            lease (float): seconds the jobs are leased for
+
+        Returns:
+            List of job dicts with payload decoded, may be empty
+        """
+        now = time.time()
+        with self.db.transaction():
+            jobs = self.db.execute("SELECT * FROM jobs WHERE kind = ? " \
+                                   "AND status IN ('queued', 'running') " \
+                                   "AND run_at <= ? ORDER BY run_at LIMIT ?",
+                                   kind, now, limit)
+            for job in jobs:
+                job["attempts"] += 1
+                job["payload"] = json.loads(job["payload"])
+                self.db.execute("UPDATE jobs SET status = 'running', " \
+                                "attempts = ?, run_at = ?, updated = ? " \
+                                "WHERE id = ?",
+                                job["attempts"], now + lease, now, job["id"])
+        return jobs
+
+    def complete(self, jobs):
+        """Marks claimed jobs as done."""
+        with self.db.transaction():
+            for job in jobs:
+                self.db.execute("UPDATE jobs SET status = 'done', " \
+                                "error = NULL, updated = ? WHERE id = ?",
+                                time.time(), job["id"])
+
+    def counts(self):
+        """Returns a list of dicts of kind, status and number of jobs."""
+        return self.db.execute("SELECT kind, status, COUNT(*) AS jobs " \
+                               "FROM jobs GROUP BY kind, status " \
+                               "ORDER BY kind, status")
+
+    def dead(self):
+        """Returns a list of dead lettered jobs, most recent first."""
+        return self.db.execute("SELECT id, kind, key, attempts, error " \
+                               "FROM jobs WHERE status = 'dead' " \
+                               "ORDER BY updated DESC")
+
+    def enqueue(self, kind, payload, key=None, delay=0):
+        """
+        Adds a job to the queue.
+
+        Args:
+            kind (str): name of the handler to run it
+            payload: JSON serialisable data for the handler
+            key (str): if given, the job is not added while another job with
+                the same key is queued or running
+            delay (float): seconds before the job is due to run
+
+        Returns:
+            bool whether the job was added
+        """
+        now = time.time()
+        self.db.execute("INSERT OR IGNORE INTO jobs " \
+                        "(kind, key, payload, run_at, created, updated) " \
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        kind, key, json.dumps(payload), now + delay, now, now)
+        return self.db.execute("SELECT changes() AS added")[0]["added"] == 1
+
+    def fail(self, jobs, error):
+        """
+        Records that claimed jobs failed, queueing them to run again after
+        a backoff or dead lettering them after max_attempts.
+
+        Args:
+            jobs (list of dicts): jobs returned by claim
+            error (str): reason they failed
+
+        Returns:
+            NONE
+        """
+        now = time.time()
+        with self.db.transaction():
+            for job in jobs:
+                if job["attempts"] >= self.max_attempts:
+                    status, run_at = "dead", now
+                else:
+                    status = "queued"
+                    run_at = now + min(RETRY_CAP,
+                                       RETRY_BASE * 2 ** (job["attempts"] - 1))
+                self.db.execute("UPDATE jobs SET status = ?, run_at = ?, " \
+                                "error = ?, updated = ? WHERE id = ?",
+                                status, run_at, str(error), now, job["id"])
+
+    def prune(self, age):
+        """
+        Deletes done jobs last updated more than age seconds ago.
+
+        Returns:
+            int number of jobs deleted
+        """
+        return self.db.execute("DELETE FROM jobs WHERE status = 'done' " \
+                               "AND updated < ?", time.time() - age)
+
+    def retry(self, job_id):
+        """
+        Queues a dead lettered job to run again with its attempts reset.
+
+        Returns:
+            bool whether the job was dead lettered and is now queued
+        """
+        now = time.time()
+        return bool(self.db.execute("UPDATE OR IGNORE jobs " \
+                                    "SET status = 'queued', attempts = 0, " \
+                                    "run_at = ?, updated = ? " \
+                                    "WHERE id = ? AND status = 'dead'",
+                                    now, now, job_id))
+
+
+##################################### WORKER ##################################
+
+def work(queue, handlers, schedules=(), batch=BATCH, interval=INTERVAL,
+         once=False):
+    """
+    Runs queued jobs until interrupted, claiming up to batch jobs of a kind at
+    a time and handing them to its handler together, at most one batch per
+    interval seconds.
+
+    Args:
+        queue (JobQueue)
+        handlers (dict): job kind to function taking a list of payloads,
+            a job batch fails as a whole if its handler raises
+        schedules (list of functions): called when the worker starts and
+            every SCHEDULE_EVERY seconds, e.g. to queue periodic jobs
+        batch (int): max jobs per handler call
+        interval (float): min seconds between batches
+        once (bool): stop when no jobs are due instead of waiting for more
+
+    Returns:
+        NONE
+    """
+    scheduled = None
+    while True:
+        if scheduled is None or time.monotonic() - scheduled >= SCHEDULE_EVERY:
+            scheduled = time.monotonic()
+            for schedule in schedules:
+                schedule()
+
+        busy = False
+        for kind, handler in handlers.items():
+            jobs = queue.claim(kind, batch)
+            if not jobs:
+                continue
+
+            busy = True
+            try:
+                handler([job["payload"] for job in jobs])
+            except Exception as error:
+                log.exception("%d %s jobs failed", len(jobs), kind)
+                queue.fail(jobs, repr(error))
+            else:
+                queue.complete(jobs)
+            time.sleep(interval)
+
+        if not busy:
+            if once:
+                return
+            time.sleep(POLL)
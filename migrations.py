@@ -0,0 +1,443 @@
+""" Schema migrations for Bootra
+
+The schema is built by the numbered migrations in MIGRATIONS, applied in
+order by migrate. The number of the last one applied is kept in the
+database's user_version, so an empty file gets the whole schema and an
+existing database only the migrations it is missing. Databases from before
+migrations (user_version 0) already have some of the tables, which is why
+the early migrations only create what isn't there.
+
+Migrations are never edited once released, changes to the schema go in a
+new migration at the end of MIGRATIONS.
+
+Tables private to one component, such as jobs, lookups, covers, rate_limits
+and sessions, are still created by that component.
+
+explain and full_scans check the query plans of the statements the app runs,
+see 'flask db check' in application.py.
+
+SECTIONS:
+    - Config
+    - Migrations
+    - Runner
+    - Query Plans
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import re
+
+from contextlib import contextmanager
+
+# Lifetime stats for each user recomputed from the current and history tables,
+# used to build and verify the user_stats summary table
+USER_STATS_SQL = "SELECT users.id AS user_id, " \
+                 "(SELECT COUNT(*) FROM history " \
+                 "WHERE user_id = users.id) AS books, " \
+                 "(SELECT COALESCE(SUM(pages), 0) FROM books JOIN history " \
+                 "ON books.id = book_id WHERE user_id = users.id) " \
+                 "AS history_pages, " \
+                 "(SELECT COALESCE(SUM(page), 0) FROM books JOIN current " \
+                 "ON books.id = book_id WHERE user_id = users.id) " \
+                 "AS current_pages, " \
+                 "(SELECT MIN(start_date) FROM history " \
+                 "WHERE user_id = users.id) AS earliest_start " \
+                 "FROM users"
+
+# Rows of library_search rebuilt from the current and history tables
+LIBRARY_SEARCH_SQL = "(rowid, owner, title, author) " \
+                     "SELECT current.rowid * 2, 'u' || user_id, title, " \
+                     "author FROM current JOIN books ON id = book_id " \
+                     "UNION ALL SELECT history.rowid * 2 + 1, " \
+                     "'u' || user_id, title, author " \
+                     "FROM history JOIN books ON id = book_id"
+
+# Plan steps reading a whole table or index, the table name as group 1
+SCAN_STEP = re.compile(r"^SCAN (\w+)(?! VIRTUAL TABLE)")
+
+
+################################## MIGRATIONS #################################
+
+def create_library(db):
+    """Creates the users, books, current and history tables."""
+    db.execute("CREATE TABLE IF NOT EXISTS users " \
+               "(id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, " \
+               "username VARCHAR(27) NOT NULL, hash NOT NULL)")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS username " \
+               "ON users (username)")
+    db.execute("CREATE TABLE IF NOT EXISTS books " \
+               "(id INTEGER PRIMARY KEY NOT NULL, title TEXT NOT NULL, " \
+               "author TEXT NOT NULL, pages INTEGER NOT NULL, " \
+               "isbn CHAR(13))")
+    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS isbn ON books (isbn)")
+    db.execute("CREATE TABLE IF NOT EXISTS current " \
+               "(user_id INTEGER NOT NULL, book_id INTEGER NOT NULL, " \
+               "target_date DATE DEFAULT NULL, " \
+               "start_date DATE DEFAULT NULL, " \
+               "page INTEGER NOT NULL DEFAULT 0, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id), " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+    db.execute("CREATE INDEX IF NOT EXISTS current_user_id " \
+               "ON current (user_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS current_book_id " \
+               "ON current (book_id)")
+    db.execute("CREATE TABLE IF NOT EXISTS history " \
+               "(user_id INTEGER NOT NULL, book_id INTEGER NOT NULL, " \
+               "start_date DATE NOT NULL, end_date DATE NOT NULL, " \
+               "rate NUMERIC, days INTEGER, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id), " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+    db.execute("CREATE INDEX IF NOT EXISTS history_book_id " \
+               "ON history (book_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS history_user_id " \
+               "ON history (user_id)")
+
+
+def create_user_stats(db):
+    """
+    Creates user_stats, kept up to date by every helper that changes current
+    or history, and the indexes for paging through current and history most
+    recent first.
+    """
+    if not db.execute("SELECT name FROM sqlite_master " \
+                      "WHERE name = 'user_stats'"):
+        db.execute("CREATE TABLE user_stats " \
+                   "(user_id INTEGER PRIMARY KEY NOT NULL, " \
+                   "books INTEGER NOT NULL DEFAULT 0, " \
+                   "history_pages INTEGER NOT NULL DEFAULT 0, " \
+                   "current_pages INTEGER NOT NULL DEFAULT 0, " \
+                   "earliest_start DATE DEFAULT NULL, " \
+                   "FOREIGN KEY(user_id) REFERENCES users(id))")
+        db.execute(f"INSERT INTO user_stats {USER_STATS_SQL}")
+    db.execute("CREATE INDEX IF NOT EXISTS current_user_start " \
+               "ON current (user_id, start_date)")
+    db.execute("CREATE INDEX IF NOT EXISTS history_user_end " \
+               "ON history (user_id, end_date)")
+
+
+def create_reading_log(db):
+    """
+    Creates reading_events, where every page update is logged, and
+    reading_days, which compact_reading_events rolls the events up into as
+    one row per user, book and day.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS reading_events " \
+               "(user_id INTEGER NOT NULL, book_id INTEGER NOT NULL, " \
+               "day DATE NOT NULL, page INTEGER NOT NULL, " \
+               "pages_read INTEGER NOT NULL, created REAL NOT NULL, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id), " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+    db.execute("CREATE INDEX IF NOT EXISTS reading_events_user_book_day " \
+               "ON reading_events (user_id, book_id, day)")
+    db.execute("CREATE TABLE IF NOT EXISTS reading_days " \
+               "(user_id INTEGER NOT NULL, book_id INTEGER NOT NULL, " \
+               "day DATE NOT NULL, pages INTEGER NOT NULL, " \
+               "PRIMARY KEY(user_id, book_id, day), " \
+               "FOREIGN KEY(user_id) REFERENCES users(id), " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+
+
+def create_pending_books(db):
+    """
+    Creates pending_books, the placeholder books added before their details
+    were looked up, with status pending, failed (network errors) or
+    not_found.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS pending_books " \
+               "(book_id INTEGER PRIMARY KEY NOT NULL, " \
+               "isbn CHAR(13) NOT NULL, " \
+               "status TEXT NOT NULL DEFAULT 'pending', " \
+               "attempts INTEGER NOT NULL DEFAULT 0, " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+
+
+def create_library_search(db):
+    """
+    Creates library_search, the full text index of the titles and authors of
+    the books in each users current and history, for search_books. Every row
+    is tagged with its owner as a 'u<user id>' token, so a search only walks
+    that users rows however big the books catalog is. Row ids are current
+    rowid * 2 for current rows and history rowid * 2 + 1 for history rows,
+    and triggers keep the index in sync as books are added, moved, removed
+    and looked up.
+    """
+    if db.execute("SELECT name FROM sqlite_master " \
+                  "WHERE name = 'library_search'"):
+        return
+
+    db.execute("CREATE VIRTUAL TABLE library_search USING fts5" \
+               "(owner, title, author, prefix = '2 3', " \
+               "tokenize = 'unicode61 remove_diacritics 2')")
+    for table, offset in [("current", 0), ("history", 1)]:
+        db.execute(f"CREATE TRIGGER {table}_search_insert " \
+                   f"AFTER INSERT ON {table} " \
+                   "BEGIN INSERT INTO library_search " \
+                   "(rowid, owner, title, author) " \
+                   f"SELECT new.rowid * 2 + {offset}, " \
+                   "'u' || new.user_id, title, author FROM books " \
+                   "WHERE id = new.book_id; END")
+        db.execute(f"CREATE TRIGGER {table}_search_delete " \
+                   f"AFTER DELETE ON {table} " \
+                   "BEGIN DELETE FROM library_search " \
+                   f"WHERE rowid = old.rowid * 2 + {offset}; END")
+    db.execute("CREATE TRIGGER books_search_update " \
+               "AFTER UPDATE OF title, author ON books " \
+               "BEGIN UPDATE library_search " \
+               "SET title = new.title, author = new.author " \
+               "WHERE rowid IN (SELECT rowid * 2 FROM current " \
+               "WHERE book_id = new.id UNION ALL " \
+               "SELECT rowid * 2 + 1 FROM history " \
+               "WHERE book_id = new.id); END")
+    db.execute(f"INSERT INTO library_search {LIBRARY_SEARCH_SQL}")
+
+
+def create_book_details(db):
+    """
+    Creates book_details, the catalog details from the last refresh of each
+    book, subjects as a JSON list.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS book_details " \
+               "(book_id INTEGER PRIMARY KEY NOT NULL, " \
+               "found INTEGER NOT NULL, subjects TEXT, publish_date TEXT, " \
+               "refreshed REAL NOT NULL, " \
+               "FOREIGN KEY(book_id) REFERENCES books(id))")
+
+
+def index_hot_queries(db):
+    """
+    Makes each book appear at most once in a user's current, and replaces
+    the single column user indexes with ones that cover the lookups and
+    sums the pages run on every request:
+
+        current_user_book (user_id, book_id): unique, finds a user's book by
+            id, or by ISBN after finding its id, and covers joining a
+            user's current to books
+        history_user_book (user_id, book_id): covers joining a user's
+            history to books, for USER_STATS_SQL
+        pending_books_isbn (isbn, status): looking up placeholders by ISBN
+
+    current_user_start and history_user_end already serve the paging by date,
+    and lead with user_id, so current_user_id and history_user_id go.
+
+    Duplicate current rows, which nothing stopped before, are merged into
+    the one with the most pages read.
+    """
+    duplicates = db.execute("DELETE FROM current WHERE rowid NOT IN " \
+                            "(SELECT rowid FROM (SELECT rowid, " \
+                            "ROW_NUMBER() OVER (PARTITION BY user_id, " \
+                            "book_id ORDER BY page DESC, rowid) AS n " \
+                            "FROM current) WHERE n = 1)")
+    if duplicates:
+        db.execute("DELETE FROM user_stats")
+        db.execute(f"INSERT INTO user_stats {USER_STATS_SQL}")
+
+    db.execute("CREATE UNIQUE INDEX current_user_book " \
+               "ON current (user_id, book_id)")
+    db.execute("CREATE INDEX history_user_book ON history (user_id, book_id)")
+    db.execute("CREATE INDEX pending_books_isbn " \
+               "ON pending_books (isbn, status)")
+    db.execute("DROP INDEX IF EXISTS current_user_id")
+    db.execute("DROP INDEX IF EXISTS history_user_id")
+
+
+def create_user_versions(db):
+    """
+    Creates user_versions, a number per user bumped whenever their current or
+    history changes, which keys the page cache.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS user_versions " \
+               "(user_id INTEGER PRIMARY KEY NOT NULL, " \
+               "version INTEGER NOT NULL DEFAULT 0, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id))")
+
+
+def create_goals(db):
+    """
+    Creates the tables of goals.py:
+
+        goals: each user's goals, one row per period, with status active,
+            met or missed. Streak goals have no period_end until met
+        reading_streaks: each user's current and best streak of days with
+            reading, and the last of those days
+        goal_rollovers: the days rollover has run, with what it changed
+
+    Streaks are filled in from the reading log, the current streak being
+    the run of days up to the last day read. rollover breaks it if that was
+    before yesterday.
+    """
+    db.execute("CREATE TABLE goals " \
+               "(id INTEGER PRIMARY KEY NOT NULL, " \
+               "user_id INTEGER NOT NULL, kind TEXT NOT NULL, " \
+               "target INTEGER NOT NULL, " \
+               "progress INTEGER NOT NULL DEFAULT 0, " \
+               "status TEXT NOT NULL DEFAULT 'active', " \
+               "period_start DATE NOT NULL, period_end DATE, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id))")
+    db.execute("CREATE INDEX goals_user_status " \
+               "ON goals (user_id, status, kind)")
+    db.execute("CREATE INDEX goals_status_end ON goals (status, period_end)")
+
+    db.execute("CREATE TABLE reading_streaks " \
+               "(user_id INTEGER PRIMARY KEY NOT NULL, " \
+               "current INTEGER NOT NULL, best INTEGER NOT NULL, " \
+               "last_day DATE NOT NULL, " \
+               "FOREIGN KEY(user_id) REFERENCES users(id))")
+    db.execute("WITH days AS (SELECT user_id, day FROM " \
+               "(SELECT user_id, day, pages FROM reading_days " \
+               "UNION ALL SELECT user_id, day, pages_read " \
+               "FROM reading_events) " \
+               "GROUP BY user_id, day HAVING SUM(pages) > 0), " \
+               "runs AS (SELECT user_id, COUNT(*) AS length, " \
+               "MAX(day) AS last_day FROM (SELECT user_id, day, " \
+               "julianday(day) - ROW_NUMBER() OVER (PARTITION BY user_id " \
+               "ORDER BY day) AS run FROM days) GROUP BY user_id, run) " \
+               "INSERT INTO reading_streaks " \
+               "(user_id, current, best, last_day) " \
+               "SELECT user_id, length, best, MAX(last_day) " \
+               "FROM (SELECT *, MAX(length) OVER (PARTITION BY user_id) " \
+               "AS best FROM runs) GROUP BY user_id")
+
+    db.execute("CREATE TABLE goal_rollovers " \
+               "(day DATE PRIMARY KEY NOT NULL, counts TEXT NOT NULL)")
+
+
+def index_history_start(db):
+    """
+    Indexes history by (user_id, start_date), so exports read a user's
+    history oldest first straight from the index, like current_user_start
+    does for current, instead of sorting all of it before the first row.
+    """
+    db.execute("CREATE INDEX history_user_start " \
+               "ON history (user_id, start_date)")
+
+
+# In order, the database's user_version is the number of migrations applied
+MIGRATIONS = [
+    create_library,
+    create_user_stats,
+    create_reading_log,
+    create_pending_books,
+    create_library_search,
+    create_book_details,
+    index_hot_queries,
+    create_user_versions,
+    create_goals,
+    index_history_start
+]
+
+
+#################################### RUNNER ###################################
+
+def migrate(db, target=None):
+    """
+    Applies the migrations the database is missing, each in its own
+    transaction along with the user_version it brings the database to, so
+    a failed migration leaves the database as it was and processes starting
+    at the same time don't apply one twice.
+
+    Args:
+        db (Database)
+        target (int): version to stop at, the latest if not specified
+
+    Returns:
+        list of int versions applied
+    """
+    target = len(MIGRATIONS) if target is None else target
+    if schema_version(db) >= target:
+        return []
+
+    applied = []
+    for version, migration in enumerate(MIGRATIONS[:target], 1):
+        with db.transaction():
+            if schema_version(db) >= version:
+                continue
+            migration(db)
+            db.execute(f"PRAGMA user_version = {version}")
+        applied.append(version)
+    return applied
+
+
+def pending_migrations(db):
+    """
+    Returns:
+        list of (int version, str name) of migrations not yet applied
+    """
+    return [(version, migration.__name__) for version, migration
+            in enumerate(MIGRATIONS, 1) if version > schema_version(db)]
+
+
+def schema_version(db):
+    """Returns the number of migrations applied to the database."""
+    return db.execute("PRAGMA user_version")[0]["user_version"]
+
+
+################################## QUERY PLANS ################################
+
+def explain(db, sql):
+    """
+    Returns the query plan of a statement, with NULL for every placeholder.
+
+    Args:
+        db (Database)
+        sql (str)
+
+    Returns:
+        list of str plan steps, indented by depth
+    """
+    rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", *[None] * sql.count("?"))
+    depth = {0: -1}
+    steps = []
+    for row in rows:
+        depth[row["id"]] = depth.get(row["parent"], -1) + 1
+        steps.append("  " * depth[row["id"]] + row["detail"])
+    return steps
+
+
+def full_scans(db, plan):
+    """
+    Returns the tables a query plan reads in full, either the table itself
+    or a whole index of it. Scans of subqueries, CTEs and full text indexes
+    aren't counted.
+
+    Args:
+        db (Database)
+        plan (list of str): steps from explain
+
+    Returns:
+        list of str table names
+    """
+    tables = {row["name"] for row in db.execute("SELECT name " \
+                                                "FROM sqlite_master " \
+                                                "WHERE type = 'table'")}
+    scans = []
+    for step in plan:
+        match = SCAN_STEP.match(step.strip())
+        if match and match.group(1) in tables:
+            scans.append(match.group(1))
+    return scans
+
+
+@contextmanager
+def recording(db):
+    """
+    Records the distinct statements run on the database in the with block.
+
+    Usage:
+        with recording(db) as statements:
+            ...
+
+    Yields:
+        dict of str SQL to int number of times run, in order first run
+    """
+    statements = {}
+
+    def record(sql, seconds, rows):
+        statements[sql] = statements.get(sql, 0) + 1
+
+    db.observers.append(record)
+    try:
+        yield statements
+    finally:
+        db.observers.remove(record)
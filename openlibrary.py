@@ -0,0 +1,347 @@
+""" Open Library client for Bootra
+
+Wraps the Open Library books API used to look up book info by ISBN.
+https://openlibrary.org/dev/docs/api/books
+
+Covers come from the Open Library covers API.
+https://openlibrary.org/dev/docs/api/covers
+
+The base URLs can be pointed at a local stub server by setting the
+OPENLIBRARY_URL and OPENLIBRARY_COVERS_URL environment variables (see
+bench/stub_openlibrary.py).
+
+fetch_book_async is the asyncio version used by background lookups. It
+retries with jittered backoff and stops calling the API for a while after
+repeated failures, so an outage doesn't pile up waiting lookups. It is
+thread backed rather than a native asyncio client: each request is a
+blocking requests call on a pool of its own, limited by TIMEOUT.
+
+SECTIONS:
+    - Config
+    - Lookup Functions
+    - Async Lookup Functions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import asyncio
+import os
+import random
+import requests
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL = os.environ.get("OPENLIBRARY_URL", "https://openlibrary.org")
+COVERS_URL = os.environ.get("OPENLIBRARY_COVERS_URL",
+                            "https://covers.openlibrary.org")
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 10)
+
+# Bibkeys per request and concurrent requests for bulk lookups
+BATCH_SIZE = 50
+WORKERS = 4
+
+# Max subjects kept from a book's details
+SUBJECTS = 10
+
+# One keep-alive session shared by every lookup, retrying transient errors
+http = requests.Session()
+http.mount("http://", HTTPAdapter(pool_maxsize=WORKERS, max_retries=Retry(
+    total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))))
+http.mount("https://", http.get_adapter("http://"))
+
+# Attempts per async lookup, with backoff between them of up to
+# BACKOFF_BASE * 2 ** attempt seconds, capped at BACKOFF_CAP
+ATTEMPTS = 3
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8
+
+# Failed requests in a row that open the circuit, and seconds it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+
+# Session for async lookups, which do their own retries, and the threads
+# their requests run on. A slow Open Library ties up these threads alone,
+# never the event loop's default pool
+async_http = requests.Session()
+async_http.mount("http://", HTTPAdapter(pool_maxsize=WORKERS))
+async_http.mount("https://", async_http.get_adapter("http://"))
+async_pool = ThreadPoolExecutor(WORKERS, thread_name_prefix="openlibrary")
+
+
+class CircuitOpen(requests.RequestException):
+    """Raised instead of calling the API while the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Counts failed requests in a row. After threshold failures the circuit
+    opens and calls are refused for cooldown seconds, then one trial call is
+    let through each cooldown until one succeeds and closes it again.
+
+    Attributes:
+        threshold (int): failures in a row that open the circuit
+        cooldown (float): seconds to refuse calls for once open
+        failures (int): failures in a row so far
+        opened (float): time.monotonic() the circuit last opened or let a
+            trial call through, None while closed
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        """
+        Args:
+            threshold (int): failures in a row that open the circuit
+            cooldown (float): seconds to refuse calls for once open
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns whether a call may be made now."""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened >= self.cooldown:
+                self.opened = time.monotonic()
+                return True
+            return False
+
+    def record(self, success):
+        """Records the outcome of a call, opening or closing the circuit."""
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened = time.monotonic()
+
+
+breaker = CircuitBreaker()
+
+
+############################### LOOKUP FUNCTIONS ##############################
+
+def fetch_book(isbn, session=http):
+    """
+    Fetches data on book identified by ISBN from the Open Library API.
+
+    Args:
+        isbn (str)
+        session (requests.Session): defaults to the shared retrying session
+
+    Returns:
+        dict containing title, author and number of pages for the book
+        None if Open Library has no usable data for the ISBN
+
+    Raises:
+        requests.RequestException if the API could not be reached, so that
+        network errors are not mistaken for a missing book
+    """
+    response = session.get(f"{API_URL}/api/books",
+                           params={"bibkeys": f"ISBN:{isbn}",
+                                   "format": "json", "jscmd": "data"},
+                           timeout=TIMEOUT)
+    response.raise_for_status()
+
+    try:
+        return parse_book(response.json().get(f"ISBN:{isbn}"), isbn)
+    except ValueError:
+        return None
+
+
+def fetch_books(isbns, progress=None):
+    """
+    Fetches data on many books at once using the multi bibkey form of the
+    Open Library API, with up to WORKERS requests of BATCH_SIZE ISBNs in
+    flight over the shared keep-alive session.
+
+    Args:
+        isbns (list of str)
+        progress (function): called with (done, total) after each batch
+
+    Returns:
+        dict mapping every ISBN to its book dict, or to None if not found
+        ISBNs in batches that failed with a network error are left out
+    """
+    batches = [isbns[i:i + BATCH_SIZE]
+               for i in range(0, len(isbns), BATCH_SIZE)]
+    books = {}
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = {pool.submit(_fetch_batch, batch, parse_book): batch
+                   for batch in batches}
+        for future in as_completed(futures):
+            try:
+                books.update(future.result())
+            except requests.RequestException:
+                pass
+            done += len(futures[future])
+            if progress:
+                progress(done, len(isbns))
+
+    return books
+
+
+def fetch_cover(isbn):
+    """
+    Fetches the largest cover image Open Library has for a book.
+
+    Args:
+        isbn (str)
+
+    Returns:
+        (bytes, str) image data and its mimetype
+        None if Open Library has no cover for the ISBN
+
+    Raises:
+        requests.RequestException if the API could not be reached
+    """
+    response = http.get(f"{COVERS_URL}/b/isbn/{isbn}-L.jpg",
+                        params={"default": "false"}, timeout=TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.content, response.headers.get("Content-Type",
+                                                  "image/jpeg")
+
+
+def fetch_details(isbns):
+    """
+    Fetches the catalog details used to refresh stored books, in one multi
+    bibkey request.
+
+    Args:
+        isbns (list of str): at most BATCH_SIZE
+
+    Returns:
+        dict mapping every ISBN to its details dict, see parse_details, or
+        to None if not found
+
+    Raises:
+        requests.RequestException if the API could not be reached
+    """
+    return _fetch_batch(isbns, parse_details)
+
+
+def _fetch_batch(isbns, parse):
+    """Fetches one multi bibkey request parsing each record with parse."""
+    bibkeys = ",".join(f"ISBN:{isbn}" for isbn in isbns)
+    response = http.get(f"{API_URL}/api/books",
+                        params={"bibkeys": bibkeys, "format": "json",
+                                "jscmd": "data"},
+                        timeout=TIMEOUT)
+    response.raise_for_status()
+
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    return {isbn: parse(data.get(f"ISBN:{isbn}"), isbn) for isbn in isbns}
+
+
+def parse_book(data, isbn):
+    """
+    Picks the fields Bootra stores out of an Open Library book record.
+
+    Args:
+        data (dict): book record from the API, may be None
+        isbn (str)
+
+    Returns:
+        dict containing title, author, number of pages and isbn
+        None if any field is missing
+    """
+    try:
+        return {
+            "title": data["title"],
+            "author": data["authors"][0]["name"],
+            "pages": data["number_of_pages"],
+            "isbn": isbn
+        }
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def parse_details(data, isbn):
+    """
+    Picks the catalog details out of an Open Library book record.
+
+    Args:
+        data (dict): book record from the API, may be None
+        isbn (str)
+
+    Returns:
+        dict containing pages (None if missing), up to SUBJECTS subject
+        names, publish date as given by Open Library (None if missing) and
+        isbn
+        None if the record is missing
+    """
+    if not isinstance(data, dict):
+        return None
+    pages = data.get("number_of_pages")
+    return {
+        "pages": pages if type(pages) is int and pages > 0 else None,
+        "subjects": [subject["name"] for subject in data.get("subjects", [])
+                     if isinstance(subject, dict) and "name" in subject
+                     ][:SUBJECTS],
+        "publish_date": data.get("publish_date"),
+        "isbn": isbn
+    }
+
+
+############################ ASYNC LOOKUP FUNCTIONS ###########################
+
+def backoff(attempt):
+    """Returns a random 'full jitter' delay in seconds before a retry."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+async def fetch_book_async(isbn, attempts=ATTEMPTS):
+    """
+    Fetches data on book identified by ISBN without blocking the event loop,
+    retrying network errors with jittered backoff through the circuit
+    breaker.
+    Thread backed, requests has no asyncio interface: each attempt runs
+    the blocking fetch_book on async_pool. The requests connect and read
+    timeouts are the only limit on an attempt, the coroutine is never
+    abandoned while its thread carries on.
+
+    Args:
+        isbn (str)
+        attempts (int): max number of requests to make
+
+    Returns:
+        dict containing title, author and number of pages for the book
+        None if Open Library has no usable data for the ISBN
+
+    Raises:
+        CircuitOpen if the API has been failing and is not being called
+        requests.RequestException if every attempt failed
+    """
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise CircuitOpen(f"Open Library unavailable, skipped ISBN:{isbn}")
+        try:
+            book = await asyncio.get_running_loop().run_in_executor(
+                async_pool, fetch_book, isbn, async_http)
+        except requests.RequestException:
+            breaker.record(False)
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(backoff(attempt))
+        else:
+            breaker.record(True)
+            return book
@@ -0,0 +1,216 @@
+""" Rendered page cache for Bootra
+
+Keeps the rendered responses of a user's pages, so viewing a page again
+costs one query for the user's data version instead of rebuilding it.
+
+Pages are keyed by user, data version, day and URL. Every helper that
+changes what a user's pages show bumps their data version in the same
+transaction, so a page is never served from before a change. Projections
+count days from today, so each page is also rendered again on its first view
+of the day. Old pages are never invalidated, they are just no longer asked
+for and fall out of the store.
+
+Pages aren't served from the cache while the session holds flashed messages,
+and aren't stored when the view changed the session, e.g. by flashing.
+
+Stores, picked with the BOOTRA_PAGE_CACHE environment variable:
+
+    memory: the default. An LRU of up to MEMORY_BYTES in each process.
+    sqlite: a SQLite file shared by the worker processes on one machine.
+    off: no caching.
+
+SECTIONS:
+    - Config
+    - Page Cache
+    - Stores
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import date
+from flask import Response, g, request, session
+
+from database import Database
+
+STORES = ("memory", "sqlite", "off")
+
+# Endpoints whose GET responses are cached
+ENDPOINTS = ("index", "current_page", "history", "history_page", "book",
+             "forecast", "goals")
+
+# Bytes of pages kept in memory by each process
+MEMORY_BYTES = 32 * 1024 * 1024
+
+# SQLite store file, pages kept in it, and seconds between sweeps of old
+# pages
+STORE_FILE = os.environ.get("BOOTRA_PAGE_CACHE_FILE", "page_cache.db")
+STORE_PAGES = 10000
+SWEEP_EVERY = 10 * 60
+
+
+################################## PAGE CACHE #################################
+
+class PageCache:
+    """
+    Caches the GET responses of endpoints per user.
+
+    Attributes:
+        stats (dict): endpoint to dict of hits, misses and skipped counts
+    """
+
+    def __init__(self, app, store, version, endpoints=ENDPOINTS):
+        """
+        Adds the hooks to the app. Add it after any hooks that change
+        responses, such as Instrumentation, so they aren't cached.
+
+        Args:
+            app (Flask)
+            store: MemoryStore or SqliteStore
+            version (function): takes a user id and returns their data
+                version
+            endpoints (list of str): endpoints to cache
+        """
+        self.store = store
+        self.version = version
+        self.endpoints = set(endpoints)
+        self.stats = {endpoint: dict.fromkeys(["hits", "misses", "skipped"], 0)
+                      for endpoint in self.endpoints}
+        self._lock = threading.Lock()
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def before_request(self):
+        """Serves the request's page from the cache if it's there."""
+        if request.method != "GET" or request.endpoint not in self.endpoints:
+            return None
+        user_id = session.get("user_id")
+        if user_id is None:
+            return None
+        if "_flashes" in session:
+            self.count("skipped")
+            return None
+
+        key = f"{user_id}:{self.version(user_id)}:{date.today()}:" \
+              f"{request.full_path}"
+        page = self.store.get(key)
+        if page is None:
+            self.count("misses")
+            g.page_cache_key = key
+            return None
+
+        self.count("hits")
+        body, mimetype = page
+        return Response(body, mimetype=mimetype)
+
+    def after_request(self, response):
+        """Stores the page of a miss, unless the view changed the session."""
+        key = g.pop("page_cache_key", None)
+        if key is not None and response.status_code == 200 \
+                and not response.direct_passthrough and not session.modified:
+            self.store.set(key, (response.get_data(), response.mimetype))
+        return response
+
+    def count(self, result):
+        """Counts a hit, miss or skip of the request's endpoint."""
+        g.page_cache = result
+        with self._lock:
+            self.stats[request.endpoint][result] += 1
+
+
+#################################### STORES ###################################
+
+class MemoryStore:
+    """LRU of pages in this process, bounded by their total size."""
+
+    def __init__(self, capacity=MEMORY_BYTES):
+        """
+        Args:
+            capacity (int): max bytes of page bodies kept
+        """
+        self.capacity = capacity
+        self.size = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the (body, mimetype) stored for a key, or None."""
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        """Stores a (body, mimetype) page, evicting the least recently used."""
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._pages[key] = page
+            self.size += len(page[0])
+            while self.size > self.capacity:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted[0])
+
+
+class SqliteStore:
+    """
+    Pages in the pages table of a SQLite file of their own, shared by every
+    process using the file. Writes are best effort, a page that can't be
+    stored because the file is busy is just rendered again next time.
+    """
+
+    def __init__(self, path=STORE_FILE, capacity=STORE_PAGES):
+        """
+        Args:
+            path (str): store file, created if it doesn't exist
+            capacity (int): pages kept after a sweep
+        """
+        self.db = Database(path)
+        self.capacity = capacity
+        self._swept = 0
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages " \
+                        "(key TEXT PRIMARY KEY NOT NULL, " \
+                        "body BLOB NOT NULL, mimetype TEXT NOT NULL, " \
+                        "stored REAL NOT NULL)")
+
+    def get(self, key):
+        """Returns the (body, mimetype) stored for a key, or None."""
+        rows = self.db.execute("SELECT body, mimetype FROM pages " \
+                               "WHERE key = ?", key)
+        return (rows[0]["body"], rows[0]["mimetype"]) if rows else None
+
+    def set(self, key, page):
+        """Stores a (body, mimetype) page, sweeping old pages now and then."""
+        try:
+            self.db.execute("INSERT OR REPLACE INTO pages " \
+                            "(key, body, mimetype, stored) " \
+                            "VALUES (?, ?, ?, ?)",
+                            key, page[0], page[1], time.time())
+            if time.time() - self._swept > SWEEP_EVERY:
+                self.sweep()
+        except sqlite3.OperationalError:
+            pass
+
+    def sweep(self):
+        """
+        Deletes pages stored over two days ago, whose day has passed, and all
+        but the newest capacity pages.
+
+        Returns:
+            int number of pages deleted
+        """
+        self._swept = time.time()
+        return self.db.execute("DELETE FROM pages WHERE stored < ? OR " \
+                               "rowid <= (SELECT MAX(rowid) FROM pages) - ?",
+                               self._swept - 2 * 24 * 60 * 60, self.capacity)
@@ -0,0 +1,172 @@
+""" Reading projections for Bootra
+
+Vectorised versions of the book dashboard calculations. Rates and completion
+dates for every book on a shelf, at any number of reading speeds, are worked
+out together with NumPy arrays instead of one book and one rate at a time.
+
+SECTIONS:
+    - Config
+    - Projection Functions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import numpy as np
+
+from datetime import date
+
+# Pages per day read in roughly 15 mins, 30 mins and 1 hour daily
+READING_RATES = {"15min": 11, "30min": 22, "1hour": 44}
+
+NAT = np.datetime64("NaT", "D")
+
+
+############################# PROJECTION FUNCTIONS ############################
+
+def finish_dates(pages_left, rates, today):
+    """
+    Calculates dates to read a number of pages at given rates starting
+    tomorrow, element wise with broadcasting.
+
+    Args:
+        pages_left (array): pages left to read
+        rates (array): pages read per day
+        today (numpy datetime64)
+
+    Returns:
+        datetime64[D] array, NaT where the rate is not a positive number
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days = np.ceil(pages_left / rates)
+    valid = np.isfinite(days) & (rates > 0)
+    days = np.where(valid, days, 0).astype("timedelta64[D]")
+    return np.where(valid, today + days, NAT)
+
+
+def project(pages, page, start_dates, target_dates, rates, today=None,
+            recent_rates=None):
+    """
+    Calculates reading rates and completion dates for many books at once.
+
+    Args:
+        pages (sequence of int): total pages of each book
+        page (sequence of int): current page of each book
+        start_dates (sequence): start date of each book as 'YYYY-MM-DD' or
+            datetime date, None if not started
+        target_dates (sequence): target date of each book, None if no target
+        rates (sequence of float): reading speed scenarios in pages per day
+        today (datetime date): defaults to today
+        recent_rates (sequence of float): pages per day read recently by
+            each book, None or NaN where unknown
+
+    Returns:
+        dict of arrays, one row per book
+            current_rate - recent rate where known, else pages per day since
+                starting, NaN if not started
+            target_rate - pages per day needed from tomorrow to finish on the
+                target date, NaN if no target or target reached
+            current_date - completion date at current_rate, NaT if none
+            dates - completion date at each of rates, shape (books, rates)
+    """
+    today = np.datetime64(today or date.today(), "D")
+    pages = np.asarray(pages, dtype=float)
+    page = np.asarray(page, dtype=float)
+    pages_left = pages - page
+    start = to_dates(start_dates)
+    target = to_dates(target_dates)
+
+    # +1 to count the start day as a whole day
+    days_read = np.where(np.isnat(start), np.nan,
+                         (today - start).astype(float) + 1)
+    days_left = np.where(np.isnat(target), np.nan,
+                         (target - today).astype(float))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        current_rate = page / days_read
+        target_rate = np.where(days_left >= 1, pages_left / days_left, np.nan)
+
+    if recent_rates is not None:
+        recent = np.array([np.nan if rate is None else rate
+                           for rate in recent_rates], dtype=float)
+        current_rate = np.where(np.isnan(recent), current_rate, recent)
+
+    rates = np.asarray(rates, dtype=float)
+    return {
+        "current_rate": current_rate,
+        "target_rate": target_rate,
+        "current_date": finish_dates(pages_left, current_rate, today),
+        "dates": finish_dates(pages_left[:, None], rates[None, :], today)
+    }
+
+
+def project_books(books, rates=READING_RATES, today=None, recent_rates=None):
+    """
+    Calculates the book dashboard rates and dates for a list of books.
+
+    Args:
+        books (list of dicts): current book data from the current table
+        rates (dict): scenario name to pages per day
+        today (datetime date): defaults to today
+        recent_rates (dict): book id to recent pages per day, see
+            helpers.select_recent_rates, books without one use the rate
+            since starting
+
+    Returns:
+        list with a (rates, dates) pair for each book, in the format of
+        helpers.book_projections
+    """
+    today = today or date.today()
+    result = project([book["pages"] for book in books],
+                     [book["page"] for book in books],
+                     [book["start_date"] for book in books],
+                     [book["target_date"] for book in books],
+                     list(rates.values()), today,
+                     None if recent_rates is None else
+                     [recent_rates.get(book["id"]) for book in books])
+
+    current_rate = to_floats(result["current_rate"])
+    target_rate = to_floats(result["target_rate"])
+    current_date = result["current_date"].astype(object)
+    dates = result["dates"].astype(object)
+    tomorrow = (np.datetime64(today, "D") + 1).astype(object)
+
+    projections = []
+    for i in range(len(books)):
+        book_dates = {"current": current_date[i], "tomorrow": tomorrow}
+        book_dates.update(zip(rates, dates[i]))
+        projections.append(({"current": current_rate[i],
+                             "target": target_rate[i]}, book_dates))
+    return projections
+
+
+def shelf_dates(books, rates=READING_RATES, today=None):
+    """
+    Calculates when a whole shelf of books would be finished reading one
+    after another at each rate.
+
+    Args:
+        books (list of dicts): current book data from the current table
+        rates (dict): scenario name to pages per day
+        today (datetime date): defaults to today
+
+    Returns:
+        dict of scenario name to datetime date
+    """
+    today = np.datetime64(today or date.today(), "D")
+    pages_left = sum(book["pages"] - book["page"] for book in books)
+    dates = finish_dates(float(pages_left),
+                         np.asarray(list(rates.values()), dtype=float), today)
+    return dict(zip(rates, dates.astype(object)))
+
+
+def to_dates(values):
+    """Converts dates, 'YYYY-MM-DD' strings and None to a datetime64 array."""
+    return np.array(["NaT" if value is None else value for value in values],
+                    dtype="datetime64[D]")
+
+
+def to_floats(values):
+    """Converts a float array to a list of floats, None where NaN."""
+    return [None if np.isnan(value) else float(value) for value in values]
@@ -0,0 +1,195 @@
+""" Session backends for Bootra
+
+Two ways to keep Flask sessions that work behind a multi-process server and
+across restarts, picked with the BOOTRA_SESSIONS environment variable:
+
+    sqlite: the default. Sessions are rows in the sessions table of the app's
+        database, which every worker process shares through WAL. The cookie
+        holds only a random session id, stored hashed. Expired sessions are
+        swept every SWEEP_EVERY seconds.
+    cookie: Flask's signed cookie sessions, nothing stored on the server.
+        Every worker and node must share the secret key, set it with
+        BOOTRA_SECRET_KEY.
+
+SECTIONS:
+    - Config
+    - Secret Key
+    - SQLite Sessions
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import hashlib
+import os
+import secrets
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+BACKENDS = ("sqlite", "cookie")
+
+# Secret key file used when BOOTRA_SECRET_KEY isn't set
+SECRET_FILE = os.environ.get("BOOTRA_SECRET_FILE", "secret_key")
+
+# Seconds between sweeps of expired sessions in each process
+SWEEP_EVERY = 60 * 60
+
+
+################################### SECRET KEY ################################
+
+def load_secret_key(path=SECRET_FILE):
+    """
+    Returns the secret key from BOOTRA_SECRET_KEY, or from a file shared by
+    the processes on this machine, creating the file with a random key if it
+    doesn't exist.
+
+    Args:
+        path (str): secret key file
+
+    Returns:
+        str secret key
+    """
+    key = os.environ.get("BOOTRA_SECRET_KEY")
+    if key:
+        return key
+
+    try:
+        # Only one process can create the file, the rest read its key
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path) as f:
+            return f.read().strip()
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, "w") as f:
+        f.write(key + "\n")
+    return key
+
+
+################################# SQLITE SESSIONS #############################
+
+class SqliteSession(CallbackDict, SessionMixin):
+    """
+    Session loaded from the sessions table.
+
+    Attributes:
+        sid (str): session id sent in the cookie, None until first saved
+        expires (float): time the stored session expires, None if new
+        modified (bool): whether the data changed in this request
+        rotate (bool): whether the session was cleared, so it gets a new id
+    """
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+        self.rotate = False
+
+    def clear(self):
+        """Empties the session, giving it a new id when saved, as on log in."""
+        super().clear()
+        self.rotate = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Flask session interface storing sessions in the sessions table.
+
+    Stored sessions expire after the app's permanent_session_lifetime, which
+    is extended once less than half of it is left. Unchanged sessions aren't
+    written, so most requests only read their session.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, db):
+        """
+        Args:
+            db: database with execute(sql, *args) and transaction() methods
+        """
+        self.db = db
+        self._swept = 0
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS sessions " \
+                        "(id TEXT PRIMARY KEY NOT NULL, data TEXT NOT NULL, " \
+                        "expires REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS sessions_expires " \
+                        "ON sessions (expires)")
+
+    def open_session(self, app, request):
+        """Loads the request's session, or starts an empty one."""
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            rows = self.db.execute("SELECT data, expires FROM sessions " \
+                                   "WHERE id = ? AND expires > ?",
+                                   self._key(sid), time.time())
+            if rows:
+                return SqliteSession(self.serializer.loads(rows[0]["data"]),
+                                     sid, rows[0]["expires"])
+        return SqliteSession()
+
+    def save_session(self, app, session, response):
+        """Stores the session if it changed or is due to be extended."""
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        if now - self._swept > SWEEP_EVERY:
+            self.sweep()
+
+        if session.sid is not None and (session.rotate or not session):
+            if session.modified or session.rotate:
+                self.db.execute("DELETE FROM sessions WHERE id = ?",
+                                self._key(session.sid))
+            session.sid = None
+        if not session:
+            if session.modified or session.rotate:
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        response.vary.add("Cookie")
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.sid is not None and not session.modified \
+                and session.expires - now > lifetime / 2:
+            return
+
+        new = session.sid is None
+        if new:
+            session.sid = secrets.token_urlsafe(32)
+        self.db.execute("INSERT OR REPLACE INTO sessions (id, data, expires) " \
+                        "VALUES (?, ?, ?)", self._key(session.sid),
+                        self.serializer.dumps(dict(session)), now + lifetime)
+
+        # Session cookies last until the browser closes, unless permanent
+        if new or session.permanent:
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app),
+                                httponly=self.get_cookie_httponly(app))
+
+    def sweep(self):
+        """
+        Deletes expired sessions.
+
+        Returns:
+            int number of sessions deleted
+        """
+        self._swept = time.time()
+        return self.db.execute("DELETE FROM sessions WHERE expires <= ?",
+                               self._swept)
+
+    def _key(self, sid):
+        """Returns the stored key of a session id, so ids aren't stored."""
+        return hashlib.sha256(sid.encode()).hexdigest()
@@ -0,0 +1,42 @@
+// Infinite scrolling for the paged tables on the homepage and history page.
+// When the Load more link scrolls into view the next page of rows is fetched
+// from its data-page url and appended to the table.
+document.addEventListener("DOMContentLoaded", function() {
+
+    let more = document.querySelector(".load-more");
+    if (!more || !("IntersectionObserver" in window)) {
+        return;
+    }
+
+    let rows = document.querySelector("#books tbody");
+    let loading = false;
+
+    let observer = new IntersectionObserver(function(entries) {
+        if (!entries[0].isIntersecting || loading) {
+            return;
+        }
+        loading = true;
+
+        let query = "?after=" + encodeURIComponent(more.dataset.after) + "&size=" + more.dataset.size;
+        fetch(more.dataset.page + query, {credentials: "same-origin"})
+            .then(function(response) {
+                return response.json();
+            })
+            .then(function(page) {
+                rows.insertAdjacentHTML("beforeend", page.html);
+                if (page.after) {
+                    more.dataset.after = page.after;
+                    more.href = window.location.pathname + "?after=" + encodeURIComponent(page.after) + "&size=" + more.dataset.size;
+                    loading = false;
+                }
+                else {
+                    observer.disconnect();
+                    more.remove();
+                }
+            })
+            .catch(function() {
+                loading = false;
+            });
+    });
+    observer.observe(more);
+});
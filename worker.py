@@ -0,0 +1,109 @@
+""" Background book lookups for Bootra
+
+Looks up books on Open Library outside of the request that added them. The
+/add page saves a placeholder book and hands its ISBN to the worker, which
+fills in the title, author and pages once Open Library answers, so adding a
+book never waits on the API.
+
+The worker is one daemon thread running an asyncio event loop, with a fixed
+number of lookups in flight at once. It makes one attempt at each lookup
+and holds nothing durable: every placeholder also has a lookup_book job on
+the job queue, which retries lookups that failed or were lost to a restart.
+
+SECTIONS:
+    - Config
+    - Lookup Worker
+"""
+
+__author__ = "Jack Cahill"
+
+#################################### CONFIG ###################################
+
+import asyncio
+import logging
+import threading
+
+from requests import RequestException
+
+from openlibrary import WORKERS
+
+log = logging.getLogger(__name__)
+
+
+################################# LOOKUP WORKER ###############################
+
+class LookupWorker:
+    """
+    Runs async ISBN lookups on a background thread and passes each result
+    to a callback.
+
+    Attributes:
+        fetch (coroutine function): looks up one ISBN, returning a book dict
+            or None, raising RequestException on network errors
+        found (function): called with (isbn, book or None) for each lookup
+            that got an answer
+        failed (function): called with isbn for each lookup that failed
+            with a network error, left to the lookup_book job to retry
+        concurrency (int): max lookups in flight at once
+    """
+
+    def __init__(self, fetch, found, failed, concurrency=WORKERS):
+        """
+        Args:
+            fetch (coroutine function): see class attributes
+            found (function): see class attributes
+            failed (function): see class attributes
+            concurrency (int): max lookups in flight at once
+        """
+        self.fetch = fetch
+        self.found = found
+        self.failed = failed
+        self.concurrency = concurrency
+        self._loop = None
+        self._queue = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, isbns=()):
+        """
+        Starts the worker thread if it is not already running.
+
+        Args:
+            isbns (iterable of str): lookups left over from a previous run
+        """
+        with self._lock:
+            if self._loop is None:
+                threading.Thread(target=asyncio.run, args=(self._main(),),
+                                 name="lookup-worker", daemon=True).start()
+                self._ready.wait()
+        for isbn in isbns:
+            self.submit(isbn)
+
+    def submit(self, isbn):
+        """Queues an ISBN to be looked up, starting the worker if needed."""
+        if self._loop is None:
+            self.start()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, isbn)
+
+    async def _main(self):
+        """Event loop body, runs concurrency lookup tasks forever."""
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._ready.set()
+        await asyncio.gather(*(self._lookups()
+                               for _ in range(self.concurrency)))
+
+    async def _lookups(self):
+        """Looks up queued ISBNs one at a time."""
+        while True:
+            isbn = await self._queue.get()
+            try:
+                try:
+                    book = await self.fetch(isbn)
+                except RequestException as error:
+                    log.warning("Lookup of %s failed: %s", isbn, error)
+                    await asyncio.to_thread(self.failed, isbn)
+                else:
+                    await asyncio.to_thread(self.found, isbn, book)
+            except Exception:
+                log.exception("Saving lookup of %s failed", isbn)